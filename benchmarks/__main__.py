@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+import os
+import sys
+
+from materialgirl.storage.memory import InMemoryStorage
+from materialgirl.storage.redis import RedisStorage
+from benchmarks import scenarios
+from benchmarks.core import redis_server, load_baseline, save_baseline, compare, format_seconds
+
+
+SCENARIOS = ('run', 'get', 'serialization')
+STORAGES = ('memory', 'redis')
+
+
+def parse_arguments(arguments=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Benchmarks materialgirl hot paths.')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='scenarios to run (default: all)')
+    parser.add_argument('--storage', action='append', choices=STORAGES, help='storages to run against (default: all)')
+    parser.add_argument('--quick', action='store_true', help='smaller sizes and fewer repetitions')
+    parser.add_argument('--repeat', type=int, help='samples of each scenario')
+    parser.add_argument('--baseline', help='compare with the results saved in this file')
+    parser.add_argument('--save-baseline', help='save the results in this file')
+    parser.add_argument(
+        '--max-regression', type=float,
+        help='fail if any p50 is slower than the baseline by more than this fraction (like 0.2)'
+    )
+    return parser.parse_args(arguments)
+
+
+def run_scenarios(options, name, storage):
+    repeat = options.repeat or (5 if options.quick else 20)
+    results = []
+
+    if 'run' in options.scenario:
+        for materials in ((100, 1000) if options.quick else (100, 10000, 100000)):
+            for expired_fraction in (0, 0.1, 1):
+                results.append(scenarios.run_pass(name, storage, materials, expired_fraction, repeat))
+
+    if 'get' in options.scenario:
+        samples = repeat * 100
+        results.append(scenarios.get_hit(name, storage, samples))
+        results.append(scenarios.get_stale(name, storage, samples))
+        results.append(scenarios.get_miss(name, storage, samples))
+
+    return results
+
+
+def run_serialization(options):
+    repeat = (options.repeat or (5 if options.quick else 20)) * 10
+    results = []
+
+    for serializer_name, serializer in sorted(scenarios.serializers().items()):
+        for shape in sorted(scenarios.SHAPES):
+            for size in ((1024, 102400) if options.quick else (1024, 102400, 1048576)):
+                result = scenarios.serialization(serializer_name, serializer, shape, size, repeat)
+                if result is not None:
+                    results.append(result)
+
+    return results
+
+
+def report(results, baseline=None):
+    print('%-45s %14s %10s %10s %10s' % ('scenario', 'ops/s', 'p50', 'p99', 'vs base'))
+
+    for result in results:
+        change = '-'
+        if baseline is not None:
+            difference = compare(result, baseline)
+            if difference is not None:
+                change = '%+.1f%%' % (difference * 100)
+
+        print('%-45s %14.1f %10s %10s %10s' % (
+            result.name, result.throughput or 0, format_seconds(result.p50), format_seconds(result.p99), change
+        ))
+
+
+def main(arguments=None):
+    options = parse_arguments(arguments)
+    options.scenario = options.scenario or list(SCENARIOS)
+    options.storage = options.storage or list(STORAGES)
+
+    # refreshes log every step, which would be measured too
+    logging.disable(logging.INFO)
+
+    results = []
+
+    if 'run' in options.scenario or 'get' in options.scenario:
+        if 'memory' in options.storage:
+            results.extend(run_scenarios(options, 'memory', InMemoryStorage()))
+
+        if 'redis' in options.storage:
+            with redis_server() as connection:
+                results.extend(run_scenarios(options, 'redis', RedisStorage(connection)))
+
+    if 'serialization' in options.scenario:
+        results.extend(run_serialization(options))
+
+    baseline = None
+    if options.baseline:
+        if os.path.exists(options.baseline):
+            baseline = load_baseline(options.baseline)
+        else:
+            print('No baseline at %s yet, run "make benchmark-baseline" to save one.' % options.baseline)
+    report(results, baseline)
+
+    if options.save_baseline:
+        save_baseline(options.save_baseline, results)
+
+    if baseline is not None and options.max_regression is not None:
+        regressions = [
+            result.name for result in results
+            if (compare(result, baseline) or 0) > options.max_regression
+        ]
+        if regressions:
+            print('Slower than the baseline: %s' % ', '.join(regressions))
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import subprocess
+from contextlib import contextmanager
+from time import time, sleep
+
+import redis
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# benchmarks get their own server, so they don't mess with the tests' one
+REDIS_PORT = 7558
+
+
+def percentile(samples, percent):
+    if not samples:
+        return None
+
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * percent / 100.0))]
+
+
+def format_seconds(seconds):
+    if seconds is None:
+        return '-'
+    if seconds < 0.001:
+        return '%.1fus' % (seconds * 1000000)
+    if seconds < 1:
+        return '%.2fms' % (seconds * 1000)
+    return '%.2fs' % seconds
+
+
+class Result(object):
+    '''
+    What a scenario measured: how long each sample took, in seconds, and how
+    many operations each sample did.
+    '''
+
+    def __init__(self, name, samples, operations=1):
+        self.name = name
+        self.samples = samples
+        self.operations = operations
+
+    @property
+    def throughput(self):
+        total = sum(self.samples)
+        if not total:
+            return None
+        return len(self.samples) * self.operations / total
+
+    @property
+    def p50(self):
+        return percentile(self.samples, 50)
+
+    @property
+    def p99(self):
+        return percentile(self.samples, 99)
+
+    def to_dict(self):
+        return {
+            'throughput': self.throughput,
+            'p50': self.p50,
+            'p99': self.p99,
+            'samples': len(self.samples),
+            'operations': self.operations,
+        }
+
+
+def measure(name, method, repeat, operations=1, setup=None):
+    '''
+    Calls `method` `repeat` times, timing each call. `setup` is called (and not
+    timed) before each of them.
+    '''
+    samples = []
+
+    for index in range(repeat):
+        if setup is not None:
+            setup()
+
+        start = time()
+        method()
+        samples.append(time() - start)
+
+    return Result(name, samples, operations)
+
+
+@contextmanager
+def redis_server(port=REDIS_PORT):
+    '''
+    A connection to a redis-server started from the repository's redis.conf
+    (on `port`, with its own pid and dump files), shut down when done.
+    '''
+    connection = redis.StrictRedis(host='localhost', port=port, db=0)
+
+    subprocess.check_call([
+        'redis-server', os.path.join(ROOT, 'redis.conf'),
+        '--port', str(port),
+        '--pidfile', '/tmp/redis-material-girl-benchmarks.pid',
+        '--dbfilename', 'redis-material-girl-benchmarks.rdb',
+        '--save', '',
+    ])
+
+    try:
+        wait_for(connection)
+        connection.flushdb()
+        yield connection
+    finally:
+        try:
+            connection.shutdown(nosave=True)
+        except redis.ConnectionError:
+            pass
+
+
+def wait_for(connection, timeout=5):
+    deadline = time() + timeout
+
+    while True:
+        try:
+            connection.ping()
+            return
+        except redis.ConnectionError:
+            if time() > deadline:
+                raise
+            sleep(0.05)
+
+
+def load_baseline(path):
+    with open(path) as baseline:
+        return json.load(baseline)
+
+
+def save_baseline(path, results):
+    with open(path, 'w') as baseline:
+        json.dump(dict((result.name, result.to_dict()) for result in results), baseline, indent=2, sort_keys=True)
+
+
+def compare(result, baseline):
+    '''
+    How much slower (positive) or faster (negative) `result` is than its
+    baseline, as a fraction of the baseline p50, or None if not in it.
+    '''
+    previous = baseline.get(result.name)
+    if not previous or not previous.get('p50') or result.p50 is None:
+        return None
+
+    return (result.p50 - previous['p50']) / previous['p50']
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from itertools import count
+
+from materialgirl import Materializer
+from materialgirl.materializer import REFRESHED
+from materialgirl.serializers import (
+    Serializer, MsgPackCodec, PickleCodec, JsonCodec, BytesCodec, ZlibCompressor, Lz4Compressor, lz4
+)
+from benchmarks.core import measure
+
+
+def get_value():
+    return {'violations': [{'key': 'blacklist.domains', 'value': index} for index in range(10)]}
+
+
+def run_pass(name, storage, materials, expired_fraction, repeat):
+    '''
+    A `run` over `materials` materials (stored and up-to-date) with
+    `expired_fraction` of them expired before each pass. Fails if a pass
+    refreshes any other number of materials, as it would measure something else.
+    '''
+    girl = Materializer(storage=storage)
+
+    expired = int(materials * expired_fraction)
+    for index in range(materials):
+        tags = ['benchmark-expired'] if index < expired else None
+        girl.add_material('benchmark-run-%d' % index, get_value, expiration=3600, tags=tags)
+
+    girl.run()
+
+    def expire():
+        if expired:
+            storage.expire_tag('benchmark-expired')
+
+    refreshed = []
+
+    def run():
+        refreshed.append(sum(1 for result in girl.run().values() if result.status == REFRESHED))
+
+    try:
+        result = measure(
+            'run/%s/%d/%d%%' % (name, materials, expired_fraction * 100),
+            run, repeat, operations=materials, setup=expire
+        )
+    finally:
+        girl.close()
+
+    if set(refreshed) != set([expired]):
+        raise RuntimeError('%s refreshed %s materials per pass, instead of %d.' % (
+            result.name, ', '.join(str(number) for number in refreshed), expired
+        ))
+
+    return result
+
+
+def get_hit(name, storage, repeat):
+    girl = Materializer(storage=storage)
+    girl.add_material('benchmark-hit', get_value, expiration=3600)
+    girl.get('benchmark-hit')
+
+    return measure('get/%s/hit' % name, lambda: girl.get('benchmark-hit'), repeat)
+
+
+def get_stale(name, storage, repeat):
+    girl = Materializer(storage=storage, stale_while_revalidate=True)
+    girl.add_material('benchmark-stale', get_value, expiration=3600, grace_period=7200)
+    girl.get('benchmark-stale')
+
+    # someone else holds the lock, so stale values are served over and over
+    storage.expire('benchmark-stale')
+    lock = storage.acquire_lock('benchmark-stale')
+
+    try:
+        return measure('get/%s/stale' % name, lambda: girl.get('benchmark-stale'), repeat)
+    finally:
+        storage.release_lock(lock)
+        girl.close()
+
+
+def get_miss(name, storage, repeat):
+    girl = Materializer(storage=storage)
+    for index in range(repeat):
+        girl.add_material('benchmark-miss-%d' % index, get_value, expiration=3600)
+
+    indexes = count()
+    return measure('get/%s/miss' % name, lambda: girl.get('benchmark-miss-%d' % next(indexes)), repeat)
+
+
+SHAPES = {
+    'ints': lambda size: list(range(size // 3)),
+    'records': lambda size: [
+        {'id': index, 'url': 'http://example.com/page/%d' % index, 'violations': index % 7}
+        for index in range(size // 60)
+    ],
+    'text': lambda size: u'materialgirl ' * (size // 13),
+    'bytes': lambda size: b'materialgirl ' * (size // 13),
+}
+
+
+def serializers():
+    available = {
+        'msgpack': Serializer(),
+        'msgpack+zlib': Serializer(MsgPackCodec(), ZlibCompressor(), compress_threshold=0),
+        'pickle': Serializer(PickleCodec()),
+        'json': Serializer(JsonCodec()),
+        'bytes': Serializer(BytesCodec()),
+    }
+
+    if lz4 is not None:
+        available['msgpack+lz4'] = Serializer(MsgPackCodec(), Lz4Compressor(), compress_threshold=0)
+
+    return available
+
+
+def serialization(serializer_name, serializer, shape, size, repeat):
+    '''
+    Encoding and decoding a value of `shape` serializing to about `size` bytes.
+    None if the serializer can't handle that shape.
+    '''
+    value = SHAPES[shape](size)
+
+    try:
+        serializer.loads(serializer.dumps(value))
+    except (TypeError, ValueError):
+        return None
+
+    return measure(
+        'serialization/%s/%s/%d' % (serializer_name, shape, size),
+        lambda: serializer.loads(serializer.dumps(value)), repeat
+    )
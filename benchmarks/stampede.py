@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Simulates a stampede: many reader processes getting one material and a few
+worker processes refreshing it, while the material keeps being expired (or
+deleted) under them. Run it with `python -m benchmarks.stampede --help`.
+'''
+
+import argparse
+import logging
+import multiprocessing
+import random
+import sys
+try:
+    from queue import Empty
+except ImportError:  # Python 2
+    from Queue import Empty
+from time import time, sleep
+
+import redis
+
+from materialgirl import Materializer
+from materialgirl.materializer import LOCKED
+from materialgirl.metrics import InMemoryMetrics
+from materialgirl.storage.redis import RedisStorage
+from benchmarks.core import REDIS_PORT, redis_server, percentile, format_seconds
+
+
+KEY = 'stampede'
+COMPUTATIONS = 'stampede-computations'
+
+
+def parse_arguments(arguments=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.stampede', description='Simulates readers and workers hitting an expiring material.'
+    )
+    parser.add_argument('--readers', type=int, default=200, help='reader processes (default: 200)')
+    parser.add_argument('--workers', type=int, default=4, help='worker processes (default: 4)')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to run for (default: 10)')
+    parser.add_argument('--expire-every', type=float, default=2, help='seconds between expirations (default: 2)')
+    parser.add_argument(
+        '--delete', action='store_true',
+        help='delete the value instead of expiring it, so readers miss instead of reading stale values'
+    )
+    parser.add_argument('--latency', type=float, default=0.5, help='seconds get_method takes (default: 0.5)')
+    parser.add_argument('--jitter', type=float, default=0.2, help='get_method latency varies by this fraction (default: 0.2)')
+    parser.add_argument('--read-interval', type=float, default=0.01, help='seconds between reads (default: 0.01)')
+    parser.add_argument('--run-interval', type=float, default=0.1, help='seconds between worker runs (default: 0.1)')
+    parser.add_argument('--lock-timeout', type=float, default=None, help='lock timeout of the material')
+    parser.add_argument('--stale-while-revalidate', action='store_true', help='readers revalidate stale values')
+    parser.add_argument('--bucket', type=float, default=1, help='seconds per line of the report (default: 1)')
+    parser.add_argument('--port', type=int, default=REDIS_PORT, help='port of the redis-server started (default: %d)' % REDIS_PORT)
+    return parser.parse_args(arguments)
+
+
+def get_method_for(options, role):
+    connection = redis.StrictRedis(port=options.port)
+
+    def get_method():
+        started = time()
+        sleep(max(0, random.uniform(options.latency * (1 - options.jitter), options.latency * (1 + options.jitter))))
+        connection.rpush(COMPUTATIONS, '%f %s' % (started, role))
+        return {'computed_at': started}
+
+    return get_method
+
+
+def materializer_for(options, role, **kwargs):
+    storage = RedisStorage(redis.StrictRedis(port=options.port))
+    girl = Materializer(storage=storage, **kwargs)
+    girl.add_material(
+        KEY, get_method_for(options, role),
+        expiration=3600, grace_period=7200, lock_timeout=options.lock_timeout
+    )
+    return girl
+
+
+def reader(options, ready, start, started_at, results):
+    metrics = InMemoryMetrics()
+    girl = materializer_for(options, 'reader', metrics=metrics, stale_while_revalidate=options.stale_while_revalidate)
+
+    ready.put(True)
+    start.wait()
+    end = started_at.value + options.duration
+
+    reads = []
+    while time() < end:
+        read_at = time()
+        value = girl.get(KEY)
+        reads.append((read_at, time() - read_at, value and value['computed_at']))
+        sleep(options.read_interval)
+
+    girl.close()
+    results.put(('reader', reads, metrics.counter('lock.contended', material=KEY)))
+
+
+def worker(options, ready, start, started_at, results):
+    girl = materializer_for(options, 'worker')
+
+    ready.put(True)
+    start.wait()
+    end = started_at.value + options.duration
+
+    contended = 0
+    while time() < end:
+        contended += sum(1 for result in girl.run().values() if result.status == LOCKED)
+        sleep(options.run_interval)
+
+    girl.close()
+    results.put(('worker', [], contended))
+
+
+class Report(object):
+    '''
+    What happened in a simulation, computed from the reads, computations and
+    expirations seen. A read is stale when its value was computed before the
+    last expiration.
+    '''
+
+    def __init__(self, started_at, expirations, computations, reads, contention):
+        self.started_at = started_at
+        self.expirations = expirations
+        self.computations = computations
+        self.reads = sorted(reads)
+        self.contention = contention
+
+    def computations_per_expiration(self):
+        bounds = self.expirations + [float('inf')]
+        return [
+            sum(1 for started, _ in self.computations if bounds[index] <= started < bounds[index + 1])
+            for index in range(len(self.expirations))
+        ]
+
+    def is_stale(self, read_at, computed_at):
+        last_expiration = None
+        for expired_at in self.expirations:
+            if expired_at > read_at:
+                break
+            last_expiration = expired_at
+
+        return computed_at is not None and last_expiration is not None and computed_at < last_expiration
+
+    def buckets(self, seconds):
+        buckets = {}
+        for read in self.reads:
+            buckets.setdefault(int((read[0] - self.started_at) // seconds), []).append(read)
+        return [(index * seconds, buckets[index]) for index in sorted(buckets)]
+
+    def summary(self, bucket):
+        per_expiration = self.computations_per_expiration()
+        duplicates = [max(0, count - 1) for count in per_expiration]
+        roles = {}
+        for _, role in self.computations:
+            roles[role] = roles.get(role, 0) + 1
+
+        lines = [
+            'expirations: %d, computations: %d (%s)' % (
+                len(self.expirations), len(self.computations),
+                ', '.join('%s %d' % item for item in sorted(roles.items())) or 'none'
+            ),
+            'duplicate recomputations per expiration: mean %.2f, max %d (%d computations before the first one)' % (
+                sum(duplicates) / float(len(duplicates)) if duplicates else 0, max(duplicates or [0]),
+                len(self.computations) - sum(per_expiration)
+            ),
+            'lock contention: %s' % ', '.join('%s %d' % item for item in sorted(self.contention.items())),
+            'reads: %d, stale: %s, misses: %d, p50: %s, p99: %s' % self._reads_summary(self.reads),
+            '',
+            '%8s %8s %8s %10s %10s %10s' % ('second', 'reads', 'stale', 'misses', 'p50', 'p99'),
+        ]
+
+        for offset, reads in self.buckets(bucket):
+            count, stale, misses, p50, p99 = self._reads_summary(reads)
+            expired = any(offset <= expired_at - self.started_at < offset + bucket for expired_at in self.expirations)
+            lines.append('%8.1f %8d %8s %10d %10s %10s%s' % (
+                offset, count, stale, misses, p50, p99, '  <- expired' if expired else ''
+            ))
+
+        return '\n'.join(lines)
+
+    def _reads_summary(self, reads):
+        latencies = [latency for _, latency, _ in reads]
+        stale = sum(1 for read_at, _, computed_at in reads if self.is_stale(read_at, computed_at))
+        misses = sum(1 for _, _, computed_at in reads if computed_at is None)
+
+        return (
+            len(reads),
+            '%.1f%%' % (100.0 * stale / len(reads)) if reads else '-',
+            misses,
+            format_seconds(percentile(latencies, 50)),
+            format_seconds(percentile(latencies, 99)),
+        )
+
+
+def expire(connection, storage, delete):
+    if delete:
+        connection.delete(storage.layout.value(KEY), storage.layout.expired(KEY))
+    else:
+        storage.expire(KEY)
+
+
+def collect(queue, processes):
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            if any(process.exitcode for process in processes):
+                raise RuntimeError('A simulated reader or worker failed.')
+
+
+def simulate(options, connection):
+    storage = RedisStorage(connection)
+    materializer_for(options, 'setup').run()
+    connection.delete(COMPUTATIONS)
+
+    ready = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    start = multiprocessing.Event()
+    started_at = multiprocessing.Value('d', 0)
+
+    processes = [
+        multiprocessing.Process(target=target, args=(options, ready, start, started_at, results))
+        for target, count in ((reader, options.readers), (worker, options.workers))
+        for _ in range(count)
+    ]
+    for process in processes:
+        process.start()
+    for _ in processes:
+        collect(ready, processes)
+
+    started_at.value = time()
+    start.set()
+
+    expirations = []
+    next_expiration = started_at.value + options.expire_every
+    while next_expiration < started_at.value + options.duration:
+        sleep(max(0, next_expiration - time()))
+        expirations.append(time())
+        expire(connection, storage, options.delete)
+        next_expiration += options.expire_every
+
+    reads = []
+    contention = {'reader': 0, 'worker': 0}
+    for _ in processes:
+        role, process_reads, contended = collect(results, processes)
+        reads.extend(process_reads)
+        contention[role] += contended
+
+    for process in processes:
+        process.join()
+
+    computations = []
+    for item in connection.lrange(COMPUTATIONS, 0, -1):
+        started, role = item.decode('utf-8').split(' ')
+        computations.append((float(started), role))
+
+    return Report(started_at.value, expirations, computations, reads, contention)
+
+
+def main(arguments=None):
+    options = parse_arguments(arguments)
+    logging.disable(logging.INFO)
+
+    with redis_server(options.port) as connection:
+        report = simulate(options, connection)
+
+    print(report.summary(options.bucket))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import asyncio
+import logging
+from time import time
+
+from materialgirl.materializer import Material, RefreshResult, REFRESHED, SKIPPED, LOCKED, FAILED
+
+
+class AsyncMaterializer(object):
+    '''
+    asyncio counterpart of Materializer. Works with AsyncStorage backends
+    and accepts both coroutine functions and regular functions as get
+    methods (the latter are run in the loop's default executor).
+    '''
+
+    def __init__(self, storage, load_on_cachemiss=True):
+        self.storage = storage
+        self.load_on_cachemiss = load_on_cachemiss
+
+        self.materials = {}
+
+    def add_material(self, key, get_method, expiration=10, grace_period=0, lock_timeout=None, serializer=None):
+        self.materials[key] = Material(key, get_method, expiration, grace_period, lock_timeout)
+
+        if serializer is not None:
+            self.storage.use_serializer(key, serializer)
+
+    async def expire(self, key):
+        if not key in self.materials:
+            raise ValueError('Key %s not found in materials. Maybe you forgot to call "add_material" for this key?' % key)
+
+        await self.storage.expire(key)
+
+    async def is_expired(self, key):
+        if not key in self.materials:
+            raise ValueError('Key %s not found in materials. Maybe you forgot to call "add_material" for this key?' % key)
+
+        return await self.storage.is_expired(key)
+
+    async def run(self):
+        results = await asyncio.gather(*[
+            self._refresh(key, material) for key, material in list(self.materials.items())
+        ])
+
+        return dict((result.key, result) for result in results)
+
+    async def _refresh(self, key, material):
+        logging.info('Acquiring lock for %s...', key)
+        lock = await self.storage.acquire_lock(key, timeout=material.lock_timeout)
+
+        if lock is None:
+            logging.info('%s is locked, skipping.', key)
+            return RefreshResult(key, LOCKED)
+
+        status = SKIPPED
+        start = time()
+
+        try:
+            if await self.storage.is_expired(key, material.expiration) or material.is_expired:
+                logging.info('Retrieving %s...', key)
+                value = await self._load(material)
+                await self.storage.store(key, value, expiration=material.expiration, grace_period=material.grace_period)
+                logging.info('Storing %s...', key)
+                material.expiration_date = time() + material.expiration
+                status = REFRESHED
+        except Exception:
+            logging.exception('Failed to refresh %s.', key)
+            return RefreshResult(key, FAILED, error=sys.exc_info()[1], duration=time() - start)
+        finally:
+            logging.info('Releasing lock for %s...', key)
+            await self.storage.release_lock(lock)
+
+        logging.info('Done with %s.', key)
+        return RefreshResult(key, status, duration=time() - start)
+
+    async def _load(self, material):
+        if asyncio.iscoroutinefunction(material.get_method):
+            material.current_value = await material.get_method()
+        else:
+            loop = asyncio.get_event_loop()
+            material.current_value = await loop.run_in_executor(None, material.get_method)
+
+        return material.current_value
+
+    async def get(self, key):
+        if not key in self.materials:
+            raise ValueError('Key %s not found in materials. Maybe you forgot to call "add_material" for this key?' % key)
+
+        value = await self.storage.retrieve(key)
+
+        if value is None and self.load_on_cachemiss:
+            material = self.materials[key]
+            value = await self._load(material)
+            await self.storage.store(key, value, expiration=material.expiration, grace_period=material.grace_period)
+
+        return value
@@ -1,12 +1,43 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import re
+import sys
 import logging
-from time import time
+import threading
+from collections import OrderedDict, deque
+from math import log
+from random import random, uniform
+from time import time, sleep
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from materialgirl.metrics import Metrics, InstrumentedStorage
+from materialgirl.resources import ResourceLimiter
+from materialgirl.scheduler import Scheduler
+from materialgirl.storage import StaleLockError, iter_records
+
+
+REFRESHED = 'refreshed'
+SKIPPED = 'skipped'
+LOCKED = 'locked'
+FAILED = 'failed'
+
+# failed refreshes are retried after this many seconds, doubling with each failure in a row up to their expiration
+RETRY_DELAY = 1
 
 
 class Material(object):
-    def __init__(self, key, get_method, expiration=10, grace_period=0, lock_timeout=None):
+    __slots__ = (
+        'key', 'current_value', 'get_method', 'expiration', 'expiration_date', 'grace_period', 'lock_timeout',
+        'early_refresh_beta', 'ttl_jitter', 'last_duration', 'dependencies', 'input_versions', 'refresh_timeout',
+        'resource', 'cost', 'priority', 'failures',
+    )
+
+    def __init__(
+        self, key, get_method, expiration=10, grace_period=0, lock_timeout=None,
+        early_refresh_beta=0, ttl_jitter=0, dependencies=None, refresh_timeout=None,
+        resource=None, cost=1, priority=0
+    ):
         self.key = key
         self.current_value = None
         self.get_method = get_method
@@ -14,67 +45,1148 @@ class Material(object):
         self.expiration_date = time() + expiration
         self.grace_period = grace_period
         self.lock_timeout = lock_timeout
+        self.early_refresh_beta = early_refresh_beta
+        self.ttl_jitter = ttl_jitter
+        self.last_duration = None
+        self.dependencies = tuple(dependencies or ())
+        self.input_versions = None
+        self.refresh_timeout = refresh_timeout
+        self.resource = resource
+        self.cost = cost
+        self.priority = priority
+        self.failures = 0
 
     @property
     def is_expired(self):
-        return self.current_value is None or time() > self.expiration_date
+        return self.is_due()
+
+    @property
+    def name(self):
+        '''
+        How the material is identified in metrics.
+        '''
+        return self.key
+
+    @property
+    def is_loaded(self):
+        return self.current_value is not None
+
+    def is_due(self, early=0):
+        return not self.is_loaded or time() + early > self.expiration_date
+
+    def early_refresh_offset(self):
+        '''
+        How many seconds before its expiration this material should be considered due,
+        following the XFetch algorithm: the slower the get method was last time, the
+        likelier it is to be recomputed early.
+        '''
+        if not self.early_refresh_beta or not self.last_duration:
+            return 0
+
+        return -self.last_duration * self.early_refresh_beta * log(1.0 - random())
+
+    def stored_expiration(self):
+        if not self.ttl_jitter:
+            return self.expiration, self.grace_period
+
+        jitter = uniform(0, self.ttl_jitter * self.expiration)
+        return self.expiration + jitter, self.grace_period + jitter
+
+    def get(self, *inputs):
+        start = time()
+        value = self.get_method(*inputs)
+        self.last_duration = time() - start
+        self.keep(value)
+        return value
+
+    def keep(self, value):
+        '''
+        Remembers `value` was just loaded.
+        '''
+        self.current_value = value
+
+
+class Delta(object):
+    '''
+    What changed in an incremental material: `merge(previous_value, changes)` returns
+    the new value. `watermark` defaults to the time the refresh started.
+    '''
+
+    def __init__(self, changes, merge, watermark=None):
+        self.changes = changes
+        self.merge = merge
+        self.watermark = watermark
+
+
+class IncrementalMaterial(Material):
+    '''
+    A material updated from what changed since its last refresh: `delta_method` gets the
+    previous value and watermark (plus any dependencies values) and returns either a Delta
+    or the new value. `get_method` rebuilds it from scratch on the first refresh of each
+    process and every `full_refresh_interval` seconds (if given).
+    '''
+
+    __slots__ = ('delta_method', 'full_refresh_interval', 'watermark', 'last_full_refresh')
+
+    def __init__(self, key, get_method, delta_method, full_refresh_interval=None, **kwargs):
+        super(IncrementalMaterial, self).__init__(key, get_method, **kwargs)
+        self.delta_method = delta_method
+        self.full_refresh_interval = full_refresh_interval
+        self.watermark = None
+        self.last_full_refresh = None
+
+    def needs_full_refresh(self, now):
+        if self.current_value is None or self.watermark is None:
+            return True
+
+        return self.full_refresh_interval is not None and now - self.last_full_refresh >= self.full_refresh_interval
+
+    def get(self, *inputs):
+        start = time()
+
+        if self.needs_full_refresh(start):
+            value = self.get_method(*inputs)
+            watermark = start
+            self.last_full_refresh = start
+        else:
+            result = self.delta_method(self.current_value, self.watermark, *inputs)
+            if isinstance(result, Delta):
+                value = result.merge(self.current_value, result.changes)
+                watermark = start if result.watermark is None else result.watermark
+            else:
+                value = result
+                watermark = start
+
+        self.current_value = value
+        self.watermark = watermark
+        self.last_duration = time() - start
+        return value
+
+
+class FamilyMaterial(Material):
+    '''
+    A member of a family. There can be lots of them, so only when it was
+    loaded is kept, not its value.
+    '''
+
+    __slots__ = ('requested_at', 'recorded_at', 'pattern', 'loaded_at')
+
+    def __init__(self, key, get_method, pattern=None, **kwargs):
+        super(FamilyMaterial, self).__init__(key, get_method, **kwargs)
+        self.requested_at = None
+        self.recorded_at = None
+        self.pattern = pattern
+        self.loaded_at = None
+
+    @property
+    def is_loaded(self):
+        return self.loaded_at is not None
+
+    def keep(self, value):
+        if value is not None:
+            self.loaded_at = time()
+
+    @property
+    def name(self):
+        # members are measured together, so metrics don't grow with the number of keys
+        return self.pattern
+
+
+def compile_pattern(pattern):
+    '''
+    Turns a key pattern like `violations:{domain_id}` into a regular expression
+    capturing each `{name}` placeholder.
+    '''
+    regex = ''
+    for index, part in enumerate(re.split(r'\{(\w+)\}', pattern)):
+        regex += re.escape(part) if index % 2 == 0 else '(?P<%s>.+?)' % part
+
+    return re.compile('^%s$' % regex)
+
+
+class MaterialFamily(object):
+    '''
+    Materials whose keys match `pattern`, created on demand from the pattern
+    placeholders: `get_method_factory(**placeholders)` returns their get method.
+
+    Only members requested in the last `active_for` seconds are kept (at most
+    `max_members` of them, if given), so only those are refreshed. Requests
+    are recorded in the storage, so workers also refresh the members
+    requested in other processes.
+    '''
+
+    def __init__(self, pattern, get_method_factory, active_for=3600, max_members=None, tags=None, **options):
+        self.pattern = pattern
+        self.regex = compile_pattern(pattern)
+        self.get_method_factory = get_method_factory
+        self.active_for = active_for
+        self.max_members = max_members
+        self.tags = tuple(tags or ())
+        self.options = options
+
+        self.members = OrderedDict()
+        self.synced_at = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.members)
+
+    def match(self, key):
+        match = self.regex.match(key)
+        if match is None:
+            return None
+        return match.groupdict()
+
+    def tags_for(self, params):
+        return [tag.format(**params) for tag in self.tags]
+
+    def request(self, key, params, requested_at=None):
+        '''
+        The member for `key` (created if needed), marked as requested at
+        `requested_at` (now, by default). Returns it and whether it was created.
+        '''
+        if requested_at is None:
+            requested_at = time()
+
+        with self._lock:
+            material = self.members.get(key)
+            created = material is None
+            if created:
+                material = FamilyMaterial(key, self.get_method_factory(**params), pattern=self.pattern, **self.options)
+
+            if created or requested_at > material.requested_at:
+                material.requested_at = requested_at
+                self.members.pop(key, None)
+                self.members[key] = material
+
+        return material, created
+
+    def should_record(self, material, now):
+        '''
+        Whether the request of `material` should be recorded in the storage:
+        at most a few times per `active_for`, so reads don't all write.
+        '''
+        if material.recorded_at is not None and now - material.recorded_at < self.active_for / 10.0:
+            return False
+
+        material.recorded_at = now
+        return True
+
+    def prune(self, now=None):
+        '''
+        Forgets members that were not requested recently. Returns their keys.
+        '''
+        if now is None:
+            now = time()
+
+        removed = []
+        with self._lock:
+            # members are kept in request order, so the least recently requested come first
+            while self.members:
+                key, material = next(iter(self.members.items()))
+                too_many = self.max_members is not None and len(self.members) > self.max_members
+                if not too_many and now - material.requested_at < self.active_for:
+                    break
+
+                del self.members[key]
+                removed.append(key)
+
+        return removed
+
+    def active_members(self):
+        with self._lock:
+            return list(self.members.items())
+
 
-    def get(self):
-        self.current_value = self.get_method()
-        return self.current_value
+class RefreshResult(object):
+    def __init__(self, key, status, error=None, duration=None):
+        self.key = key
+        self.status = status
+        self.error = error
+        self.duration = duration
+
+    @property
+    def succeeded(self):
+        return self.status != FAILED
+
+    def __repr__(self):
+        return '<RefreshResult %s: %s>' % (self.key, self.status)
+
+
+class RefreshTimeout(Exception):
+    '''
+    A get method ran longer than its material's `refresh_timeout`. It is left
+    running, but its value is dropped.
+    '''
+
+
+class Lease(object):
+    '''
+    A lock held while refreshing a material, with the fencing token issued
+    for it, if any. Once started, it is renewed for `timeout` seconds every
+    third of them until stopped; `lost` tells whether it was taken meanwhile.
+    '''
+
+    def __init__(self, storage, key, lock, timeout=None, fence=None):
+        self.storage = storage
+        self.key = key
+        self.lock = lock
+        self.timeout = timeout
+        self.fence = fence
+        self.lost = False
+
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._renew, name='materialgirl-lease-%s' % self.key)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _renew(self):
+        while not self._stopped.wait(self.timeout / 3.0):
+            try:
+                renewed = self.storage.renew_lock(self.lock, self.timeout)
+            except Exception:
+                logging.exception('Failed to renew the lock for %s.', self.key)
+                continue
+
+            if not renewed:
+                logging.warning('Lost the lock for %s.', self.key)
+                self.lost = True
+                return
+
+
+class Flight(object):
+    '''
+    An in-flight cache miss load that other callers for the same key wait on.
+    '''
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
 
 
 class Materializer(object):
-    def __init__(self, storage, load_on_cachemiss=True):
+    def __init__(
+        self, storage, load_on_cachemiss=True, workers=1, use_processes=False,
+        cachemiss_wait=5, cachemiss_poll_interval=0.05, stale_while_revalidate=False, refresh_ahead=0,
+        partitioner=None, metrics=None, lock_lease=None, fencing=False, resources=None, share_resources=False
+    ):
         self.storage = storage
         self.load_on_cachemiss = load_on_cachemiss
+        self.workers = workers
+        self.use_processes = use_processes
+        self.cachemiss_wait = cachemiss_wait
+        self.cachemiss_poll_interval = cachemiss_poll_interval
+        self.stale_while_revalidate = stale_while_revalidate
+        self.refresh_ahead = refresh_ahead
+        self.partitioner = partitioner
+        self.metrics = metrics or Metrics()
+        self.lock_lease = lock_lease
+        self.fencing = fencing
+
+        if metrics is not None and not isinstance(storage, InstrumentedStorage):
+            self.storage = InstrumentedStorage(storage, metrics, name_for=self._material_name)
+
+        self.limiters = {}
+        for resource, limit in (resources or {}).items():
+            if not isinstance(limit, ResourceLimiter):
+                limit = ResourceLimiter(resource, limit, storage=self.storage if share_resources else None)
+            self.limiters[resource] = limit
 
         self.materials = {}
+        self.dependents = {}
+        self.families = []
+        self.scheduler = Scheduler()
+
+        self._stopped = threading.Event()
+
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+
+        # refreshes left behind by refresh_timeout, until their get methods return
+        self._abandoned = {}
+
+        self._revalidating = set()
+        self._revalidating_lock = threading.Lock()
+
+        self._executor = None
+        self._process_pool = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    @property
+    def process_pool(self):
+        if self._process_pool is None:
+            self._process_pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._process_pool
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+        if self._process_pool is not None:
+            self._process_pool.shutdown()
+            self._process_pool = None
+
+        if self.partitioner is not None:
+            self.partitioner.leave()
+
+    def add_material(
+        self, key, get_method, expiration=10, grace_period=0, lock_timeout=None,
+        early_refresh_beta=0, ttl_jitter=0, serializer=None, dependencies=None,
+        delta_method=None, full_refresh_interval=None, tags=None, refresh_timeout=None,
+        resource=None, cost=1, priority=0
+    ):
+        '''
+        Materials with `dependencies` (other material keys) get their values, in
+        the same order, as arguments of `get_method`. They are refreshed after
+        them, and only recomputed when one of them changes or they expire.
+
+        Given a `delta_method`, the material is an IncrementalMaterial.
+
+        Materials can be expired by any of their `tags` with `expire_tag`.
+
+        Refreshes taking longer than `refresh_timeout` seconds are abandoned
+        and reported as failed with a RefreshTimeout.
+
+        Get methods using the same `resource` run within the budget given for
+        it in `resources`, each taking `cost` of it; when it runs out, higher
+        `priority` materials go first.
+        '''
+        options = dict(
+            expiration=expiration, grace_period=grace_period, lock_timeout=lock_timeout,
+            early_refresh_beta=early_refresh_beta, ttl_jitter=ttl_jitter, dependencies=dependencies,
+            refresh_timeout=refresh_timeout, resource=resource, cost=cost, priority=priority
+        )
+
+        if delta_method is not None:
+            material = IncrementalMaterial(
+                key, get_method, delta_method, full_refresh_interval=full_refresh_interval, **options
+            )
+        else:
+            material = Material(key, get_method, **options)
+
+        previous = self.materials.get(key)
+        if previous is not None:
+            for dependency in previous.dependencies:
+                self.dependents[dependency].pop(key, None)
+
+        # kept as ordered sets, so levels come out in the order materials were added
+        for dependency in material.dependencies:
+            self.dependents.setdefault(dependency, OrderedDict())[key] = True
+
+        self.materials[key] = material
+        self.scheduler.schedule(key, time())
+
+        if serializer is not None:
+            self.storage.use_serializer(key, serializer)
+
+        if tags:
+            self.storage.use_tags(key, tags)
+
+    def add_material_family(
+        self, pattern, get_method_factory, expiration=10, grace_period=0, lock_timeout=None,
+        early_refresh_beta=0, ttl_jitter=0, active_for=3600, max_members=None, tags=None, refresh_timeout=None,
+        resource=None, cost=1, priority=0
+    ):
+        '''
+        Handles every key matching `pattern` (like `violations:{domain_id}`) as a
+        material whose get method is `get_method_factory(domain_id=...)`, without
+        registering them upfront. See MaterialFamily.
+
+        `tags` can use the same placeholders, like `domain:{domain_id}`.
+        '''
+        family = MaterialFamily(
+            pattern, get_method_factory, active_for=active_for, max_members=max_members, tags=tags,
+            expiration=expiration, grace_period=grace_period, lock_timeout=lock_timeout,
+            early_refresh_beta=early_refresh_beta, ttl_jitter=ttl_jitter, refresh_timeout=refresh_timeout,
+            resource=resource, cost=cost, priority=priority
+        )
+        self.families.append(family)
+        return family
+
+    def _get_material(self, key):
+        '''
+        The material for `key`, resolving (and marking as requested) members of
+        families. Raises ValueError for unknown keys.
+        '''
+        material = self.materials.get(key)
+        if material is not None:
+            return material
+
+        for family in self.families:
+            params = family.match(key)
+            if params is None:
+                continue
+
+            material, created = family.request(key, params)
+            if created:
+                self._add_member(family, key, params)
+            if family.should_record(material, material.requested_at):
+                self.storage.record_request(family.pattern, key, family.active_for)
+            return material
+
+        raise ValueError('Key %s not found in materials. Maybe you forgot to call "add_material" for this key?' % key)
+
+    def _material_name(self, key):
+        material = self.materials.get(key)
+        if material is not None:
+            return material.name
+
+        for family in self.families:
+            if family.match(key) is not None:
+                return family.pattern
+
+        return key
+
+    def _find_material(self, key):
+        material = self.materials.get(key)
+        if material is not None:
+            return material
+
+        for family in self.families:
+            material = family.members.get(key)
+            if material is not None:
+                return material
+
+        return None
+
+    def _add_member(self, family, key, params):
+        self.scheduler.schedule(key, time())
+        if family.tags:
+            self.storage.use_tags(key, family.tags_for(params))
+
+    def _active_members(self):
+        self._prune_families()
+
+        members = []
+        for family in self.families:
+            members.extend(family.active_members())
+        return members
+
+    def _prune_families(self):
+        for family in self.families:
+            self._sync_family(family)
 
-    def add_material(self, key, get_method, expiration=10, grace_period=0, lock_timeout=None):
-        self.materials[key] = Material(key, get_method, expiration, grace_period, lock_timeout)
+            for key in family.prune():
+                self.scheduler.remove(key)
+                if family.tags:
+                    self.storage.use_tags(key, ())
+
+    def _sync_family(self, family):
+        '''
+        Adds the members requested in other processes since the last sync.
+        '''
+        now = time()
+        # a little overlap, so requests recorded by slightly late clocks are not missed
+        since = now - family.active_for if family.synced_at is None else family.synced_at - 1
+        family.synced_at = now
+
+        for key, requested_at in self.storage.requested_since(family.pattern, since):
+            params = family.match(key)
+            if params is None:
+                continue
+
+            material, created = family.request(key, params, requested_at)
+            if created:
+                self._add_member(family, key, params)
 
     def expire(self, key):
-        if not key in self.materials:
-            raise ValueError('Key %s not found in materials. Maybe you forgot to call "add_material" for this key?' % key)
+        '''
+        Expires the value of `key` and wakes `run_forever` up to refresh it,
+        in this process only.
+        '''
+        self._get_material(key)
 
         self.storage.expire(key)
+        self.scheduler.wake(key)
+
+    def expire_tag(self, tag):
+        '''
+        Expires every material tagged with `tag` at once, returning their keys.
+        '''
+        keys = self.storage.expire_tag(tag)
+
+        for key in keys:
+            if self._find_material(key) is not None:
+                self.scheduler.wake(key)
+
+        return keys
 
     def is_expired(self, key):
-        if not key in self.materials:
-            raise ValueError('Key %s not found in materials. Maybe you forgot to call "add_material" for this key?' % key)
+        self._get_material(key)
 
         return self.storage.is_expired(key)
 
+    def get_version(self, key):
+        '''
+        The version of the stored value for `key`, which only grows when the value
+        actually changes (None if the storage does not keep versions).
+        '''
+        self._get_material(key)
+
+        return self.storage.get_version(key)
+
+    def stats(self):
+        '''
+        A snapshot of every material (how long its get method last took, when
+        it expires and whether it is due), plus whatever the metrics keep.
+        '''
+        now = time()
+
+        members = []
+        for family in self.families:
+            members.extend(family.active_members())
+
+        materials = {}
+        for key, material in list(self.materials.items()) + members:
+            materials[key] = {
+                'last_duration': material.last_duration,
+                'expires_in': material.expiration_date - now,
+                'is_due': material.is_due(),
+            }
+
+        return {'materials': materials, 'metrics': self.metrics.snapshot()}
+
     def run(self):
-        for key, material in self.materials.items():
-            logging.info('Acquiring lock for %s...' % key)
-            lock = self.storage.acquire_lock(key, timeout=material.lock_timeout)
+        return self._run_materials(list(self.materials.items()) + self._active_members())
+
+    def run_due(self):
+        '''
+        Refreshes only the materials whose scheduled due time has passed.
+        '''
+        self._prune_families()
+        keys = self.scheduler.pop_due()
+
+        materials = [(key, self._find_material(key)) for key in keys]
+        materials = [(key, material) for key, material in materials if material is not None]
+
+        try:
+            return self._run_materials(materials)
+        finally:
+            # popped keys are only scheduled again once refreshed, so keep those a storage error cut short
+            for key, material in materials:
+                if key not in self.scheduler:
+                    self.scheduler.schedule(key, self._retry_time(material))
+
+    def run_forever(self, max_sleep=None):
+        '''
+        Keeps refreshing materials as they become due, sleeping until the next
+        one is due (or `max_sleep` seconds) in between, until `stop` is called.
+        '''
+        self._stopped.clear()
+
+        # heartbeats must keep going even when nothing is due
+        if self.partitioner is not None:
+            max_sleep = min(max_sleep or self.partitioner.heartbeat_interval, self.partitioner.heartbeat_interval)
+
+        while not self._stopped.is_set():
+            try:
+                self.run_due()
+            except Exception:
+                logging.exception('Failed to run due materials.')
+
+            if not self._stopped.is_set():
+                self.scheduler.wait(max_sleep)
+
+    def stop(self):
+        self._stopped.set()
+        self.scheduler.notify()
+
+    def _run_materials(self, materials):
+        results = {}
+        materials = dict(materials)
+
+        if self.partitioner is not None:
+            self.partitioner.heartbeat()
+
+        # materials only run after the ones they depend on, and independent ones run together
+        for level in self._levels(list(materials)):
+            level = [(key, materials[key] if key in materials else self.materials[key]) for key in level]
+            level = self._owned(level)
+
+            # when resources run out, the materials submitted first get them first
+            level.sort(key=lambda item: -item[1].priority)
+
+            if self.workers > 1:
+                futures = [self.executor.submit(self._refresh, key, material) for key, material in level]
+                level_results = [future.result() for future in futures]
+            else:
+                level_results = [self._refresh(key, material) for key, material in level]
+
+            for (key, material), result in zip(level, level_results):
+                self.scheduler.schedule(key, self._next_due_time(material, result))
+                results[key] = result
+
+        return results
+
+    def _owned(self, materials):
+        if self.partitioner is None:
+            return materials
+
+        owned = []
+        for key, material in materials:
+            if self.partitioner.owns(key):
+                owned.append((key, material))
+            else:
+                # check again soon, in case its owner leaves
+                self.scheduler.schedule(key, time() + min(material.expiration, self.partitioner.heartbeat_interval))
+
+        return owned
+
+    def _levels(self, keys):
+        '''
+        Groups `keys`, plus every material depending on them, by their depth in
+        the dependency graph.
+        '''
+        selected = OrderedDict()
+        pending = deque(keys)
+        while pending:
+            key = pending.popleft()
+            if key not in selected:
+                selected[key] = True
+                pending.extend(self.dependents.get(key, ()))
+
+        depths = {}
+        levels = []
+        for key in selected:
+            depth = self._depth(key, depths, [])
+            while len(levels) <= depth:
+                levels.append([])
+            levels[depth].append(key)
+
+        return [level for level in levels if level]
+
+    def _depth(self, key, depths, path):
+        if key in depths:
+            return depths[key]
+
+        if key in path:
+            raise ValueError('Materials %s depend on each other.' % ' -> '.join(path[path.index(key):] + [key]))
+
+        material = self.materials.get(key)
+
+        depth = 0
+        for dependency in (material.dependencies if material is not None else ()):
+            if not dependency in self.materials:
+                raise ValueError(
+                    'Material %s depends on %s, which was not found in materials. '
+                    'Maybe you forgot to call "add_material" for it?' % (key, dependency)
+                )
+            depth = max(depth, self._depth(dependency, depths, path + [key]) + 1)
+
+        depths[key] = depth
+        return depth
+
+    def _next_due_time(self, material, result):
+        if result.status == FAILED:
+            material.failures += 1
+            return self._retry_time(material)
+
+        material.failures = 0
+        if result.status == REFRESHED:
+            return material.expiration_date - material.early_refresh_offset()
+
+        # up-to-date or locked: check it again in one expiration
+        return time() + material.expiration
+
+    def _retry_time(self, material):
+        return time() + min(material.expiration, RETRY_DELAY * 2 ** max(material.failures - 1, 0))
+
+    def _refresh(self, key, material):
+        try:
+            return self._refresh_material(key, material)
+        except Exception:
+            # storage errors while checking or locking it
+            logging.exception('Failed to refresh %s.', key)
+            return self._result(material, FAILED, error=sys.exc_info()[1])
+
+    def _refresh_material(self, key, material):
+        early = material.early_refresh_offset()
+        input_versions = self._input_versions(material)
+
+        if not material.is_due(early) and not self._inputs_changed(material, input_versions):
+            # the storage decides whether the material is due and locks it in a single operation
+            logging.info('Acquiring lock for %s if expired...', key)
+            lock = self.storage.acquire_lock_if_expired(key, material.expiration + early, timeout=self._lock_timeout(material))
 
             if lock is None:
-                logging.info('%s is locked, skipping.' % key)
-                continue
+                logging.info('%s is up-to-date or locked, skipping.', key)
+                return self._result(material, SKIPPED)
+        else:
+            logging.info('Acquiring lock for %s...', key)
+            lock = self.storage.acquire_lock(key, timeout=self._lock_timeout(material))
+
+            if lock is None:
+                logging.info('%s is locked, skipping.', key)
+                self.metrics.increment('lock.contended', material=material.name)
+                return self._result(material, LOCKED)
+
+        lease = self._lease(material, lock)
+        start = time()
+
+        try:
+            logging.info('Retrieving %s...', key)
+            value = self._load_before_deadline(material)
+            logging.info('Storing %s...', key)
+            self._store(material, value, lease)
+            material.input_versions = input_versions
+        except Exception:
+            logging.exception('Failed to refresh %s.', key)
+            return self._result(material, FAILED, error=sys.exc_info()[1], duration=time() - start)
+        finally:
+            logging.info('Releasing lock for %s...', key)
+            self._release(lease)
+
+        logging.info('Done with %s.', key)
+        return self._result(material, REFRESHED, duration=time() - start)
+
+    def _result(self, material, status, error=None, duration=None):
+        self.metrics.increment('refresh', material=material.name, status=status)
+        return RefreshResult(material.key, status, error=error, duration=duration)
+
+    def _input_versions(self, material):
+        if not material.dependencies:
+            return None
+
+        return dict((key, self.storage.get_version(key)) for key in material.dependencies)
+
+    def _inputs_changed(self, material, input_versions):
+        if input_versions is None:
+            return False
+
+        # without versions there is no telling whether inputs changed
+        if None in input_versions.values():
+            return True
+
+        return input_versions != material.input_versions
+
+    def _inputs(self, material):
+        if not material.dependencies:
+            return []
+
+        values = self.storage.retrieve_many(material.dependencies)
+
+        inputs = []
+        for key in material.dependencies:
+            value = values.get(key)
+            if value is None and self.load_on_cachemiss:
+                value = self.get(key)
+            if value is None:
+                raise ValueError('Material %s depends on %s, which has no value.' % (material.key, key))
+            inputs.append(value)
+
+        return inputs
 
-            if self.storage.is_expired(key, material.expiration) or material.is_expired:
-                logging.info('Retrieving %s...' % key)
-                self.storage.store(key, material.get(), expiration=material.expiration, grace_period=material.grace_period)
-                logging.info('Storing %s...' % key)
-                material.expiration_date = time() + material.expiration
+    def _load(self, material, started=None):
+        inputs = self._inputs(material)
+        permit = self._acquire_resource(material)
+        if started is not None:
+            started.set()
 
-            logging.info('Releasing lock for %s...' % key)
-            self.storage.release_lock(lock)
+        try:
+            # incremental materials are merged with their previous value, which lives in this process
+            if not self.use_processes or isinstance(material, IncrementalMaterial):
+                value = material.get(*inputs)
+            else:
+                start = time()
+                value = self.process_pool.submit(material.get_method, *inputs).result()
+                material.last_duration = time() - start
+                material.keep(value)
+        finally:
+            self._release_resource(material, permit)
 
-            logging.info('Done with %s.' % key)
+        self.metrics.timing('get_method.duration', material.last_duration, material=material.name)
+        return value
+
+    def _compute(self, material):
+        inputs = self._inputs(material)
+        permit = self._acquire_resource(material)
+
+        try:
+            value = material.get(*inputs)
+        finally:
+            self._release_resource(material, permit)
+
+        self.metrics.timing('get_method.duration', material.last_duration, material=material.name)
+        return value
+
+    def _acquire_resource(self, material):
+        limiter = self.limiters.get(material.resource)
+        if limiter is None:
+            return None
+
+        start = time()
+        permit = limiter.acquire(material.cost, material.priority, material.expiration_date)
+        self.metrics.timing('resource.wait', time() - start, resource=material.resource)
+        return permit
+
+    def _release_resource(self, material, permit):
+        if permit is not None:
+            self.limiters[material.resource].release(permit)
+
+    def _load_before_deadline(self, material):
+        if material.refresh_timeout is None:
+            return self._load(material)
+
+        abandoned = self._abandoned.get(material.key)
+        if abandoned is not None:
+            if not abandoned.done.is_set():
+                # another thread each pass would pile up behind a get method that hangs
+                raise RefreshTimeout('The abandoned refresh of %s is still running, so it was not started again.' % (
+                    material.key
+                ))
+            self._abandoned.pop(material.key, None)
+
+        flight = Flight()
+        started = threading.Event()
+
+        def load():
+            try:
+                flight.value = self._load(material, started)
+            except Exception:
+                flight.error = sys.exc_info()[1]
+            finally:
+                started.set()
+                flight.done.set()
+
+        # threads can't be killed, so an overrunning get method is left behind to finish on its own
+        thread = threading.Thread(target=load, name='materialgirl-refresh-%s' % material.key)
+        thread.daemon = True
+        thread.start()
+
+        # the deadline is for the get method: fetching inputs and waiting for its resource don't count
+        started.wait()
+        if not flight.done.wait(material.refresh_timeout):
+            self._abandoned[material.key] = flight
+            self.metrics.increment('refresh.timeout', material=material.name)
+            raise RefreshTimeout('Refreshing %s took longer than %s seconds, so it was abandoned.' % (
+                material.key, material.refresh_timeout
+            ))
+
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    def _lock_timeout(self, material):
+        if self.lock_lease is None:
+            return material.lock_timeout
+        return material.lock_timeout or self.lock_lease
+
+    def _lease(self, material, lock):
+        fence = self.storage.fence(material.key) if self.fencing else None
+        lease = Lease(self.storage, material.key, lock, self._lock_timeout(material), fence)
+
+        if self.lock_lease is not None:
+            lease.start()
+
+        return lease
+
+    def _release(self, lease):
+        lease.stop()
+        self.storage.release_lock(lease.lock)
+
+    def _store(self, material, value, lease=None):
+        expiration, grace_period = material.stored_expiration()
+
+        try:
+            if lease is not None and lease.lost:
+                raise StaleLockError('Lost the lock for %s while refreshing it.' % material.key)
+
+            if lease is None or lease.fence is None:
+                self.storage.store(material.key, value, expiration=expiration, grace_period=grace_period)
+            else:
+                self.storage.store(material.key, value, expiration=expiration, grace_period=grace_period, fence=lease.fence)
+        except StaleLockError:
+            self.metrics.increment('lock.lost', material=material.name)
+            raise
+
+        material.expiration_date = time() + expiration
+        self._reschedule(material)
+
+    def _reschedule(self, material):
+        # values stored outside of run (by get, get_many or revalidation) are not due until they expire either;
+        # keys not scheduled are being refreshed by run, or were forgotten
+        if material.key in self.scheduler:
+            self.scheduler.schedule(material.key, material.expiration_date - material.early_refresh_offset())
 
     def get(self, key):
-        if not key in self.materials:
-            raise ValueError('Key %s not found in materials. Maybe you forgot to call "add_material" for this key?' % key)
+        material = self._get_material(key)
+
+        if self.stale_while_revalidate:
+            value, is_expired = self.storage.retrieve_with_expiration(key, material.expiration + self.refresh_ahead)
+            if value is not None and is_expired:
+                self.metrics.increment('get.stale', material=material.name)
+                self._revalidate(material)
+            elif value is not None:
+                self.metrics.increment('get.hit', material=material.name)
+        else:
+            value = self.storage.retrieve(key)
+            if value is not None:
+                self.metrics.increment('get.hit', material=material.name)
 
-        value = self.storage.retrieve(key)
+        if value is None:
+            self.metrics.increment('get.miss', material=material.name)
 
         if value is None and self.load_on_cachemiss:
-            material = self.materials[key]
-            value = material.get()
-            self.storage.store(key, value, expiration=material.expiration, grace_period=material.grace_period)
+            value = self._load_on_cachemiss(material)
+
+        return value
+
+    def iter_get(self, key):
+        '''
+        Like `get`, but streams the records of list materials (or the chunks of
+        bytes materials) as they are read from storages that support it.
+        '''
+        self._get_material(key)
+
+        records = self.storage.iter_retrieve(key)
+        if records is not None:
+            return records
+
+        value = self.get(key)
+        if value is None:
+            return iter([])
+
+        return iter_records(value)
+
+    def _revalidate(self, material):
+        with self._revalidating_lock:
+            if material.key in self._revalidating:
+                return
+            self._revalidating.add(material.key)
+
+        self.executor.submit(self._refresh_in_background, material)
+
+    def _refresh_in_background(self, material):
+        try:
+            lock = self.storage.acquire_lock_if_expired(
+                material.key, material.expiration + self.refresh_ahead, timeout=self._lock_timeout(material)
+            )
+            if lock is None:
+                return
+
+            lease = self._lease(material, lock)
+            try:
+                logging.info('Refreshing %s in background...', material.key)
+                self._load_and_store(material, lease)
+            finally:
+                self._release(lease)
+        except Exception:
+            logging.exception('Failed to refresh %s in background.', material.key)
+        finally:
+            with self._revalidating_lock:
+                self._revalidating.discard(material.key)
+
+    def _load_on_cachemiss(self, material):
+        with self._flights_lock:
+            flight = self._flights.get(material.key)
+            is_leader = flight is None
+            if is_leader:
+                flight = self._flights[material.key] = Flight()
+
+        if not is_leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = self._load_missing(material)
+        except Exception:
+            flight.error = sys.exc_info()[1]
+            raise
+        finally:
+            with self._flights_lock:
+                del self._flights[material.key]
+            flight.done.set()
+
+        return flight.value
+
+    def _load_missing(self, material):
+        lock = self.storage.acquire_lock(material.key, timeout=self._lock_timeout(material))
+
+        if lock is None:
+            self.metrics.increment('lock.contended', material=material.name)
+
+            # someone else (probably another process) is loading it, so wait for their value
+            value = self._wait_for_value(material.key)
+            if value is not None:
+                return value
+
+            logging.info('Gave up waiting for %s, loading it.', material.key)
+            return self._load_and_store(material)
+
+        lease = self._lease(material, lock)
+        try:
+            value = self.storage.retrieve(material.key)
+            if value is None:
+                value = self._load_and_store(material, lease)
+        finally:
+            self._release(lease)
 
         return value
+
+    def _wait_for_value(self, key):
+        deadline = time() + self.cachemiss_wait
+
+        while time() < deadline:
+            sleep(self.cachemiss_poll_interval)
+
+            value = self.storage.retrieve(key)
+            if value is not None:
+                return value
+
+        return None
+
+    def _load_and_store(self, material, lease=None):
+        value = self._compute(material)
+        self._store(material, value, lease)
+        return value
+
+    def get_many(self, keys):
+        materials = dict((key, self._get_material(key)) for key in keys)
+
+        values = self.storage.retrieve_many(keys)
+
+        for key in keys:
+            self.metrics.increment('get.miss' if values.get(key) is None else 'get.hit', material=materials[key].name)
+
+        if not self.load_on_cachemiss:
+            return values
+
+        misses = [materials[key] for key in keys if values.get(key) is None]
+        if not misses:
+            return values
+
+        if self.workers > 1 and len(misses) > 1:
+            loaded = list(self.executor.map(self._compute, misses))
+        else:
+            loaded = [self._compute(material) for material in misses]
+
+        items = []
+        for material, value in zip(misses, loaded):
+            expiration, grace_period = material.stored_expiration()
+            items.append((material.key, value, expiration, grace_period))
+            material.expiration_date = time() + expiration
+            values[material.key] = value
+
+        self.storage.store_many(items)
+
+        for material in misses:
+            self._reschedule(material)
+
+        return values
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+from collections import deque
+from time import time
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+
+# histograms of bytes, from 64 bytes to 64 MB
+SIZE_BUCKETS = tuple(64 * 4 ** power for power in range(11)) + (float('inf'),)
+
+
+class Metrics(object):
+    '''
+    Receives what materializers and storages measure. Does nothing; subclass
+    it to send measurements somewhere. Tags are given as keyword arguments.
+    '''
+
+    def increment(self, name, value=1, **tags):
+        pass
+
+    def timing(self, name, seconds, **tags):
+        pass
+
+    def histogram(self, name, value, **tags):
+        pass
+
+    def snapshot(self):
+        return {}
+
+
+class Summary(object):
+    __slots__ = ('count', 'total', 'max', 'samples')
+
+    def __init__(self, samples=1000):
+        self.count = 0
+        self.total = 0
+        self.max = None
+        self.samples = deque(maxlen=samples)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = value if self.max is None else max(self.max, value)
+        self.samples.append(value)
+
+    def percentile(self, percent):
+        if not self.samples:
+            return None
+
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100.0))]
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.total / float(self.count) if self.count else None,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+        }
+
+
+class InMemoryMetrics(Metrics):
+    '''
+    Keeps counters and summaries (count, mean, max and percentiles of the last
+    `samples` values) of everything measured, by name and tags.
+    '''
+
+    def __init__(self, samples=1000):
+        self.samples = samples
+        self.counters = {}
+        self.summaries = {}
+
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1, **tags):
+        metric = self._metric(name, tags)
+        with self._lock:
+            self.counters[metric] = self.counters.get(metric, 0) + value
+
+    def timing(self, name, seconds, **tags):
+        self.histogram(name, seconds, **tags)
+
+    def histogram(self, name, value, **tags):
+        metric = self._metric(name, tags)
+        with self._lock:
+            summary = self.summaries.get(metric)
+            if summary is None:
+                summary = self.summaries[metric] = Summary(self.samples)
+            summary.add(value)
+
+    def counter(self, name, **tags):
+        return self.counters.get(self._metric(name, tags), 0)
+
+    def summary(self, name, **tags):
+        return self.summaries.get(self._metric(name, tags))
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': dict((self._format(metric), value) for metric, value in self.counters.items()),
+                'summaries': dict((self._format(metric), summary.to_dict()) for metric, summary in self.summaries.items()),
+            }
+
+    def _metric(self, name, tags):
+        return name, tuple(sorted(tags.items()))
+
+    def _format(self, metric):
+        name, tags = metric
+        if not tags:
+            return name
+        return '%s[%s]' % (name, ','.join('%s=%s' % tag for tag in tags))
+
+
+class StatsdMetrics(Metrics):
+    '''
+    Sends measurements to a statsd client (anything with the `incr`, `timing`
+    and `gauge` methods of statsd.StatsClient). Tags are appended to the names.
+    '''
+
+    def __init__(self, client, prefix='materialgirl'):
+        self.client = client
+        self.prefix = prefix
+
+    def increment(self, name, value=1, **tags):
+        self.client.incr(self._name(name, tags), value)
+
+    def timing(self, name, seconds, **tags):
+        self.client.timing(self._name(name, tags), seconds * 1000)
+
+    def histogram(self, name, value, **tags):
+        self.client.gauge(self._name(name, tags), value)
+
+    def _name(self, name, tags):
+        parts = [self.prefix, name] + [str(tags[tag]).replace('.', '_') for tag in sorted(tags)]
+        return '.'.join(part for part in parts if part)
+
+
+class PrometheusMetrics(Metrics):
+    '''
+    Exposes measurements as prometheus_client counters and histograms in
+    `registry` (the default one unless given), with tags as labels.
+    Histograms use the `buckets` given for their name (byte sizes for
+    `value.size`), or prometheus_client's default ones, made for seconds.
+    '''
+
+    def __init__(self, registry=None, prefix='materialgirl', buckets=None):
+        if prometheus_client is None:
+            raise ImportError('PrometheusMetrics requires prometheus_client. Please install it with "pip install prometheus_client".')
+
+        self.registry = registry or prometheus_client.REGISTRY
+        self.prefix = prefix
+        self.buckets = {'value.size': SIZE_BUCKETS}
+        self.buckets.update(buckets or {})
+        self.metrics = {}
+
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1, **tags):
+        self._get(prometheus_client.Counter, name, tags).inc(value)
+
+    def timing(self, name, seconds, **tags):
+        self._get(prometheus_client.Histogram, name + '.seconds', tags).observe(seconds)
+
+    def histogram(self, name, value, **tags):
+        self._get(prometheus_client.Histogram, name, tags).observe(value)
+
+    def _get(self, kind, name, tags):
+        options = {}
+        if name in self.buckets:
+            options['buckets'] = self.buckets[name]
+
+        name = '_'.join([self.prefix, name]).replace('.', '_')
+        labels = tuple(sorted(tags))
+
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = kind(name, name, labels, registry=self.registry, **options)
+
+        if not labels:
+            return metric
+        return metric.labels(**dict((label, str(tags[label])) for label in labels))
+
+
+class NamedMetrics(Metrics):
+    '''
+    Passes measurements on to `metrics`, with the keys in `material` tags
+    turned into material names by `name_for`, so storages measure family
+    members together too.
+    '''
+
+    def __init__(self, metrics, name_for):
+        self.metrics = metrics
+        self.name_for = name_for
+
+    def increment(self, name, value=1, **tags):
+        self.metrics.increment(name, value, **self._named(tags))
+
+    def timing(self, name, seconds, **tags):
+        self.metrics.timing(name, seconds, **self._named(tags))
+
+    def histogram(self, name, value, **tags):
+        self.metrics.histogram(name, value, **self._named(tags))
+
+    def snapshot(self):
+        return self.metrics.snapshot()
+
+    def _named(self, tags):
+        if 'material' in tags:
+            tags['material'] = self.name_for(tags['material'])
+        return tags
+
+
+class InstrumentedStorage(object):
+    '''
+    Wraps a storage timing every call to it (as `storage.latency`, tagged with
+    the `operation`). The wrapped storage also reports to `metrics` what it
+    measures itself, like the size of stored values, tagged with the name
+    `name_for` gives each key (the key itself, unless given).
+    '''
+
+    def __init__(self, storage, metrics, name_for=None):
+        self.storage = storage
+        self.metrics = metrics
+
+        storage.metrics = metrics if name_for is None else NamedMetrics(metrics, name_for)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.storage, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+
+        def timed(*args, **kwargs):
+            start = time()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                self.metrics.timing('storage.latency', time() - start, operation=name)
+
+        return timed
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import struct
+from hashlib import md5
+from time import time
+from uuid import uuid4
+
+
+def weight(worker_id, key):
+    digest = md5(('%s:%s' % (worker_id, key)).encode('utf-8')).digest()
+    return struct.unpack('>Q', digest[:8])[0]
+
+
+class Partitioner(object):
+    '''
+    Splits materials among the workers of a `group` using rendezvous hashing,
+    so each material is refreshed by a single worker and only the materials
+    of workers that join or leave change hands.
+
+    Workers register themselves in the storage with heartbeats; those not
+    heard from in `worker_timeout` seconds are considered dead.
+    '''
+
+    def __init__(self, storage, group='materialgirl-workers', worker_id=None, worker_timeout=15, heartbeat_interval=None):
+        self.storage = storage
+        self.group = group
+        self.worker_id = worker_id or uuid4().hex
+        self.worker_timeout = worker_timeout
+        self.heartbeat_interval = heartbeat_interval or worker_timeout / 3.0
+
+        self.workers = [self.worker_id]
+        self.last_heartbeat = None
+
+    def heartbeat(self, force=False):
+        '''
+        Tells other workers this one is alive (at most once per `heartbeat_interval`,
+        unless `force`) and refreshes the list of live workers.
+        '''
+        now = time()
+        if not force and self.last_heartbeat is not None and now - self.last_heartbeat < self.heartbeat_interval:
+            return
+
+        workers = sorted(self.storage.register_worker(self.group, self.worker_id, self.worker_timeout))
+        self.last_heartbeat = now
+
+        self.workers = workers
+
+    def leave(self):
+        self.storage.unregister_worker(self.group, self.worker_id)
+        self.last_heartbeat = None
+
+    def owner(self, key):
+        # a hash per live worker is cheap enough that caching owners (for every key ever seen) isn't worth it
+        return max(self.workers, key=lambda worker_id: weight(worker_id, key))
+
+    def owns(self, key):
+        return self.owner(key) == self.worker_id
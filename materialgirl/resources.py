@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import heapq
+import logging
+import threading
+from itertools import count
+from time import sleep
+from uuid import uuid4
+
+
+class ResourceLimiter(object):
+    '''
+    Lets get methods using `resource` (like a database) run only while the
+    cost of the ones running stays within `limit`. The excess waits, the
+    highest priority first and then the longest due. A cost bigger than
+    the limit counts as the whole limit, so it runs alone.
+
+    Given a `storage`, the budget is shared with every worker using that
+    storage: running get methods hold permits in it, renewed every third of
+    `permit_timeout` seconds, so they are freed that long after their worker
+    dies. Waiting for permits of other workers polls the storage every
+    `poll_interval` seconds.
+    '''
+
+    def __init__(self, resource, limit, storage=None, permit_timeout=300, poll_interval=0.05):
+        self.resource = resource
+        self.limit = limit
+        self.storage = storage
+        self.permit_timeout = permit_timeout
+        self.poll_interval = poll_interval
+
+        self.holder_id = uuid4().hex
+        self.used = 0
+        self.waiting = []
+        self.held = {}
+        self.condition = threading.Condition()
+
+        self._counter = count()
+        self._renewer = None
+
+    def acquire(self, cost=1, priority=0, due_time=0):
+        '''
+        Blocks until `cost` fits in the budget and returns a permit to release.
+        '''
+        cost = min(cost, self.limit)
+        ticket = (-priority, due_time, next(self._counter))
+        permit = (cost, '%s:%d' % (self.holder_id, ticket[2]))
+
+        with self.condition:
+            heapq.heappush(self.waiting, ticket)
+
+            try:
+                while not (self.waiting[0] == ticket and self.used + cost <= self.limit and self._acquire_shared(permit)):
+                    # only the first in line polls the storage, the others wait for their turn
+                    timeout = self.poll_interval if self.storage is not None and self.waiting[0] == ticket else None
+                    self.condition.wait(timeout)
+            finally:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                self.condition.notify_all()
+
+            self.used += cost
+            self._hold(permit)
+
+        return permit
+
+    def release(self, permit):
+        cost, holder = permit
+
+        with self.condition:
+            self.held.pop(holder, None)
+
+        if self.storage is not None:
+            self.storage.release_permit(self.resource, holder)
+
+        with self.condition:
+            self.used -= cost
+            self.condition.notify_all()
+
+    def _hold(self, permit):
+        cost, holder = permit
+        self.held[holder] = cost
+
+        # a single thread renews every permit held, while there are any
+        if self.storage is not None and self._renewer is None:
+            self._renewer = threading.Thread(target=self._renew, name='materialgirl-permits-%s' % self.resource)
+            self._renewer.daemon = True
+            self._renewer.start()
+
+    def _renew(self):
+        while True:
+            sleep(self.permit_timeout / 3.0)
+
+            with self.condition:
+                holders = list(self.held)
+                if not holders:
+                    self._renewer = None
+                    return
+
+            for holder in holders:
+                try:
+                    renewed = self.storage.renew_permit(self.resource, holder, self.permit_timeout)
+                except Exception:
+                    logging.exception('Failed to renew the permit %s for %s.', holder, self.resource)
+                    continue
+
+                if not renewed and holder in self.held:
+                    logging.warning('Lost the permit %s for %s.', holder, self.resource)
+
+    def _acquire_shared(self, permit):
+        if self.storage is None:
+            return True
+
+        cost, holder = permit
+        return self.storage.acquire_permit(self.resource, holder, cost, self.limit, self.permit_timeout)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import heapq
+import threading
+from itertools import count
+from time import time
+
+
+class Scheduler(object):
+    '''
+    Keeps material keys in a heap ordered by the time they are due.
+
+    Rescheduling a key just pushes a new entry; entries that no longer
+    match the key's current due time are dropped when they reach the top.
+    '''
+
+    def __init__(self):
+        self.heap = []
+        self.due_times = {}
+        self.condition = threading.Condition()
+
+        self._counter = count()
+
+    def __len__(self):
+        return len(self.due_times)
+
+    def __contains__(self, key):
+        return key in self.due_times
+
+    def schedule(self, key, due_time):
+        with self.condition:
+            self.due_times[key] = due_time
+            heapq.heappush(self.heap, (due_time, next(self._counter), key))
+            self.condition.notify_all()
+
+    def wake(self, key):
+        self.schedule(key, time())
+
+    def remove(self, key):
+        with self.condition:
+            self.due_times.pop(key, None)
+
+    def next_due_time(self):
+        with self.condition:
+            self._drop_stale_entries()
+            if not self.heap:
+                return None
+            return self.heap[0][0]
+
+    def pop_due(self, now=None):
+        if now is None:
+            now = time()
+
+        keys = []
+        with self.condition:
+            self._drop_stale_entries()
+            while self.heap and self.heap[0][0] <= now:
+                due_time, _, key = heapq.heappop(self.heap)
+                del self.due_times[key]
+                keys.append(key)
+                self._drop_stale_entries()
+
+        return keys
+
+    def wait(self, timeout=None):
+        '''
+        Sleeps until the next key is due, something gets (re)scheduled or
+        `timeout` seconds go by, whatever happens first.
+        '''
+        with self.condition:
+            next_due_time = self.next_due_time()
+
+            if next_due_time is not None:
+                delay = next_due_time - time()
+                if delay <= 0:
+                    return
+                timeout = delay if timeout is None else min(timeout, delay)
+
+            self.condition.wait(timeout)
+
+    def notify(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def _drop_stale_entries(self):
+        while self.heap:
+            due_time, _, key = self.heap[0]
+            if self.due_times.get(key) == due_time:
+                return
+            heapq.heappop(self.heap)
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import pickle
+import struct
+import zlib
+
+import msgpack
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# 0xc1 is never used by msgpack, so values that don't start with it were
+# written by older versions (plain msgpack, no header)
+MAGIC = b'\xc1'
+HEADER_SIZE = 2
+
+
+class Codec(object):
+    id = None
+
+    def encode(self, value):
+        raise NotImplementedError()
+
+    def decode(self, data):
+        raise NotImplementedError()
+
+
+class MsgPackCodec(Codec):
+    id = 1
+
+    def encode(self, value):
+        return msgpack.packb(value, encoding='utf-8')
+
+    def decode(self, data):
+        return msgpack.unpackb(data, encoding='utf-8')
+
+    def unpacker(self):
+        return msgpack.Unpacker(encoding='utf-8')
+
+
+class PickleCodec(Codec):
+    id = 2
+
+    def __init__(self, protocol=None):
+        if protocol is None:
+            protocol = min(5, pickle.HIGHEST_PROTOCOL)
+        self.protocol = protocol
+
+    def encode(self, value):
+        return pickle.dumps(value, protocol=self.protocol)
+
+    def decode(self, data):
+        return pickle.loads(data)
+
+
+class JsonCodec(Codec):
+    id = 3
+
+    def encode(self, value):
+        return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+    def decode(self, data):
+        return json.loads(bytes(data).decode('utf-8'))
+
+
+class NumpyCodec(Codec):
+    '''
+    Stores a numpy array as a small json header (dtype and shape) followed
+    by the raw array data. Arrays are rebuilt over the received buffer,
+    without copying it, so they are read-only.
+    '''
+
+    id = 4
+
+    def __init__(self):
+        if numpy is None:
+            raise ImportError('NumpyCodec requires numpy. Please install it with "pip install numpy".')
+
+    def encode(self, value):
+        value = numpy.ascontiguousarray(value)
+        header = json.dumps({'dtype': value.dtype.str, 'shape': value.shape})
+
+        # pads the header so the array data is 16 bytes aligned within the stored value
+        padding = -(HEADER_SIZE + 4 + len(header)) % 16
+        header = (header + ' ' * padding).encode('utf-8')
+
+        return struct.pack('>I', len(header)) + header + value.tobytes()
+
+    def decode(self, data):
+        header_size = struct.unpack('>I', data[:4])[0]
+        header = json.loads(bytes(data[4:4 + header_size]).decode('utf-8'))
+
+        array = numpy.frombuffer(data, dtype=header['dtype'], offset=4 + header_size)
+        return array.reshape(header['shape'])
+
+
+class BytesCodec(Codec):
+    '''
+    Stores bytes as they are. Values are retrieved as memoryviews over the
+    received buffer, without copying it.
+    '''
+
+    id = 5
+
+    def encode(self, value):
+        return bytes(value)
+
+    def decode(self, data):
+        return memoryview(data)
+
+
+class Compressor(object):
+    id = None
+
+    def compress(self, data):
+        raise NotImplementedError()
+
+    def decompress(self, data):
+        raise NotImplementedError()
+
+
+class ZlibCompressor(Compressor):
+    id = 1
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class Lz4Compressor(Compressor):
+    id = 2
+
+    def __init__(self):
+        if lz4 is None:
+            raise ImportError('Lz4Compressor requires lz4. Please install it with "pip install lz4".')
+
+    def compress(self, data):
+        return lz4.frame.compress(data)
+
+    def decompress(self, data):
+        return lz4.frame.decompress(data)
+
+
+class ZstdCompressor(Compressor):
+    id = 3
+
+    def __init__(self, level=3):
+        if zstandard is None:
+            raise ImportError('ZstdCompressor requires zstandard. Please install it with "pip install zstandard".')
+        self.level = level
+
+    def compress(self, data):
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def decompress(self, data):
+        return zstandard.ZstdDecompressor().decompress(data)
+
+
+CODECS = dict((codec.id, codec) for codec in (MsgPackCodec, PickleCodec, JsonCodec, NumpyCodec, BytesCodec))
+COMPRESSORS = dict((compressor.id, compressor) for compressor in (ZlibCompressor, Lz4Compressor, ZstdCompressor))
+
+
+class Serializer(object):
+    '''
+    Turns values into bytes using `codec`, compressing them with `compressor`
+    when they are at least `compress_threshold` bytes long.
+
+    Values are prefixed with a two bytes header (a magic byte plus the codec
+    and compressor ids). Without a codec, values are written as plain
+    msgpack, as older versions did.
+
+    Values are read with `codec`, msgpack or the codecs in `accept`; others
+    raise ValueError. Unpickling runs arbitrary code, so pickled values are
+    only read by serializers configured to (with a PickleCodec as `codec` or
+    in `accept`).
+    '''
+
+    def __init__(self, codec=None, compressor=None, compress_threshold=1024, accept=()):
+        self.codec = codec
+        self.compressor = compressor
+        self.compress_threshold = compress_threshold
+        self.accept = list(accept)
+
+        self._codecs = {}
+        self._compressors = {}
+
+    def dumps(self, value):
+        if self.codec is None:
+            return MsgPackCodec().encode(value)
+
+        data = self.codec.encode(value)
+
+        compressor_id = 0
+        if self.compressor is not None and len(data) >= self.compress_threshold:
+            data = self.compressor.compress(data)
+            compressor_id = self.compressor.id
+
+        return MAGIC + struct.pack('B', self.codec.id << 4 | compressor_id) + data
+
+    def loads(self, data):
+        codec, payload = self._split(data)
+        return codec.decode(payload)
+
+    def payload(self, data):
+        '''
+        The encoded value in `data`, without its header and decompressed if
+        needed. Unless it was compressed, no bytes are copied.
+        '''
+        return self._split(data)[1]
+
+    def parse_header(self, data):
+        '''
+        The codec and compressor (None if not compressed) `data` was written
+        with, and the offset where its payload starts.
+        '''
+        data = memoryview(data)
+
+        if data[:1] != MAGIC:
+            return self._get_codec(MsgPackCodec.id), None, 0
+
+        header = data[1]
+        if not isinstance(header, int):
+            header = struct.unpack('B', header)[0]
+
+        compressor = None
+        if header & 0x0f:
+            compressor = self._get_compressor(header & 0x0f)
+
+        return self._get_codec(header >> 4), compressor, HEADER_SIZE
+
+    def _split(self, data):
+        data = memoryview(data)
+        codec, compressor, offset = self.parse_header(data)
+
+        payload = data[offset:]
+        if compressor is not None:
+            payload = memoryview(compressor.decompress(payload))
+
+        return codec, payload
+
+    def _get_codec(self, codec_id):
+        if codec_id not in self._codecs:
+            for codec in [self.codec] + self.accept:
+                if codec is not None and codec.id == codec_id:
+                    self._codecs[codec_id] = codec
+                    break
+            else:
+                if codec_id != MsgPackCodec.id:
+                    raise ValueError('Value was written with %s, which this serializer does not read. Pass it in `accept` to read it.' % (
+                        CODECS[codec_id].__name__ if codec_id in CODECS else 'unknown codec %d' % codec_id
+                    ))
+                self._codecs[codec_id] = MsgPackCodec()
+        return self._codecs[codec_id]
+
+    def _get_compressor(self, compressor_id):
+        if compressor_id not in self._compressors:
+            if self.compressor is not None and self.compressor.id == compressor_id:
+                self._compressors[compressor_id] = self.compressor
+            else:
+                self._compressors[compressor_id] = COMPRESSORS[compressor_id]()
+        return self._compressors[compressor_id]
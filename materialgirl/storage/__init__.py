@@ -1,22 +1,148 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from materialgirl.metrics import Metrics
+
+
+def iter_records(value):
+    if isinstance(value, (list, tuple)):
+        return iter(value)
+    return iter([value])
+
+
+class StaleLockError(Exception):
+    '''
+    Raised when storing a value with a fencing token older than the last one
+    issued for its key (someone else took the lock since), or when a lock is
+    lost while being held.
+    '''
+
 
 class Storage(object):
-    def store(self, key, value, expiration=None, grace_period=None):
+    metrics = Metrics()
+
+    def store(self, key, value, expiration=None, grace_period=None, fence=None):
         raise NotImplementedError()
 
     def retrieve(self, key):
         raise NotImplementedError()
 
+    def retrieve_with_expiration(self, key, expiration=None):
+        return self.retrieve(key), self.is_expired(key, expiration)
+
+    def retrieve_with_freshness(self, key, expiration=None):
+        '''
+        The value for `key` and for how many more seconds it stays fresh: 0
+        once expired, None when the storage can't tell.
+        '''
+        value, is_expired = self.retrieve_with_expiration(key, expiration)
+        return value, 0 if is_expired else None
+
+    def iter_retrieve(self, key):
+        value = self.retrieve(key)
+        if value is None:
+            return None
+
+        return iter_records(value)
+
+    def use_serializer(self, key, serializer):
+        pass
+
+    def use_tags(self, key, tags):
+        pass
+
+    def store_many(self, items):
+        for key, value, expiration, grace_period in items:
+            self.store(key, value, expiration=expiration, grace_period=grace_period)
+
+    def retrieve_many(self, keys):
+        return dict((key, self.retrieve(key)) for key in keys)
+
+    def get_version(self, key):
+        return None
+
+    def register_worker(self, group, worker_id, timeout):
+        '''
+        Marks `worker_id` as alive for `timeout` seconds and returns the ids
+        of every live worker in `group`.
+        '''
+        raise NotImplementedError()
+
+    def unregister_worker(self, group, worker_id):
+        raise NotImplementedError()
+
+    def record_request(self, family, key, timeout):
+        '''
+        Records that the `family` member `key` was just requested, for
+        `requested_since` to return for `timeout` seconds. Storages that
+        don't record requests only see the members requested in-process.
+        '''
+        pass
+
+    def requested_since(self, family, since):
+        '''
+        The (key, requested at) pairs of the `family` members requested
+        since the timestamp `since`.
+        '''
+        return []
+
+    def acquire_permit(self, resource, holder, cost, limit, timeout):
+        '''
+        Lets `holder` use `cost` of `resource` for up to `timeout` seconds, if
+        the cost of every permit held stays within `limit`. Returns whether it did.
+        '''
+        raise NotImplementedError()
+
+    def renew_permit(self, resource, holder, timeout):
+        '''
+        Makes the permit of `holder` expire `timeout` seconds from now.
+        Returns False if it is no longer held.
+        '''
+        raise NotImplementedError()
+
+    def release_permit(self, resource, holder):
+        raise NotImplementedError()
+
     def release_lock(self, lock):
         raise NotImplementedError()
 
     def acquire_lock(self, key, timeout=None):
         raise NotImplementedError()
 
+    def renew_lock(self, lock, timeout):
+        '''
+        Makes `lock` expire `timeout` seconds from now. Returns False if it
+        is no longer held.
+        '''
+        raise NotImplementedError()
+
+    def fence(self, key):
+        '''
+        Issues a fencing token for `key`, greater than every one issued before.
+        Storing with an older token (`store(..., fence=token)`) raises a
+        StaleLockError. Storages without fencing return None.
+        '''
+        return None
+
+    def acquire_lock_if_expired(self, key, expiration=None, timeout=None):
+        lock = self.acquire_lock(key, timeout=timeout)
+        if lock is None:
+            return None
+
+        if not self.is_expired(key, expiration):
+            self.release_lock(lock)
+            return None
+
+        return lock
+
     def is_expired(self, key, expiration=None):
         raise NotImplementedError()
 
     def expire(self, key):
         raise NotImplementedError()
+
+    def expire_tag(self, tag):
+        '''
+        Expires every material tagged with `tag` and returns their keys.
+        '''
+        raise NotImplementedError()
@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+class AsyncStorage(object):
+    async def store(self, key, value, expiration=None, grace_period=None):
+        raise NotImplementedError()
+
+    async def retrieve(self, key):
+        raise NotImplementedError()
+
+    async def get_version(self, key):
+        return None
+
+    def use_serializer(self, key, serializer):
+        pass
+
+    async def release_lock(self, lock):
+        raise NotImplementedError()
+
+    async def acquire_lock(self, key, timeout=None):
+        raise NotImplementedError()
+
+    async def is_expired(self, key, expiration=None):
+        raise NotImplementedError()
+
+    async def expire(self, key):
+        raise NotImplementedError()
@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from materialgirl.storage.aio import AsyncStorage
+from materialgirl.storage.memory import InMemoryStorage
+
+
+class AsyncInMemoryStorage(AsyncStorage):
+    def __init__(self, storage=None):
+        self.storage = storage or InMemoryStorage()
+
+    async def store(self, key, value, expiration=None, grace_period=None):
+        return self.storage.store(key, value, expiration=expiration, grace_period=grace_period)
+
+    async def retrieve(self, key):
+        return self.storage.retrieve(key)
+
+    async def get_version(self, key):
+        return self.storage.get_version(key)
+
+    async def release_lock(self, lock):
+        return self.storage.release_lock(lock)
+
+    async def acquire_lock(self, key, timeout=None):
+        return self.storage.acquire_lock(key, timeout=timeout)
+
+    async def is_expired(self, key, expiration=None):
+        return self.storage.is_expired(key, expiration)
+
+    async def expire(self, key):
+        return self.storage.expire(key)
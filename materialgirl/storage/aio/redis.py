@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from hashlib import sha1
+from time import time
+
+from redis.exceptions import LockError
+
+try:
+    from redis.asyncio.cluster import RedisCluster
+except ImportError:
+    RedisCluster = None
+
+from materialgirl.serializers import Serializer, MsgPackCodec
+from materialgirl.storage.aio import AsyncStorage
+from materialgirl.storage.layout import KeyLayout, HashTaggedKeyLayout
+from materialgirl.storage.redis import expiration_ms, STORE_SCRIPT, IS_EXPIRED_SCRIPT, EXPIRE_SCRIPT, META_TTL_MS, MANIFEST
+
+
+class AsyncRedisStorage(AsyncStorage):
+    '''
+    Same layout as RedisStorage, on top of an asyncio redis client
+    (a redis.asyncio.Redis instance). Reads values RedisStorage split in
+    chunks, but always stores them whole.
+    '''
+
+    def __init__(self, redis, serializer=None, layout=None):
+        self.redis = redis
+        is_cluster = RedisCluster is not None and isinstance(redis, RedisCluster)
+        self.layout = layout or (HashTaggedKeyLayout() if is_cluster else KeyLayout())
+        self.serializer = serializer or Serializer()
+        self.serializers = {}
+
+        self.store_script = redis.register_script(STORE_SCRIPT)
+        self.is_expired_script = redis.register_script(IS_EXPIRED_SCRIPT)
+        self.expire_script = redis.register_script(EXPIRE_SCRIPT)
+
+    async def store(self, key, value, expiration=10, grace_period=0):
+        if value is None:
+            return False
+
+        time_ms = expiration_ms(expiration, grace_period)
+        data = self.serializer_for(key).dumps(value)
+
+        return bool(await self.store_script(
+            keys=[self.layout.value(key), self.layout.expired(key), self.layout.meta(key)],
+            args=[
+                data, sha1(data).hexdigest(), time_ms, int(time() * 1000), time_ms + META_TTL_MS, key,
+                '', int(expiration * 1000),
+            ]
+        ))
+
+    async def get_version(self, key):
+        version = await self.redis.hget(self.layout.meta(key), 'version')
+        return None if version is None else int(version)
+
+    def use_serializer(self, key, serializer):
+        self.serializers[key] = serializer
+
+    def serializer_for(self, key):
+        return self.serializers.get(key, self.serializer)
+
+    async def retrieve(self, key):
+        value, expired_value = await self.redis.mget([self.layout.value(key), self.layout.expired(key)])
+        if value is None:
+            value = expired_value
+
+        value = await self._resolve(key, value)
+        if value is None:
+            return None
+
+        return self.serializer_for(key).loads(value)
+
+    async def _resolve(self, key, value):
+        if value is None or value[:len(MANIFEST)] != MANIFEST:
+            return value
+
+        version, count = MsgPackCodec().decode(value[len(MANIFEST):])
+        chunks = await self.redis.mget([self.layout.chunk(key, version, index) for index in range(count)])
+        if None in chunks:
+            return None
+
+        return b''.join(chunks)
+
+    async def release_lock(self, lock):
+        # like release() in the sync storage: False if it had already expired
+        try:
+            await lock.release()
+        except LockError:
+            return False
+        return True
+
+    async def acquire_lock(self, key, timeout=None):
+        lock = self.redis.lock(self.layout.lock(key), timeout=timeout)
+        has_acquired = await lock.acquire(blocking=False)
+        if not has_acquired:
+            return None
+        return lock
+
+    async def is_expired(self, key, expiration=None):
+        return bool(await self.is_expired_script(
+            keys=[self.layout.value(key), self.layout.expired(key), self.layout.meta(key)],
+            args=['' if expiration is None else expiration]
+        ))
+
+    async def expire(self, key):
+        await self.expire_script(keys=[self.layout.value(key), self.layout.expired(key)])
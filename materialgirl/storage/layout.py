@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+class KeyLayout(object):
+    '''
+    Names of the redis keys kept for each material: its value, its expired
+    copy, its lock, its digest and version, and the chunks of big values;
+    plus the sets of materials with each tag and the permits of each resource.
+    '''
+
+    def value(self, key):
+        return key
+
+    def expired(self, key):
+        return '_expired_%s' % key
+
+    def lock(self, key):
+        return '%s-_LOCK_' % key
+
+    def meta(self, key):
+        return '%s-_META_' % key
+
+    def chunk(self, key, version, index):
+        return '%s-_CHUNK_-%s-%d' % (key, version, index)
+
+    def tag(self, tag):
+        return '_tag_%s' % tag
+
+    def permits(self, resource):
+        return '_permits_%s' % resource
+
+    def permit_costs(self, resource):
+        return '_permits_%s-_COST_' % resource
+
+    def requests(self, family):
+        return '_requests_%s' % family
+
+
+class HashTaggedKeyLayout(KeyLayout):
+    '''
+    Wraps material keys in a hash tag (`{key}`), so every key of a material
+    lives in the same Redis Cluster slot and scripts or renames touching
+    them work in a cluster.
+    '''
+
+    def value(self, key):
+        return '{%s}' % key
+
+    def expired(self, key):
+        return '_expired_{%s}' % key
+
+    def lock(self, key):
+        return '{%s}-_LOCK_' % key
+
+    def meta(self, key):
+        return '{%s}-_META_' % key
+
+    def chunk(self, key, version, index):
+        return '{%s}-_CHUNK_-%s-%d' % (key, version, index)
+
+    def tag(self, tag):
+        return '_tag_{%s}' % tag
+
+    def permits(self, resource):
+        return '_permits_{%s}' % resource
+
+    def permit_costs(self, resource):
+        return '_permits_{%s}-_COST_' % resource
@@ -1,33 +1,367 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from materialgirl.storage import Storage
+import sys
+import threading
+from collections import OrderedDict
+from time import time
+from uuid import uuid4
+
+from materialgirl.storage import Storage, StaleLockError
+
+
+def approximate_size(value):
+    size = sys.getsizeof(value)
+
+    if isinstance(value, dict):
+        size += sum(approximate_size(key) + approximate_size(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(approximate_size(item) for item in value)
+
+    return size
+
+
+class Entry(object):
+    __slots__ = ('expiration', 'fresh_until', 'expires_at', 'size', 'version')
+
+    def __init__(self, expiration=None, fresh_until=None, expires_at=None, size=0, version=None):
+        self.expiration = expiration
+        self.fresh_until = fresh_until
+        self.expires_at = expires_at
+        self.size = size
+        self.version = version
+
+    def is_alive(self, now):
+        return self.expires_at is None or now < self.expires_at
+
+    def is_fresh(self, now, expiration=None):
+        fresh_for = self.fresh_for(now, expiration)
+        return fresh_for is None or fresh_for > 0
+
+    def fresh_for(self, now, expiration=None):
+        if self.fresh_until is None:
+            return None
+
+        early = 0
+        if expiration is not None and self.expiration is not None:
+            early = max(0, expiration - self.expiration)
+
+        return self.fresh_until - early - now
 
 
 class InMemoryStorage(Storage):
-    def __init__(self):
-        self.items = {}
-        self.locks = []
+    '''
+    Keeps materials in-process. Values are fresh for `expiration` seconds and
+    can still be retrieved until `grace_period` (if longer) goes by.
+
+    When `max_entries` or `max_size` (in approximate bytes, as measured by
+    `size_of`) are given, the least recently used values are evicted to
+    respect them. All operations are thread-safe.
+
+    Storing a value equal to the one already stored only extends its
+    expiration and keeps its version.
+    '''
+
+    def __init__(self, max_entries=None, max_size=None, size_of=approximate_size):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.size_of = size_of
+
+        self.size = 0
+        self.entries = {}
+        self.locks = {}
+        self.fences = {}
+        self.permits = {}
+        self.workers = {}
+        self.requests = {}
+        self.tags = {}
+        self.tagged = {}
+
+        self._items = OrderedDict()
+        self._lock = threading.RLock()
+
+    @property
+    def items(self):
+        return self._items
+
+    @items.setter
+    def items(self, items):
+        with self._lock:
+            self._items = OrderedDict()
+            self.entries = {}
+            self.size = 0
+
+            for key, value in items.items():
+                self._set(key, value, Entry())
 
-    def store(self, key, value, expiration=None, grace_period=None):
-        self.items[key] = value
-        self.items.pop('_expired_%s' % key, None)
+    def store(self, key, value, expiration=None, grace_period=None, fence=None):
+        now = time()
+        entry = Entry()
+
+        if expiration is not None:
+            entry.expiration = expiration
+            entry.fresh_until = now + expiration
+            entry.expires_at = now + max(expiration, grace_period or 0)
+
+        with self._lock:
+            if fence is not None and fence < self.fences.get(key, 0):
+                raise StaleLockError('Fencing token %d for %s is stale, someone else took its lock.' % (fence, key))
+
+            current = self._current_entry(key, now)
+            changed = current is None or not self._equals(self._items[current], value)
+
+            # versions are stamped with the current time, so they keep growing even after eviction
+            previous = self.entries[current].version if current is not None else None
+            if changed or previous is None:
+                entry.version = max((previous or 0) + 1, int(now * 1000))
+            else:
+                entry.version = previous
+                value = self._items[current]
+
+            self._delete('_expired_%s' % key)
+            self._set(key, value, entry)
+            self._evict()
+
+            for tag in self.tags.get(key, ()):
+                self.tagged.setdefault(tag, set()).add(key)
+
+            return changed
+
+    def use_tags(self, key, tags):
+        with self._lock:
+            if tags:
+                self.tags[key] = tuple(tags)
+            else:
+                self.tags.pop(key, None)
 
     def retrieve(self, key):
-        return self.items.get(key, self.items.get('_expired_%s' % key, None))
+        with self._lock:
+            now = time()
 
-    def release_lock(self, key):
-        self.locks.remove(key)
+            for name in (key, '_expired_%s' % key):
+                if self._is_alive(name, now):
+                    value = self._items.pop(name)
+                    self._items[name] = value
+                    return value
 
-    def acquire_lock(self, key, timeout=None):
-        if key in self.locks:
             return None
-        self.locks.append(key)
-        return key
+
+    def retrieve_many(self, keys):
+        return {key: self.retrieve(key) for key in keys}
+
+    def get_version(self, key):
+        with self._lock:
+            current = self._current_entry(key, time())
+            return None if current is None else self.entries[current].version
+
+    def register_worker(self, group, worker_id, timeout):
+        with self._lock:
+            now = time()
+            workers = self.workers.setdefault(group, {})
+            workers[worker_id] = now + timeout
+
+            for name, expires_at in list(workers.items()):
+                if expires_at <= now:
+                    del workers[name]
+
+            return list(workers)
+
+    def unregister_worker(self, group, worker_id):
+        with self._lock:
+            self.workers.get(group, {}).pop(worker_id, None)
+
+    def record_request(self, family, key, timeout):
+        with self._lock:
+            now = time()
+            requests = self.requests.setdefault(family, {})
+            requests[key] = now
+
+            for name, requested_at in list(requests.items()):
+                if requested_at <= now - timeout:
+                    del requests[name]
+
+    def requested_since(self, family, since):
+        with self._lock:
+            return [
+                (key, requested_at) for key, requested_at in self.requests.get(family, {}).items()
+                if requested_at >= since
+            ]
+
+    def acquire_permit(self, resource, holder, cost, limit, timeout):
+        with self._lock:
+            now = time()
+            permits = self.permits.setdefault(resource, {})
+
+            for name, (_, expires_at) in list(permits.items()):
+                if expires_at <= now:
+                    del permits[name]
+
+            if sum(used for used, _ in permits.values()) + cost > limit:
+                return False
+
+            permits[holder] = (cost, now + timeout)
+            return True
+
+    def renew_permit(self, resource, holder, timeout):
+        with self._lock:
+            now = time()
+            permits = self.permits.get(resource, {})
+
+            if holder not in permits or permits[holder][1] <= now:
+                return False
+
+            permits[holder] = (permits[holder][0], now + timeout)
+            return True
+
+    def release_permit(self, resource, holder):
+        with self._lock:
+            self.permits.get(resource, {}).pop(holder, None)
+
+    def release_lock(self, lock):
+        key, token = lock
+
+        with self._lock:
+            if not self._holds(lock, time()):
+                return False
+
+            del self.locks[key]
+            return True
+
+    def acquire_lock(self, key, timeout=None):
+        with self._lock:
+            now = time()
+
+            if key in self.locks:
+                _, expires_at = self.locks[key]
+                if expires_at is None or now < expires_at:
+                    return None
+
+            # the token tells holders apart, so a stale one can't renew or release the lock of the next
+            token = uuid4().hex
+            self.locks[key] = (token, None if timeout is None else now + timeout)
+            return key, token
+
+    def renew_lock(self, lock, timeout):
+        key, token = lock
+
+        with self._lock:
+            now = time()
+
+            if not self._holds(lock, now):
+                return False
+
+            self.locks[key] = (token, now + timeout)
+            return True
+
+    def _holds(self, lock, now):
+        key, token = lock
+        holder, expires_at = self.locks.get(key, (None, None))
+        return holder == token and (expires_at is None or now < expires_at)
+
+    def fence(self, key):
+        with self._lock:
+            self.fences[key] = self.fences.get(key, 0) + 1
+            return self.fences[key]
 
     def is_expired(self, key, expiration=None):
-        return '_expired_%s' % key in self.items or key not in self.items
+        with self._lock:
+            now = time()
+
+            if self._is_alive('_expired_%s' % key, now) or not self._is_alive(key, now):
+                return True
+
+            return not self.entries[key].is_fresh(now, expiration)
+
+    def retrieve_with_freshness(self, key, expiration=None):
+        with self._lock:
+            now = time()
+            value = self.retrieve(key)
+
+            if self._is_alive('_expired_%s' % key, now) or not self._is_alive(key, now):
+                return value, 0
+
+            fresh_for = self.entries[key].fresh_for(now, expiration)
+            return value, None if fresh_for is None else max(0, fresh_for)
 
     def expire(self, key):
-        if not self.is_expired(key):
-            self.items['_expired_%s' % key] = self.items.pop(key)
+        with self._lock:
+            now = time()
+
+            if self._is_alive(key, now) and not self._is_alive('_expired_%s' % key, now):
+                entry = self.entries.pop(key)
+                self._items['_expired_%s' % key] = self._items.pop(key)
+                self.entries['_expired_%s' % key] = entry
+
+    def expire_tag(self, tag):
+        with self._lock:
+            now = time()
+            keys = []
+
+            for key in list(self.tagged.get(tag, ())):
+                if self._current_entry(key, now) is None:
+                    # gone for good, it is added back when stored again
+                    self.tagged[tag].discard(key)
+                    continue
+
+                self.expire(key)
+                keys.append(key)
+
+            return keys
+
+    def delete(self, key):
+        with self._lock:
+            self._delete(key)
+            self._delete('_expired_%s' % key)
+
+    def _current_entry(self, key, now):
+        for name in (key, '_expired_%s' % key):
+            if self._is_alive(name, now):
+                return name
+
+        return None
+
+    def _equals(self, current, value):
+        try:
+            return bool(current == value)
+        except (TypeError, ValueError):
+            # values without a plain equality, like numpy arrays
+            return False
+
+    def _is_alive(self, name, now):
+        if name not in self._items:
+            return False
+
+        entry = self.entries.get(name)
+        if entry is None:
+            entry = self.entries[name] = Entry()
+
+        if not entry.is_alive(now):
+            self._delete(name)
+            return False
+
+        return True
+
+    def _set(self, name, value, entry):
+        self._delete(name)
+
+        if self.max_size is not None:
+            entry.size = self.size_of(value)
+            self.size += entry.size
+
+        self._items[name] = value
+        self.entries[name] = entry
+
+    def _delete(self, name):
+        self._items.pop(name, None)
+
+        entry = self.entries.pop(name, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def _evict(self):
+        # the value just stored is the most recently used one, so it always survives
+        while len(self._items) > 1 and (
+            (self.max_entries is not None and len(self._items) > self.max_entries)
+            or (self.max_size is not None and self.size > self.max_size)
+        ):
+            self._delete(next(iter(self._items)))
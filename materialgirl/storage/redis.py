@@ -1,55 +1,727 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import msgpack
+from hashlib import sha1
+from time import time
+from uuid import uuid1, uuid4
 
-from materialgirl.storage import Storage
+from redis.exceptions import LockError
+
+try:
+    from redis.cluster import RedisCluster
+except ImportError:
+    RedisCluster = None
+
+from materialgirl.serializers import Serializer, MsgPackCodec, BytesCodec, MAGIC
+from materialgirl.storage import Storage, StaleLockError, iter_records
+from materialgirl.storage.layout import KeyLayout, HashTaggedKeyLayout
+
+
+# values split in chunks are stored as a manifest pointing to them (codec 0 is never used by serializers)
+MANIFEST = MAGIC + b'\x00'
+
+# chunks of replaced values are kept around this long, so readers of the previous manifest can finish
+REPLACED_CHUNKS_TTL_MS = 30000
+
+MSGPACK_ARRAY_MARKERS = set(range(0x90, 0xa0)) | set([0xdc, 0xdd])
+
+# digests and versions outlive the values they describe by this long
+META_TTL_MS = 24 * 60 * 60 * 1000
+
+
+# KEYS: key, expired key, meta key - ARGV: expiration (or empty string)
+# values are fresh for the expiration they were stored with; a longer expiration makes them due that much earlier
+EXPIRED_CHECK = '''
+local function is_expired()
+    if redis.call('exists', KEYS[2]) == 1 then
+        return true
+    end
+    local ttl = redis.call('pttl', KEYS[1])
+    if ttl == -2 then
+        return true
+    end
+    local stored = redis.call('hmget', KEYS[3], 'expiration', 'ttl')
+    if not stored[1] or not stored[2] then
+        -- stored without its expiration, so only the ttl is known
+        return ARGV[1] ~= '' and tonumber(ARGV[1]) * 1000 > ttl
+    end
+    local early = 0
+    if ARGV[1] ~= '' then
+        early = math.max(0, tonumber(ARGV[1]) * 1000 - tonumber(stored[1]))
+    end
+    return ttl - (tonumber(stored[2]) - tonumber(stored[1])) <= early
+end
+'''
+
+IS_EXPIRED_SCRIPT = EXPIRED_CHECK + '''
+if is_expired() then
+    return 1
+end
+return 0
+'''
+
+# KEYS: key, expired key, meta key - ARGV: expiration (or empty string)
+RETRIEVE_WITH_EXPIRATION_SCRIPT = EXPIRED_CHECK + '''
+local value = redis.call('get', KEYS[1])
+if not value then
+    value = redis.call('get', KEYS[2])
+end
+if is_expired() then
+    return {value, 1}
+end
+return {value, 0}
+'''
+
+# KEYS: key, expired key, meta key - ARGV: expiration (or empty string)
+RETRIEVE_WITH_FRESHNESS_SCRIPT = EXPIRED_CHECK + '''
+local value = redis.call('get', KEYS[1])
+if not value then
+    value = redis.call('get', KEYS[2])
+end
+if is_expired() then
+    return {value, 0}
+end
+local ttl = redis.call('pttl', KEYS[1])
+local stored = redis.call('hmget', KEYS[3], 'expiration', 'ttl')
+if ttl < 0 or not stored[1] or not stored[2] then
+    return {value, -1}
+end
+local early = 0
+if ARGV[1] ~= '' then
+    early = math.max(0, tonumber(ARGV[1]) * 1000 - tonumber(stored[1]))
+end
+return {value, ttl - (tonumber(stored[2]) - tonumber(stored[1])) - early}
+'''
+
+# KEYS: key, expired key, meta key, lock key - ARGV: expiration, lock token, lock timeout in ms (or empty string)
+ACQUIRE_LOCK_IF_EXPIRED_SCRIPT = EXPIRED_CHECK + '''
+if not is_expired() then
+    return 0
+end
+local acquired
+if ARGV[3] ~= '' then
+    acquired = redis.call('set', KEYS[4], ARGV[2], 'NX', 'PX', ARGV[3])
+else
+    acquired = redis.call('set', KEYS[4], ARGV[2], 'NX')
+end
+if acquired then
+    return 1
+end
+return 0
+'''
+
+# KEYS: key, expired key
+EXPIRE_SCRIPT = '''
+if redis.call('exists', KEYS[2]) == 0 and redis.call('exists', KEYS[1]) == 1 then
+    redis.call('rename', KEYS[1], KEYS[2])
+    return 1
+end
+return 0
+'''
+
+# KEYS: key, expired key, meta key, tag keys... - ARGV: value, digest, ttl in ms, current time in ms,
+# meta expiration in ms, material key, fencing token (or empty string), expiration in ms
+STORE_SCRIPT = '''
+if ARGV[7] and ARGV[7] ~= '' and tonumber(redis.call('hget', KEYS[3], 'fence') or 0) > tonumber(ARGV[7]) then
+    return -1
+end
+for index = 4, #KEYS do
+    redis.call('sadd', KEYS[index], ARGV[6])
+end
+if redis.call('hget', KEYS[3], 'digest') == ARGV[2] then
+    if redis.call('exists', KEYS[1]) == 0 and redis.call('exists', KEYS[2]) == 1 then
+        redis.call('rename', KEYS[2], KEYS[1])
+    end
+    if redis.call('pexpire', KEYS[1], ARGV[3]) == 1 then
+        redis.call('del', KEYS[2])
+        redis.call('hmset', KEYS[3], 'expiration', ARGV[8], 'ttl', ARGV[3])
+        redis.call('pexpire', KEYS[3], ARGV[5])
+        return 0
+    end
+end
+redis.call('psetex', KEYS[1], ARGV[3], ARGV[1])
+redis.call('del', KEYS[2])
+local version = math.max(tonumber(redis.call('hget', KEYS[3], 'version') or 0) + 1, tonumber(ARGV[4]))
+redis.call('hmset', KEYS[3], 'digest', ARGV[2], 'version', string.format('%d', version), 'expiration', ARGV[8], 'ttl', ARGV[3])
+redis.call('pexpire', KEYS[3], ARGV[5])
+return 1
+'''
+
+# KEYS: key, expired key, meta key, replaced chunk keys... - ARGV: manifest, digest, ttl in ms, current time in ms,
+# meta expiration in ms, fencing token (or empty string), expiration in ms, replaced chunks ttl in ms
+SWAP_MANIFEST_SCRIPT = '''
+if ARGV[6] ~= '' and tonumber(redis.call('hget', KEYS[3], 'fence') or 0) > tonumber(ARGV[6]) then
+    return -1
+end
+redis.call('psetex', KEYS[1], ARGV[3], ARGV[1])
+redis.call('del', KEYS[2])
+for index = 4, #KEYS do
+    redis.call('pexpire', KEYS[index], ARGV[8])
+end
+local version = math.max(tonumber(redis.call('hget', KEYS[3], 'version') or 0) + 1, tonumber(ARGV[4]))
+redis.call('hmset', KEYS[3], 'digest', ARGV[2], 'version', string.format('%d', version), 'expiration', ARGV[7], 'ttl', ARGV[3])
+redis.call('pexpire', KEYS[3], ARGV[5])
+return 1
+'''
+
+# KEYS: workers key - ARGV: worker id, timeout in ms
+REGISTER_WORKER_SCRIPT = '''
+redis.replicate_commands()
+local now = redis.call('time')
+local now_ms = now[1] * 1000 + math.floor(now[2] / 1000)
+redis.call('zadd', KEYS[1], now_ms, ARGV[1])
+redis.call('zremrangebyscore', KEYS[1], '-inf', now_ms - ARGV[2])
+redis.call('pexpire', KEYS[1], ARGV[2])
+return redis.call('zrange', KEYS[1], 0, -1)
+'''
+
+# KEYS: permits key, permit costs key - ARGV: holder, cost, limit, timeout in ms
+ACQUIRE_PERMIT_SCRIPT = '''
+redis.replicate_commands()
+local now = redis.call('time')
+local now_ms = now[1] * 1000 + math.floor(now[2] / 1000)
+for _, holder in ipairs(redis.call('zrangebyscore', KEYS[1], '-inf', now_ms)) do
+    redis.call('hdel', KEYS[2], holder)
+end
+redis.call('zremrangebyscore', KEYS[1], '-inf', now_ms)
+local used = 0
+for _, cost in ipairs(redis.call('hvals', KEYS[2])) do
+    used = used + tonumber(cost)
+end
+if used + tonumber(ARGV[2]) > tonumber(ARGV[3]) then
+    return 0
+end
+redis.call('zadd', KEYS[1], now_ms + ARGV[4], ARGV[1])
+redis.call('hset', KEYS[2], ARGV[1], ARGV[2])
+for index = 1, 2 do
+    if redis.call('pttl', KEYS[index]) < tonumber(ARGV[4]) then
+        redis.call('pexpire', KEYS[index], ARGV[4])
+    end
+end
+return 1
+'''
+
+# KEYS: permits key, permit costs key - ARGV: holder, timeout in ms
+RENEW_PERMIT_SCRIPT = '''
+redis.replicate_commands()
+local now = redis.call('time')
+local now_ms = now[1] * 1000 + math.floor(now[2] / 1000)
+local expires_at = redis.call('zscore', KEYS[1], ARGV[1])
+if not expires_at or tonumber(expires_at) <= now_ms then
+    return 0
+end
+redis.call('zadd', KEYS[1], now_ms + ARGV[2], ARGV[1])
+for index = 1, 2 do
+    if redis.call('pttl', KEYS[index]) < tonumber(ARGV[2]) then
+        redis.call('pexpire', KEYS[index], ARGV[2])
+    end
+end
+return 1
+'''
+
+# KEYS: tag key - ARGV: key name format, expired key name format
+EXPIRE_TAG_SCRIPT = '''
+local keys = {}
+for _, key in ipairs(redis.call('smembers', KEYS[1])) do
+    local name = string.format(ARGV[1], key)
+    local expired_name = string.format(ARGV[2], key)
+    if redis.call('exists', expired_name) == 1 then
+        table.insert(keys, key)
+    elseif redis.call('exists', name) == 1 then
+        redis.call('rename', name, expired_name)
+        table.insert(keys, key)
+    else
+        -- gone for good, it is added back when stored again
+        redis.call('srem', KEYS[1], key)
+    end
+end
+return keys
+'''
+
+# KEYS: meta key - ARGV: meta expiration in ms
+FENCE_SCRIPT = '''
+local fence = redis.call('hincrby', KEYS[1], 'fence', 1)
+if redis.call('pttl', KEYS[1]) < tonumber(ARGV[1]) then
+    redis.call('pexpire', KEYS[1], ARGV[1])
+end
+return fence
+'''
+
+
+def expiration_ms(expiration, grace_period):
+    if grace_period > expiration:
+        return int(grace_period * 1000)
+    return int(expiration * 1000)
+
+
+def release(lock):
+    '''
+    Releases a redis lock. Returns False if it had already expired (and may
+    have been taken by someone else since).
+    '''
+    try:
+        lock.release()
+    except LockError:
+        return False
+    return True
+
+
+def renew(lock, timeout):
+    try:
+        return bool(lock.extend(timeout, replace_ttl=True))
+    except LockError:
+        return False
+
+
+def stale_fence(key, fence):
+    return StaleLockError('Fencing token %d for %s is stale, someone else took its lock.' % (fence, key))
 
 
 class RedisStorage(Storage):
-    def __init__(self, redis):
+    '''
+    Stores materials in redis. Values bigger than `chunk_size` bytes are split
+    in chunks, written ahead of a manifest that replaces the previous value
+    at once, so readers always see whole versions.
+
+    Key names come from `layout`, a HashTaggedKeyLayout by default with a
+    Redis Cluster client (redis.cluster.RedisCluster), so the keys of each
+    material share a slot.
+    '''
+
+    def __init__(self, redis, serializer=None, chunk_size=None, chunks_per_read=8, layout=None):
         self.redis = redis
+        self.is_cluster = RedisCluster is not None and isinstance(redis, RedisCluster)
+        self.layout = layout or (HashTaggedKeyLayout() if self.is_cluster else KeyLayout())
+        self.serializer = serializer or Serializer()
+        self.serializers = {}
+        self.tags = {}
+        self.chunk_size = chunk_size
+        self.chunks_per_read = chunks_per_read
 
-    def store(self, key, value, expiration=10, grace_period=0):
-        if value is None:
-            return
+        self.is_expired_script = redis.register_script(IS_EXPIRED_SCRIPT)
+        self.retrieve_with_expiration_script = redis.register_script(RETRIEVE_WITH_EXPIRATION_SCRIPT)
+        self.retrieve_with_freshness_script = redis.register_script(RETRIEVE_WITH_FRESHNESS_SCRIPT)
+        self.acquire_lock_if_expired_script = redis.register_script(ACQUIRE_LOCK_IF_EXPIRED_SCRIPT)
+        self.expire_script = redis.register_script(EXPIRE_SCRIPT)
+        self.store_script = redis.register_script(STORE_SCRIPT)
+        self.swap_manifest_script = redis.register_script(SWAP_MANIFEST_SCRIPT)
+        self.register_worker_script = redis.register_script(REGISTER_WORKER_SCRIPT)
+        self.expire_tag_script = redis.register_script(EXPIRE_TAG_SCRIPT)
+        self.fence_script = redis.register_script(FENCE_SCRIPT)
+        self.acquire_permit_script = redis.register_script(ACQUIRE_PERMIT_SCRIPT)
+        self.renew_permit_script = redis.register_script(RENEW_PERMIT_SCRIPT)
+
+    def use_serializer(self, key, serializer):
+        self.serializers[key] = serializer
 
-        if grace_period > expiration:
-            time_ms = int(grace_period * 1000)
+    def serializer_for(self, key):
+        return self.serializers.get(key, self.serializer)
+
+    def use_tags(self, key, tags):
+        if tags:
+            self.tags[key] = tuple(tags)
         else:
-            time_ms = int(expiration * 1000)
+            self.tags.pop(key, None)
+
+    def store(self, key, value, expiration=10, grace_period=0, fence=None):
+        '''
+        Stores `value` unless it is byte for byte what is already stored, in
+        which case only its expiration is extended. Returns whether it changed.
+
+        Given a `fence` token older than the last one issued for `key`, raises
+        a StaleLockError instead.
+        '''
+        if value is None:
+            return False
+
+        time_ms = expiration_ms(expiration, grace_period)
+        fresh_ms = int(expiration * 1000)
+        data = self.serializer_for(key).dumps(value)
+
+        self.metrics.histogram('value.size', len(data), material=key)
+
+        if self._should_chunk(data):
+            return self._store_chunked(key, data, time_ms, fresh_ms, fence)
+
+        stored = self._store_script(key, data, time_ms, fresh_ms, fence=fence)
+        if stored == -1:
+            raise stale_fence(key, fence)
+
+        return bool(stored)
+
+    def store_many(self, items):
+        if self.is_cluster:
+            # values of different materials live in different slots
+            return super(RedisStorage, self).store_many(items)
+
+        pipe = self.redis.pipeline(transaction=True)
+        chunked = []
+
+        for key, value, expiration, grace_period in items:
+            if value is None:
+                continue
+
+            time_ms = expiration_ms(expiration, grace_period)
+            fresh_ms = int(expiration * 1000)
+            data = self.serializer_for(key).dumps(value)
+            self.metrics.histogram('value.size', len(data), material=key)
+
+            if self._should_chunk(data):
+                chunked.append((key, data, time_ms, fresh_ms))
+                continue
+
+            self._store_script(key, data, time_ms, fresh_ms, client=pipe)
+
+        pipe.execute()
+
+        for key, data, time_ms, fresh_ms in chunked:
+            self._store_chunked(key, data, time_ms, fresh_ms)
+
+    def get_version(self, key):
+        version = self.redis.hget(self.layout.meta(key), 'version')
+        return None if version is None else int(version)
+
+    def fence(self, key):
+        return self.fence_script(keys=[self.layout.meta(key)], args=[META_TTL_MS])
+
+    def _store_script(self, key, data, time_ms, fresh_ms, client=None, fence=None):
+        tag_keys = self._tag_keys(key)
+
+        if self.is_cluster:
+            # tag sets live in other slots
+            self._add_to_tags(key, self.redis)
+            tag_keys = []
+
+        return self.store_script(
+            keys=[self.layout.value(key), self.layout.expired(key), self.layout.meta(key)] + tag_keys,
+            args=[
+                data, self._digest(data), time_ms, self._now_ms(), time_ms + META_TTL_MS, key,
+                '' if fence is None else fence, fresh_ms,
+            ],
+            client=client
+        )
+
+    def _tag_keys(self, key):
+        return [self.layout.tag(tag) for tag in self.tags.get(key, ())]
+
+    def _add_to_tags(self, key, client):
+        for tag_key in self._tag_keys(key):
+            client.sadd(tag_key, key)
+
+    def _mget(self, names):
+        if self.is_cluster:
+            return self.redis.mget_nonatomic(names)
+        return self.redis.mget(names)
+
+    def _digest(self, data):
+        return sha1(data).hexdigest()
+
+    def _now_ms(self):
+        return int(time() * 1000)
+
+    def _should_chunk(self, data):
+        return self.chunk_size is not None and len(data) > self.chunk_size
+
+    def _store_chunked(self, key, data, time_ms, fresh_ms, fence=None):
+        # chunked digests never match plain ones, so a value is rewritten if the way it is stored changes
+        digest = '%s/%d' % (self._digest(data), self.chunk_size)
+        meta_key = self.layout.meta(key)
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.mget([self.layout.value(key), self.layout.expired(key)])
+        pipe.hmget(meta_key, ['digest', 'fence'])
+        (value, expired_value), (stored_digest, stored_fence) = pipe.execute()
+
+        # checked before writing the chunks too, so stale workers don't write them for nothing
+        if fence is not None and int(stored_fence or 0) > fence:
+            raise stale_fence(key, fence)
 
-        value = msgpack.packb(value, encoding='utf-8')
-        self.redis.psetex(name=key, value=value, time_ms=time_ms)
+        manifest = value if value is not None else expired_value
+        if self._is_manifest(manifest) and stored_digest == digest.encode('utf-8'):
+            if self._extend_chunked(key, manifest, time_ms, fresh_ms, value is None):
+                return False
 
-        self.redis.delete('_expired_%s' % key)
+        version = uuid4().hex
+
+        replaced_chunk_keys = []
+        for value in (value, expired_value):
+            if self._is_manifest(value):
+                replaced_chunk_keys.extend(self._chunk_keys(key, value))
+
+        chunk_keys = self._write_chunks(key, version, data, time_ms)
+
+        # the fence is checked again as the manifest is swapped in, as the lock may be taken while writing chunks
+        swapped = self.swap_manifest_script(
+            keys=[self.layout.value(key), self.layout.expired(key), meta_key] + replaced_chunk_keys,
+            args=[
+                MANIFEST + MsgPackCodec().encode([version, len(chunk_keys)]), digest, time_ms, self._now_ms(),
+                time_ms + META_TTL_MS, '' if fence is None else fence, fresh_ms, REPLACED_CHUNKS_TTL_MS,
+            ]
+        )
+        if swapped == -1:
+            self.redis.delete(*chunk_keys)
+            raise stale_fence(key, fence)
+
+        self._add_to_tags(key, self.redis)
+
+        return True
+
+    def _write_chunks(self, key, version, data, time_ms):
+        count = (len(data) + self.chunk_size - 1) // self.chunk_size
+        chunk_keys = [self.layout.chunk(key, version, index) for index in range(count)]
+
+        pipe = self.redis.pipeline(transaction=False)
+        for index, chunk_key in enumerate(chunk_keys):
+            pipe.psetex(
+                name=chunk_key,
+                value=data[index * self.chunk_size:(index + 1) * self.chunk_size],
+                time_ms=time_ms + REPLACED_CHUNKS_TTL_MS
+            )
+        pipe.execute()
+
+        return chunk_keys
+
+    def _extend_chunked(self, key, manifest, time_ms, fresh_ms, is_expired):
+        pipe = self.redis.pipeline(transaction=False)
+        for chunk_key in self._chunk_keys(key, manifest):
+            pipe.pexpire(chunk_key, time_ms + REPLACED_CHUNKS_TTL_MS)
+        if not all(pipe.execute()):
+            return False
+
+        pipe = self.redis.pipeline(transaction=True)
+        if is_expired:
+            pipe.rename(self.layout.expired(key), self.layout.value(key))
+        pipe.pexpire(self.layout.value(key), time_ms)
+        pipe.delete(self.layout.expired(key))
+        pipe.hset(self.layout.meta(key), 'expiration', fresh_ms)
+        pipe.hset(self.layout.meta(key), 'ttl', time_ms)
+        pipe.pexpire(self.layout.meta(key), time_ms + META_TTL_MS)
+        self._add_to_tags(key, self.redis if self.is_cluster else pipe)
+        pipe.execute()
+
+        return True
+
+    def _is_manifest(self, value):
+        return value is not None and value[:len(MANIFEST)] == MANIFEST
+
+    def _chunk_keys(self, key, manifest):
+        version, count = MsgPackCodec().decode(manifest[len(MANIFEST):])
+        return [self.layout.chunk(key, version, index) for index in range(count)]
+
+    def _resolve(self, key, value):
+        if not self._is_manifest(value):
+            return value
+
+        chunks = self._mget(self._chunk_keys(key, value))
+        if None in chunks:
+            return None
+
+        return b''.join(chunks)
+
+    def _iter_chunks(self, key, chunk_keys):
+        for start in range(0, len(chunk_keys), self.chunks_per_read):
+            for chunk in self._mget(chunk_keys[start:start + self.chunks_per_read]):
+                if chunk is None:
+                    raise ValueError('Material %s was replaced while being read. Please try again.' % key)
+                yield chunk
 
     def retrieve(self, key):
-        value = self.redis.get(key)
+        return self.retrieve_many([key])[key]
+
+    def retrieve_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+
+        values = self._mget([self.layout.value(key) for key in keys] + [self.layout.expired(key) for key in keys])
+
+        result = {}
+        for key, value, expired_value in zip(keys, values[:len(keys)], values[len(keys):]):
+            if value is None:
+                value = expired_value
+
+            value = self._resolve(key, value)
+            result[key] = None if value is None else self.serializer_for(key).loads(value)
+
+        return result
+
+    def iter_retrieve(self, key):
+        value, expired_value = self._mget([self.layout.value(key), self.layout.expired(key)])
         if value is None:
-            value = self.redis.get('_expired_%s' % key)
+            value = expired_value
             if value is None:
                 return None
 
-        return msgpack.unpackb(value, encoding='utf-8')
+        if not self._is_manifest(value):
+            return iter_records(self.serializer_for(key).loads(value))
+
+        return self._iter_chunked(key, self._chunk_keys(key, value))
+
+    def _iter_chunked(self, key, chunk_keys):
+        serializer = self.serializer_for(key)
+        chunks = self._iter_chunks(key, chunk_keys)
+
+        first = next(chunks)
+        codec, compressor, offset = serializer.parse_header(first)
+        payload = first[offset:]
+
+        if compressor is None and isinstance(codec, BytesCodec):
+            yield memoryview(payload)
+            for chunk in chunks:
+                yield memoryview(chunk)
+            return
+
+        if compressor is None and isinstance(codec, MsgPackCodec) and bytearray(payload[:1])[0] in MSGPACK_ARRAY_MARKERS:
+            unpacker = codec.unpacker()
+            unpacker.feed(payload)
+            unpacker.read_array_header()
+
+            for record in unpacker:
+                yield record
+
+            for chunk in chunks:
+                unpacker.feed(chunk)
+                for record in unpacker:
+                    yield record
+            return
+
+        # compressed or not a list: it has to be decoded as a whole
+        for record in iter_records(serializer.loads(b''.join([first] + list(chunks)))):
+            yield record
+
+    def retrieve_buffer(self, key):
+        '''
+        The stored bytes for `key` (as a memoryview, decompressed if needed),
+        without copying nor decoding them.
+        '''
+        value, expired_value = self._mget([self.layout.value(key), self.layout.expired(key)])
+        if value is None:
+            value = expired_value
+
+        value = self._resolve(key, value)
+        if value is None:
+            return None
+
+        return self.serializer_for(key).payload(value)
+
+    def retrieve_with_expiration(self, key, expiration=None):
+        value, expired = self.retrieve_with_expiration_script(
+            keys=[self.layout.value(key), self.layout.expired(key), self.layout.meta(key)],
+            args=['' if expiration is None else expiration]
+        )
+
+        value = self._resolve(key, value)
+        return None if value is None else self.serializer_for(key).loads(value), bool(expired)
+
+    def retrieve_with_freshness(self, key, expiration=None):
+        value, fresh_ms = self.retrieve_with_freshness_script(
+            keys=[self.layout.value(key), self.layout.expired(key), self.layout.meta(key)],
+            args=['' if expiration is None else expiration]
+        )
+
+        value = self._resolve(key, value)
+        value = None if value is None else self.serializer_for(key).loads(value)
+        # values stored without their expiration are fresh for as long as they were stored with
+        return value, None if fresh_ms == -1 else max(0, fresh_ms) / 1000.0
+
+    def register_worker(self, group, worker_id, timeout):
+        # heartbeats are stamped with redis' clock, so workers' clocks don't need to agree
+        workers = self.register_worker_script(keys=[group], args=[worker_id, int(timeout * 1000)])
+        return [self._decode(worker) for worker in workers]
+
+    def unregister_worker(self, group, worker_id):
+        self.redis.zrem(group, worker_id)
+
+    def record_request(self, family, key, timeout):
+        # stamped with this process' clock, as members' requested_at are
+        now = time()
+        requests = self.layout.requests(family)
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zadd(requests, {key: now})
+        pipe.zremrangebyscore(requests, '-inf', now - timeout)
+        pipe.pexpire(requests, int(timeout * 1000) + 1)
+        pipe.execute()
+
+    def requested_since(self, family, since):
+        requests = self.redis.zrangebyscore(self.layout.requests(family), since, '+inf', withscores=True)
+        return [(self._decode(key), requested_at) for key, requested_at in requests]
+
+    def acquire_permit(self, resource, holder, cost, limit, timeout):
+        # permits are stamped with redis' clock, like worker heartbeats
+        return bool(self.acquire_permit_script(
+            keys=[self.layout.permits(resource), self.layout.permit_costs(resource)],
+            args=[holder, cost, limit, int(timeout * 1000)]
+        ))
+
+    def renew_permit(self, resource, holder, timeout):
+        return bool(self.renew_permit_script(
+            keys=[self.layout.permits(resource), self.layout.permit_costs(resource)],
+            args=[holder, int(timeout * 1000)]
+        ))
+
+    def release_permit(self, resource, holder):
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.zrem(self.layout.permits(resource), holder)
+        pipe.hdel(self.layout.permit_costs(resource), holder)
+        pipe.execute()
 
     def release_lock(self, lock):
-        return lock.release()
+        return release(lock)
+
+    def renew_lock(self, lock, timeout):
+        return renew(lock, timeout)
 
     def acquire_lock(self, key, timeout=None):
-        lock = self.redis.lock('%s-_LOCK_' % key, timeout=timeout)
+        lock = self.redis.lock(self.layout.lock(key), timeout=timeout)
         has_acquired = lock.acquire(blocking=False)
         if not has_acquired:
             return None
         return lock
 
+    def acquire_lock_if_expired(self, key, expiration=None, timeout=None):
+        lock = self.redis.lock(self.layout.lock(key), timeout=timeout)
+        token = uuid1().hex.encode('utf-8')
+
+        has_acquired = self.acquire_lock_if_expired_script(
+            keys=[self.layout.value(key), self.layout.expired(key), self.layout.meta(key), lock.name],
+            args=[
+                '' if expiration is None else expiration,
+                token,
+                '' if timeout is None else int(timeout * 1000),
+            ]
+        )
+        if not has_acquired:
+            return None
+
+        lock.local.token = token
+        return lock
+
     def is_expired(self, key, expiration=None):
-        return (
-            self.redis.exists('_expired_%s' % key)
-            or not self.redis.exists(key)
-            or expiration is not None and expiration > self.redis.ttl(key)
+        return bool(self.is_expired_script(
+            keys=[self.layout.value(key), self.layout.expired(key), self.layout.meta(key)],
+            args=['' if expiration is None else expiration]
+        ))
+
+    def expire_tag(self, tag):
+        '''
+        Expires every material tagged with `tag` in a single script and returns their keys.
+        '''
+        if self.is_cluster:
+            # materials live in different slots, so they can only be expired one by one
+            keys = [self._decode(key) for key in self.redis.smembers(self.layout.tag(tag))]
+            for key in keys:
+                self.expire(key)
+            return keys
+
+        keys = self.expire_tag_script(
+            keys=[self.layout.tag(tag)],
+            args=[self.layout.value('%s'), self.layout.expired('%s')]
         )
+        return [self._decode(key) for key in keys]
+
+    def _decode(self, name):
+        return name.decode('utf-8') if isinstance(name, bytes) else name
 
     def expire(self, key):
-        if not self.is_expired(key):
-            self.redis.rename(key, '_expired_%s' % key)
+        self.expire_script(keys=[self.layout.value(key), self.layout.expired(key)])
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from materialgirl.partitioning import weight
+from materialgirl.storage import Storage
+from materialgirl.storage.redis import RedisStorage, release, renew
+
+
+def shard_name(connection):
+    kwargs = connection.connection_pool.connection_kwargs
+    return '%s:%s/%s' % (kwargs.get('host'), kwargs.get('port'), kwargs.get('db', 0))
+
+
+class ShardedRedisStorage(Storage):
+    '''
+    Spreads materials over several standalone redis instances, picking the
+    instance of each material with rendezvous hashing on their names
+    (host:port/db), so adding an instance only moves the materials it gets.
+
+    Every key of a material lives in its instance; operations on several
+    materials are sent to each instance at once. Other arguments are given
+    to the RedisStorage of each instance.
+    '''
+
+    def __init__(self, connections, **options):
+        self.shards = dict((shard_name(connection), RedisStorage(connection, **options)) for connection in connections)
+
+    @property
+    def metrics(self):
+        return next(iter(self.shards.values())).metrics
+
+    @metrics.setter
+    def metrics(self, metrics):
+        for shard in self.shards.values():
+            shard.metrics = metrics
+
+    def shard_for(self, key):
+        return self.shards[max(self.shards, key=lambda name: weight(name, key))]
+
+    def group_by_shard(self, keys, key_of=lambda key: key):
+        groups = {}
+        for item in keys:
+            groups.setdefault(self.shard_for(key_of(item)), []).append(item)
+        return groups.items()
+
+    def use_serializer(self, key, serializer):
+        self.shard_for(key).use_serializer(key, serializer)
+
+    def use_tags(self, key, tags):
+        self.shard_for(key).use_tags(key, tags)
+
+    def store(self, key, value, expiration=10, grace_period=0, fence=None):
+        return self.shard_for(key).store(key, value, expiration=expiration, grace_period=grace_period, fence=fence)
+
+    def store_many(self, items):
+        for shard, shard_items in self.group_by_shard(items, key_of=lambda item: item[0]):
+            shard.store_many(shard_items)
+
+    def retrieve(self, key):
+        return self.shard_for(key).retrieve(key)
+
+    def retrieve_many(self, keys):
+        values = {}
+        for shard, shard_keys in self.group_by_shard(keys):
+            values.update(shard.retrieve_many(shard_keys))
+        return values
+
+    def retrieve_with_expiration(self, key, expiration=None):
+        return self.shard_for(key).retrieve_with_expiration(key, expiration)
+
+    def retrieve_with_freshness(self, key, expiration=None):
+        return self.shard_for(key).retrieve_with_freshness(key, expiration)
+
+    def iter_retrieve(self, key):
+        return self.shard_for(key).iter_retrieve(key)
+
+    def retrieve_buffer(self, key):
+        return self.shard_for(key).retrieve_buffer(key)
+
+    def get_version(self, key):
+        return self.shard_for(key).get_version(key)
+
+    def register_worker(self, group, worker_id, timeout):
+        return self.shard_for(group).register_worker(group, worker_id, timeout)
+
+    def unregister_worker(self, group, worker_id):
+        self.shard_for(group).unregister_worker(group, worker_id)
+
+    def record_request(self, family, key, timeout):
+        self.shard_for(family).record_request(family, key, timeout)
+
+    def requested_since(self, family, since):
+        return self.shard_for(family).requested_since(family, since)
+
+    def acquire_permit(self, resource, holder, cost, limit, timeout):
+        return self.shard_for(resource).acquire_permit(resource, holder, cost, limit, timeout)
+
+    def renew_permit(self, resource, holder, timeout):
+        return self.shard_for(resource).renew_permit(resource, holder, timeout)
+
+    def release_permit(self, resource, holder):
+        self.shard_for(resource).release_permit(resource, holder)
+
+    def release_lock(self, lock):
+        # locks know the instance they were taken in
+        return release(lock)
+
+    def renew_lock(self, lock, timeout):
+        return renew(lock, timeout)
+
+    def fence(self, key):
+        return self.shard_for(key).fence(key)
+
+    def acquire_lock(self, key, timeout=None):
+        return self.shard_for(key).acquire_lock(key, timeout=timeout)
+
+    def acquire_lock_if_expired(self, key, expiration=None, timeout=None):
+        return self.shard_for(key).acquire_lock_if_expired(key, expiration, timeout=timeout)
+
+    def is_expired(self, key, expiration=None):
+        return self.shard_for(key).is_expired(key, expiration)
+
+    def expire(self, key):
+        self.shard_for(key).expire(key)
+
+    def expire_tag(self, tag):
+        # every instance keeps the tags of its own materials
+        keys = []
+        for shard in self.shards.values():
+            keys.extend(shard.expire_tag(tag))
+        return keys
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+from uuid import uuid4
+
+from materialgirl.storage import Storage
+from materialgirl.storage.memory import InMemoryStorage
+
+
+class TieredStorage(Storage):
+    '''
+    Keeps recently used materials in a bounded in-process cache in front of
+    another storage. Local copies live for at most `ttl` seconds.
+
+    When given a redis connection, every `store` or `expire` is published to
+    `channel` so other nodes drop their local copy of that material.
+    '''
+
+    def __init__(self, storage, redis=None, ttl=5, max_entries=1000, max_size=None, channel='materialgirl-invalidations'):
+        self.storage = storage
+        self.redis = redis
+        self.ttl = ttl
+        self.channel = channel
+
+        self.local = InMemoryStorage(max_entries=max_entries, max_size=max_size)
+        self.node_id = uuid4().hex
+
+        self._listener = None
+        if redis is not None:
+            self.listen()
+
+    @property
+    def metrics(self):
+        return self.storage.metrics
+
+    @metrics.setter
+    def metrics(self, metrics):
+        self.storage.metrics = metrics
+
+    def listen(self):
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self.channel: self._on_invalidation})
+        self._listener = pubsub.run_in_thread(sleep_time=0.1, daemon=True)
+
+    def close(self):
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+    def use_serializer(self, key, serializer):
+        self.storage.use_serializer(key, serializer)
+
+    def use_tags(self, key, tags):
+        self.storage.use_tags(key, tags)
+
+    def store(self, key, value, expiration=10, grace_period=0, fence=None):
+        if fence is None:
+            changed = self.storage.store(key, value, expiration=expiration, grace_period=grace_period)
+        else:
+            changed = self.storage.store(key, value, expiration=expiration, grace_period=grace_period, fence=fence)
+        self._cache(key, value, expiration)
+
+        # other nodes' copies are still good when the value did not change
+        if changed is not False:
+            self._publish(key)
+
+        return changed
+
+    def store_many(self, items):
+        self.storage.store_many(items)
+
+        for key, value, expiration, grace_period in items:
+            self._cache(key, value, expiration)
+            self._publish(key)
+
+    def retrieve(self, key):
+        return self.retrieve_with_expiration(key)[0]
+
+    def retrieve_with_expiration(self, key, expiration=None):
+        # local copies are fresh: they live no longer than the freshness their value had left,
+        # and are dropped as soon as the material is expired or stored
+        value = self.local.retrieve(key)
+        if value is not None:
+            return value, False
+
+        value, fresh_for = self.storage.retrieve_with_freshness(key, expiration)
+        if fresh_for:
+            self._cache(key, value, fresh_for)
+
+        return value, fresh_for == 0
+
+    def retrieve_many(self, keys):
+        values = dict((key, self.local.retrieve(key)) for key in keys)
+
+        misses = [key for key, value in values.items() if value is None]
+        if misses:
+            # can't tell fresh values from expired ones here, so these are not kept locally
+            values.update(self.storage.retrieve_many(misses))
+
+        return values
+
+    def get_version(self, key):
+        return self.storage.get_version(key)
+
+    def register_worker(self, group, worker_id, timeout):
+        return self.storage.register_worker(group, worker_id, timeout)
+
+    def unregister_worker(self, group, worker_id):
+        self.storage.unregister_worker(group, worker_id)
+
+    def record_request(self, family, key, timeout):
+        self.storage.record_request(family, key, timeout)
+
+    def requested_since(self, family, since):
+        return self.storage.requested_since(family, since)
+
+    def acquire_permit(self, resource, holder, cost, limit, timeout):
+        return self.storage.acquire_permit(resource, holder, cost, limit, timeout)
+
+    def renew_permit(self, resource, holder, timeout):
+        return self.storage.renew_permit(resource, holder, timeout)
+
+    def release_permit(self, resource, holder):
+        self.storage.release_permit(resource, holder)
+
+    def release_lock(self, lock):
+        return self.storage.release_lock(lock)
+
+    def acquire_lock(self, key, timeout=None):
+        return self.storage.acquire_lock(key, timeout=timeout)
+
+    def acquire_lock_if_expired(self, key, expiration=None, timeout=None):
+        return self.storage.acquire_lock_if_expired(key, expiration, timeout=timeout)
+
+    def renew_lock(self, lock, timeout):
+        return self.storage.renew_lock(lock, timeout)
+
+    def fence(self, key):
+        return self.storage.fence(key)
+
+    def is_expired(self, key, expiration=None):
+        return self.storage.is_expired(key, expiration)
+
+    def expire(self, key):
+        self.storage.expire(key)
+        self.local.delete(key)
+        self._publish(key)
+
+    def expire_tag(self, tag):
+        keys = self.storage.expire_tag(tag)
+
+        for key in keys:
+            self.local.delete(key)
+        self._publish(*keys)
+
+        return keys
+
+    def _cache(self, key, value, expiration):
+        if value is None:
+            return
+
+        ttl = self.ttl if expiration is None else min(self.ttl, expiration)
+        self.local.store(key, value, expiration=ttl)
+
+    def _publish(self, *keys):
+        if self.redis is None or not keys:
+            return
+
+        if len(keys) == 1:
+            self.redis.publish(self.channel, '%s %s' % (self.node_id, keys[0]))
+            return
+
+        pipe = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.publish(self.channel, '%s %s' % (self.node_id, key))
+        pipe.execute()
+
+    def _on_invalidation(self, message):
+        data = message['data']
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+
+        node_id, key = data.split(' ', 1)
+        if node_id == self.node_id:
+            return
+
+        logging.debug('Dropping local copy of %s.', key)
+        self.local.delete(key)
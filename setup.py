@@ -44,9 +44,14 @@ MaterialGirl is a library to keep materialized views and consolidations up-to-da
     install_requires=[
         'redis',
         'msgpack-python',
+        'futures; python_version < "3"',
     ],
     extras_require={
         'tests': tests_require,
+        'numpy': ['numpy'],
+        'lz4': ['lz4'],
+        'zstd': ['zstandard'],
+        'prometheus': ['prometheus_client'],
     },
     entry_points={
         'console_scripts': [
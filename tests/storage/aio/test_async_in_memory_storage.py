@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+from preggy import expect
+
+from materialgirl.storage.aio.memory import AsyncInMemoryStorage
+from tests.base import TestCase
+
+
+class TestAsyncInMemoryStorage(TestCase):
+    def test_can_store_and_retrieve_value(self):
+        storage = AsyncInMemoryStorage()
+
+        async def store_and_retrieve():
+            await storage.store('test', 'woot', expiration=10)
+            return await storage.retrieve('test')
+
+        expect(asyncio.run(store_and_retrieve())).to_equal('woot')
+
+    def test_can_acquire_and_release_lock(self):
+        storage = AsyncInMemoryStorage()
+
+        async def lock_twice():
+            lock = await storage.acquire_lock('test')
+            locked = await storage.acquire_lock('test')
+            await storage.release_lock(lock)
+            return lock, locked, await storage.acquire_lock('test')
+
+        lock, locked, relocked = asyncio.run(lock_twice())
+
+        expect(lock).not_to_be_null()
+        expect(locked).to_be_null()
+        expect(relocked).not_to_be_null()
+
+    def test_can_expire(self):
+        storage = AsyncInMemoryStorage()
+
+        async def store_and_expire():
+            await storage.store('test', 'woot', expiration=10)
+            await storage.expire('test')
+            return await storage.is_expired('test'), await storage.retrieve('test')
+
+        expired, value = asyncio.run(store_and_expire())
+
+        expect(expired).to_be_true()
+        expect(value).to_equal('woot')
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import asyncio
+
+import msgpack
+from preggy import expect
+from redis.asyncio import StrictRedis
+
+from materialgirl.serializers import Serializer, JsonCodec
+from materialgirl.storage.aio.redis import AsyncRedisStorage
+from materialgirl.storage.redis import RedisStorage
+from tests.base import TestCase
+
+
+class TestAsyncRedisStorage(TestCase):
+    def run_with_storage(self, coroutine_function):
+        async def run():
+            redis = StrictRedis(host='localhost', port=7557, db=0)
+            try:
+                return await coroutine_function(AsyncRedisStorage(redis))
+            finally:
+                await redis.aclose()
+
+        return asyncio.run(run())
+
+    def test_can_store_value(self):
+        key = 'test-async-%s' % time.time()
+
+        async def store(storage):
+            await storage.store(key, 'woot', expiration=10)
+
+        self.run_with_storage(store)
+
+        value = msgpack.unpackb(self.redis.get(key), encoding='utf-8')
+        expect(value).to_equal('woot')
+
+    def test_can_store_none_as_value(self):
+        key = 'test-async-%s' % time.time()
+
+        async def store(storage):
+            await storage.store(key, None, expiration=10)
+
+        self.run_with_storage(store)
+
+        expect(self.redis.get(key)).to_be_null()
+
+    def test_can_get_value(self):
+        key = 'test-async-%s' % time.time()
+
+        async def store_and_retrieve(storage):
+            await storage.store(key, 'woot', expiration=10)
+            return await storage.retrieve(key)
+
+        expect(self.run_with_storage(store_and_retrieve)).to_equal('woot')
+
+    def test_can_get_null_if_value_not_set(self):
+        async def retrieve(storage):
+            return await storage.retrieve('invalid-key')
+
+        expect(self.run_with_storage(retrieve)).to_be_null()
+
+    def test_can_acquire_lock(self):
+        key = 'test-async-%s' % time.time()
+
+        async def lock_twice(storage):
+            lock = await storage.acquire_lock(key)
+            locked = await storage.acquire_lock(key)
+            await storage.release_lock(lock)
+            return lock, locked
+
+        lock, locked = self.run_with_storage(lock_twice)
+
+        expect(lock).not_to_be_null()
+        expect(locked).to_be_null()
+
+    def test_releasing_expired_lock_returns_false(self):
+        key = 'test-async-%s' % time.time()
+
+        async def acquire_and_release(storage):
+            lock = await storage.acquire_lock(key, timeout=0.05)
+            await asyncio.sleep(0.1)
+            return await storage.release_lock(lock)
+
+        expect(self.run_with_storage(acquire_and_release)).to_be_false()
+
+    def test_can_check_expired(self):
+        key = 'test-async-%s' % time.time()
+
+        async def check(storage):
+            before = await storage.is_expired(key)
+            await storage.store(key, 'woot', expiration=10, grace_period=20)
+            fresh = await storage.is_expired(key, 10)
+            await storage.expire(key)
+            expired = await storage.is_expired(key)
+            return before, fresh, expired, await storage.retrieve(key)
+
+        before, fresh, expired, value = self.run_with_storage(check)
+
+        expect(before).to_be_true()
+        expect(fresh).to_be_false()
+        expect(expired).to_be_true()
+        expect(value).to_equal('woot')
+
+    def test_expiring_missing_or_expired_value_does_nothing(self):
+        key = 'test-async-%s' % time.time()
+
+        async def expire(storage):
+            await storage.expire(key)
+            await storage.store(key, 'woot', expiration=10)
+            await storage.expire(key)
+            await storage.expire(key)
+            return await storage.retrieve(key)
+
+        expect(self.run_with_storage(expire)).to_equal('woot')
+        expect(self.redis.exists(key)).to_equal(0)
+
+    def test_can_get_chunked_value(self):
+        key = 'test-async-%s' % time.time()
+        RedisStorage(self.redis, chunk_size=8).store(key, 'woot' * 10, expiration=10)
+
+        async def retrieve(storage):
+            return await storage.retrieve(key)
+
+        expect(self.run_with_storage(retrieve)).to_equal('woot' * 10)
+
+    def test_uses_serializer_of_each_key(self):
+        key = 'test-async-%s' % time.time()
+        sync_storage = RedisStorage(self.redis)
+        sync_storage.use_serializer(key, Serializer(codec=JsonCodec()))
+        sync_storage.store(key, {'a': 1}, expiration=10)
+
+        async def retrieve(storage):
+            storage.use_serializer(key, Serializer(codec=JsonCodec()))
+            return await storage.retrieve(key)
+
+        expect(self.run_with_storage(retrieve)).to_equal({'a': 1})
@@ -3,6 +3,7 @@
 
 import sys
 
+from mock import Mock
 from preggy import expect
 
 from materialgirl.storage import Storage
@@ -79,3 +80,39 @@ class TestBaseStorage(TestCase):
             expect(err).to_be_an_error_like(NotImplementedError)
         else:
             assert False, "Should not have gotten this far"
+
+    def test_acquire_lock_if_expired_uses_lock_and_expiration(self):
+        storage = Storage()
+        storage.acquire_lock = Mock(return_value='lock')
+        storage.release_lock = Mock()
+        storage.is_expired = Mock(return_value=True)
+
+        expect(storage.acquire_lock_if_expired('test', 10, timeout=5)).to_equal('lock')
+        storage.acquire_lock.assert_called_once_with('test', timeout=5)
+        storage.is_expired.assert_called_once_with('test', 10)
+        expect(storage.release_lock.called).to_be_false()
+
+    def test_acquire_lock_if_expired_releases_lock_if_not_expired(self):
+        storage = Storage()
+        storage.acquire_lock = Mock(return_value='lock')
+        storage.release_lock = Mock()
+        storage.is_expired = Mock(return_value=False)
+
+        expect(storage.acquire_lock_if_expired('test', 10)).to_be_null()
+        storage.release_lock.assert_called_once_with('lock')
+
+    def test_acquire_lock_if_expired_returns_none_if_locked(self):
+        storage = Storage()
+        storage.acquire_lock = Mock(return_value=None)
+        storage.is_expired = Mock()
+
+        expect(storage.acquire_lock_if_expired('test', 10)).to_be_null()
+        expect(storage.is_expired.called).to_be_false()
+
+    def test_retrieve_with_expiration_uses_retrieve_and_is_expired(self):
+        storage = Storage()
+        storage.retrieve = Mock(return_value='woot')
+        storage.is_expired = Mock(return_value=True)
+
+        expect(storage.retrieve_with_expiration('test', 10)).to_equal(('woot', True))
+        storage.is_expired.assert_called_once_with('test', 10)
@@ -1,9 +1,14 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import sys
+import time
+import threading
+
 from preggy import expect
 
-from materialgirl.storage.memory import InMemoryStorage
+from materialgirl.storage import StaleLockError
+from materialgirl.storage.memory import InMemoryStorage, approximate_size
 from tests.base import TestCase
 
 
@@ -48,7 +53,7 @@ class TestInMemoryStorage(TestCase):
         lock = storage.acquire_lock('key-test')
         expect(lock).not_to_be_null()
 
-        storage.release_lock('key-test')
+        expect(storage.release_lock(lock)).to_be_true()
 
         lock = storage.acquire_lock('key-test')
         expect(lock).not_to_be_null()
@@ -104,3 +109,252 @@ class TestInMemoryStorage(TestCase):
         value = storage.retrieve('test')
 
         expect(value).to_equal('woot')
+
+    def test_can_retrieve_many(self):
+        storage = InMemoryStorage()
+        storage.store('test1', 'woot1', expiration=10)
+        storage.store('test2', 'woot2', expiration=10)
+        storage.expire('test2')
+
+        values = storage.retrieve_many(['test1', 'test2', 'test3'])
+
+        expect(values).to_be_like({'test1': 'woot1', 'test2': 'woot2', 'test3': None})
+
+    def test_can_store_many(self):
+        storage = InMemoryStorage()
+
+        storage.store_many([('test1', 'woot1', 10, 0), ('test2', 'woot2', 10, 0)])
+
+        expect(storage.items).to_be_like({'test1': 'woot1', 'test2': 'woot2'})
+
+    def test_value_is_fresh_until_expiration(self):
+        storage = InMemoryStorage()
+        storage.store('test', 'woot', expiration=0.05)
+
+        expect(storage.is_expired('test')).to_be_false()
+
+        time.sleep(0.06)
+
+        expect(storage.is_expired('test')).to_be_true()
+        expect(storage.retrieve('test')).to_be_null()
+        expect(storage.items).to_be_empty()
+
+    def test_value_can_be_retrieved_during_grace_period(self):
+        storage = InMemoryStorage()
+        storage.store('test', 'woot', expiration=0.05, grace_period=0.2)
+
+        time.sleep(0.06)
+
+        expect(storage.is_expired('test')).to_be_true()
+        expect(storage.retrieve('test')).to_equal('woot')
+
+        time.sleep(0.15)
+
+        expect(storage.retrieve('test')).to_be_null()
+
+    def test_expired_value_keeps_its_lifetime(self):
+        storage = InMemoryStorage()
+        storage.store('test', 'woot', expiration=0.05)
+
+        storage.expire('test')
+
+        expect(storage.retrieve('test')).to_equal('woot')
+
+        time.sleep(0.06)
+
+        expect(storage.retrieve('test')).to_be_null()
+
+    def test_can_check_expiration_ahead_of_time(self):
+        storage = InMemoryStorage()
+        storage.store('test', 'woot', expiration=10)
+
+        expect(storage.is_expired('test', 10)).to_be_false()
+        expect(storage.is_expired('test', 15)).to_be_false()
+        expect(storage.is_expired('test', 21)).to_be_true()
+
+    def test_values_stored_without_expiration_never_expire(self):
+        storage = InMemoryStorage()
+        storage.store('test', 'woot')
+
+        expect(storage.is_expired('test', 1000)).to_be_false()
+
+    def test_can_bound_number_of_entries(self):
+        storage = InMemoryStorage(max_entries=2)
+
+        storage.store('test1', 'woot1', expiration=10)
+        storage.store('test2', 'woot2', expiration=10)
+        storage.retrieve('test1')
+        storage.store('test3', 'woot3', expiration=10)
+
+        expect(storage.items).to_be_like({'test1': 'woot1', 'test3': 'woot3'})
+
+    def test_can_bound_size(self):
+        value = 'x' * 1000
+        storage = InMemoryStorage(max_size=approximate_size(value) * 2)
+
+        storage.store('test1', value, expiration=10)
+        storage.store('test2', value, expiration=10)
+
+        expect(storage.items).to_length(2)
+
+        storage.store('test3', value, expiration=10)
+
+        expect(list(storage.items)).to_equal(['test2', 'test3'])
+        expect(storage.size).to_equal(approximate_size(value) * 2)
+
+    def test_keeps_value_bigger_than_size_bound(self):
+        storage = InMemoryStorage(max_size=10)
+
+        storage.store('test', 'x' * 1000, expiration=10)
+
+        expect(storage.items).to_length(1)
+
+    def test_approximate_size_of_containers(self):
+        expect(approximate_size(['x' * 1000]) > 1000).to_be_true()
+        expect(approximate_size({'key': 'x' * 1000}) > 1000).to_be_true()
+
+    def test_lock_expires_after_timeout(self):
+        storage = InMemoryStorage()
+
+        expect(storage.acquire_lock('test', timeout=0.05)).not_to_be_null()
+        expect(storage.acquire_lock('test')).to_be_null()
+
+        time.sleep(0.06)
+
+        expect(storage.acquire_lock('test')).not_to_be_null()
+
+    def test_can_release_lock_not_held(self):
+        storage = InMemoryStorage()
+
+        expect(storage.release_lock(('test', 'token'))).to_be_false()
+
+        expect(storage.locks).to_be_empty()
+
+    def test_stale_holders_can_not_renew_or_release_lock_of_next_holder(self):
+        storage = InMemoryStorage()
+
+        stale = storage.acquire_lock('test', timeout=0.05)
+        time.sleep(0.06)
+        lock = storage.acquire_lock('test', timeout=10)
+
+        expect(storage.renew_lock(stale, 10)).to_be_false()
+        expect(storage.release_lock(stale)).to_be_false()
+        expect(storage.acquire_lock('test')).to_be_null()
+
+        expect(storage.renew_lock(lock, 10)).to_be_true()
+        expect(storage.release_lock(lock)).to_be_true()
+
+    def test_can_replace_items(self):
+        storage = InMemoryStorage()
+        storage.store('test', 'woot', expiration=10)
+
+        storage.items = {}
+
+        expect(storage.retrieve('test')).to_be_null()
+        expect(storage.entries).to_be_empty()
+
+    def test_only_one_thread_acquires_lock(self):
+        storage = InMemoryStorage()
+        locks = []
+
+        def acquire():
+            for index in range(100):
+                lock = storage.acquire_lock('test-%d' % index)
+                if lock is not None:
+                    locks.append(lock)
+
+        threads = [threading.Thread(target=acquire) for index in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        expect(locks).to_length(100)
+
+    def test_can_be_used_by_many_threads(self):
+        storage = InMemoryStorage(max_entries=50)
+
+        def use():
+            for index in range(200):
+                storage.store('test-%d' % (index % 80), index, expiration=10)
+                storage.retrieve('test-%d' % ((index + 7) % 80))
+                storage.expire('test-%d' % ((index + 3) % 80))
+
+        threads = [threading.Thread(target=use) for index in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        expect(len(storage.items) <= 50).to_be_true()
+        expect(set(storage.entries)).to_equal(set(storage.items))
+
+    def test_storing_same_value_keeps_version(self):
+        storage = InMemoryStorage()
+
+        expect(storage.get_version('test')).to_be_null()
+        expect(storage.store('test', {'woot': 'woot'}, expiration=10)).to_be_true()
+        version = storage.get_version('test')
+
+        expect(storage.store('test', {'woot': 'woot'}, expiration=10)).to_be_false()
+        expect(storage.get_version('test')).to_equal(version)
+
+        expect(storage.store('test', {'woot': 'other'}, expiration=10)).to_be_true()
+        expect(storage.get_version('test') > version).to_be_true()
+
+    def test_storing_same_value_after_expire_restores_it(self):
+        storage = InMemoryStorage()
+        storage.store('test', 'woot', expiration=10)
+        storage.expire('test')
+
+        expect(storage.store('test', 'woot', expiration=10)).to_be_false()
+        expect(storage.is_expired('test')).to_be_false()
+
+    def test_can_expire_tag(self):
+        storage = InMemoryStorage()
+        storage.use_tags('test1', ['tag'])
+        storage.use_tags('test2', ['tag', 'other'])
+        storage.use_tags('test3', ['other'])
+
+        for key in ('test1', 'test2', 'test3'):
+            storage.store(key, 'woot', expiration=10)
+        storage.delete('test2')
+
+        expect(storage.expire_tag('tag')).to_equal(['test1'])
+        expect(storage.is_expired('test1')).to_be_true()
+        expect(storage.is_expired('test3')).to_be_false()
+        expect(storage.tagged['tag']).to_equal(set(['test1']))
+
+    def test_can_renew_lock(self):
+        storage = InMemoryStorage()
+        lock = storage.acquire_lock('test', timeout=0.05)
+
+        expect(storage.renew_lock(lock, 10)).to_be_true()
+        time.sleep(0.1)
+
+        expect(storage.acquire_lock('test')).to_be_null()
+
+    def test_renewing_an_expired_lock_returns_false(self):
+        storage = InMemoryStorage()
+        lock = storage.acquire_lock('test', timeout=0.01)
+        time.sleep(0.05)
+
+        expect(storage.renew_lock(lock, 10)).to_be_false()
+        expect(storage.renew_lock(('other', 'token'), 10)).to_be_false()
+
+    def test_rejects_values_stored_with_a_stale_fence(self):
+        storage = InMemoryStorage()
+        stale = storage.fence('test')
+        current = storage.fence('test')
+
+        expect(storage.store('test', 'woot', expiration=10, fence=current)).to_be_true()
+
+        try:
+            storage.store('test', 'other', expiration=10, fence=stale)
+        except StaleLockError:
+            err = sys.exc_info()[1]
+            expect(err).to_be_an_error_like(StaleLockError)
+        else:
+            assert False, "Should not have gotten this far"
+
+        expect(storage.retrieve('test')).to_equal('woot')
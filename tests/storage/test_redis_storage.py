@@ -1,13 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import sys
 import time
 
 from mock import Mock
 from preggy import expect
 import msgpack
 
-from materialgirl.storage.redis import RedisStorage
+from materialgirl.serializers import Serializer, MsgPackCodec, PickleCodec, JsonCodec, BytesCodec, ZlibCompressor
+from materialgirl.storage import StaleLockError
+from materialgirl.storage.layout import HashTaggedKeyLayout
+from materialgirl.storage.redis import RedisStorage, RedisCluster
 from tests.base import TestCase
 
 
@@ -143,6 +147,30 @@ class TestRedisStorage(TestCase):
 
         expect(storage.is_expired(key, 10)).to_be_true()
 
+    def test_values_without_grace_period_stay_fresh_for_their_expiration(self):
+        key = 'test-4-%s' % time.time()
+        storage = RedisStorage(self.redis)
+        storage.store(key, 'woot', expiration=60)
+
+        # a second of ttl gone used to make it look expired
+        self.redis.pexpire(key, 58500)
+
+        expect(storage.is_expired(key, 60)).to_be_false()
+        expect(storage.retrieve_with_expiration(key, 60)).to_equal(('woot', False))
+        expect(storage.retrieve_with_expiration(key, 60 + 59)).to_equal(('woot', True))
+
+    def test_values_are_fresh_only_for_their_expiration_within_grace_period(self):
+        key = 'test-4-%s' % time.time()
+        storage = RedisStorage(self.redis)
+        storage.store(key, 'woot', expiration=10, grace_period=60)
+
+        expect(storage.is_expired(key, 10)).to_be_false()
+
+        self.redis.pexpire(key, 49000)
+
+        expect(storage.is_expired(key, 10)).to_be_true()
+        expect(storage.retrieve_with_expiration(key, 10)).to_equal(('woot', True))
+
     def test_can_check_expired_again(self):
         key = 'test-4-%s' % time.time()
         self.redis.delete(key)
@@ -208,3 +236,601 @@ class TestRedisStorage(TestCase):
         value = storage.retrieve(key)
 
         expect(value).to_equal('woot')
+
+    def test_can_acquire_lock_if_expired(self):
+        key = 'test-5-%s' % time.time()
+        storage = RedisStorage(self.redis)
+
+        lock = storage.acquire_lock_if_expired(key, 10)
+        expect(lock).not_to_be_null()
+
+        locked = storage.acquire_lock_if_expired(key, 10)
+        expect(locked).to_be_null()
+
+        storage.release_lock(lock)
+
+        expect(self.redis.exists('%s-_LOCK_' % key)).to_equal(0)
+
+    def test_cant_acquire_lock_if_not_expired(self):
+        key = 'test-5-%s' % time.time()
+        storage = RedisStorage(self.redis)
+        storage.store(key, 'woot', expiration=10, grace_period=20)
+
+        expect(storage.acquire_lock_if_expired(key, 10)).to_be_null()
+        expect(self.redis.exists('%s-_LOCK_' % key)).to_equal(0)
+
+        storage.expire(key)
+
+        lock = storage.acquire_lock_if_expired(key, 10, timeout=5)
+        expect(lock).not_to_be_null()
+        expect(self.redis.pttl('%s-_LOCK_' % key) > 0).to_be_true()
+
+        storage.release_lock(lock)
+
+    def test_store_clears_expired_marker(self):
+        key = 'test-5-%s' % time.time()
+        storage = RedisStorage(self.redis)
+        storage.store(key, 'woot', expiration=10)
+        storage.expire(key)
+
+        expect(self.redis.exists('_expired_%s' % key)).to_equal(1)
+
+        storage.store(key, 'woot2', expiration=10)
+
+        expect(self.redis.exists('_expired_%s' % key)).to_equal(0)
+        expect(storage.retrieve(key)).to_equal('woot2')
+
+    def test_expire_does_not_overwrite_expired_value(self):
+        key = 'test-5-%s' % time.time()
+        storage = RedisStorage(self.redis)
+        storage.store(key, 'woot', expiration=10)
+        storage.expire(key)
+
+        self.redis.set(key, msgpack.packb('other', encoding='utf-8'))
+        storage.expire(key)
+
+        expect(msgpack.unpackb(self.redis.get('_expired_%s' % key), encoding='utf-8')).to_equal('woot')
+
+    def test_can_retrieve_many(self):
+        key = 'test-6-%s' % time.time()
+        storage = RedisStorage(self.redis)
+        storage.store('%s-1' % key, 'woot1', expiration=10)
+        storage.store('%s-2' % key, 'woot2', expiration=10)
+        storage.expire('%s-2' % key)
+
+        values = storage.retrieve_many(['%s-1' % key, '%s-2' % key, '%s-3' % key])
+
+        expect(values).to_be_like({
+            '%s-1' % key: 'woot1',
+            '%s-2' % key: 'woot2',
+            '%s-3' % key: None,
+        })
+
+    def test_can_retrieve_many_without_keys(self):
+        storage = RedisStorage(self.redis)
+
+        expect(storage.retrieve_many([])).to_be_like({})
+
+    def test_retrieve_many_uses_a_single_mget(self):
+        redis = Mock()
+        redis.mget.return_value = [None, msgpack.packb('woot', encoding='utf-8'), None, None]
+
+        values = RedisStorage(redis).retrieve_many(['test1', 'test2'])
+
+        redis.mget.assert_called_once_with(['test1', 'test2', '_expired_test1', '_expired_test2'])
+        expect(values).to_be_like({'test1': None, 'test2': 'woot'})
+
+    def test_can_store_many(self):
+        key = 'test-6-%s' % time.time()
+        storage = RedisStorage(self.redis)
+        storage.store('%s-1' % key, 'old', expiration=10)
+        storage.expire('%s-1' % key)
+
+        storage.store_many([
+            ('%s-1' % key, 'woot1', 10, 0),
+            ('%s-2' % key, 'woot2', 10, 20),
+            ('%s-3' % key, None, 10, 0),
+        ])
+
+        expect(self.redis.exists('_expired_%s-1' % key)).to_equal(0)
+        expect(storage.retrieve('%s-1' % key)).to_equal('woot1')
+        expect(storage.retrieve('%s-2' % key)).to_equal('woot2')
+        expect(self.redis.pttl('%s-2' % key) > 10000).to_be_true()
+        expect(self.redis.exists('%s-3' % key)).to_equal(0)
+
+    def test_can_retrieve_with_freshness(self):
+        key = 'test-6-%s' % time.time()
+        storage = RedisStorage(self.redis)
+
+        expect(storage.retrieve_with_freshness(key)).to_equal((None, 0))
+
+        storage.store(key, 'woot', expiration=10, grace_period=20)
+        value, fresh_for = storage.retrieve_with_freshness(key)
+        expect(value).to_equal('woot')
+        expect(9 < fresh_for <= 10).to_be_true()
+
+        value, fresh_for = storage.retrieve_with_freshness(key, 15)
+        expect(4 < fresh_for <= 5).to_be_true()
+
+        storage.expire(key)
+        expect(storage.retrieve_with_freshness(key)).to_equal(('woot', 0))
+
+    def test_can_retrieve_with_expiration(self):
+        key = 'test-7-%s' % time.time()
+        storage = RedisStorage(self.redis)
+
+        expect(storage.retrieve_with_expiration(key, 10)).to_equal((None, True))
+
+        storage.store(key, 'woot', expiration=10, grace_period=20)
+
+        expect(storage.retrieve_with_expiration(key, 10)).to_equal(('woot', False))
+        expect(storage.retrieve_with_expiration(key, 30)).to_equal(('woot', True))
+
+        storage.expire(key)
+
+        expect(storage.retrieve_with_expiration(key, 10)).to_equal(('woot', True))
+
+    def test_can_store_value_with_serializer(self):
+        key = 'test-8-%s' % time.time()
+        storage = RedisStorage(self.redis, serializer=Serializer(JsonCodec()))
+        storage.store(key, {'woot': [1, 2]}, expiration=10)
+
+        expect(self.redis.get(key)[:2]).to_equal(b'\xc1\x30')
+        expect(storage.retrieve(key)).to_equal({'woot': [1, 2]})
+
+    def test_can_store_value_with_serializer_per_key(self):
+        key = 'test-8-%s' % time.time()
+        storage = RedisStorage(self.redis)
+        storage.use_serializer(key, Serializer(MsgPackCodec(), ZlibCompressor(), compress_threshold=0))
+        storage.store(key, 'woot' * 100, expiration=10)
+        storage.store('%s-other' % key, 'woot', expiration=10)
+
+        expect(self.redis.get(key)[:2]).to_equal(b'\xc1\x11')
+        expect(msgpack.unpackb(self.redis.get('%s-other' % key), encoding='utf-8')).to_equal('woot')
+        expect(storage.retrieve(key)).to_equal('woot' * 100)
+
+    def test_can_read_legacy_values_with_serializer(self):
+        key = 'test-8-%s' % time.time()
+        self.redis.set(key, msgpack.packb('woot', encoding='utf-8'))
+        storage = RedisStorage(self.redis, serializer=Serializer(PickleCodec()))
+
+        expect(storage.retrieve(key)).to_equal('woot')
+
+    def test_can_retrieve_buffer(self):
+        key = 'test-9-%s' % time.time()
+        storage = RedisStorage(self.redis, serializer=Serializer(BytesCodec()))
+        storage.store(key, b'woot' * 100, expiration=10)
+
+        value = storage.retrieve_buffer(key)
+
+        expect(value).to_be_instance_of(memoryview)
+        expect(value.tobytes()).to_equal(b'woot' * 100)
+        expect(storage.retrieve_buffer('%s-invalid' % key)).to_be_null()
+
+        storage.expire(key)
+
+        expect(storage.retrieve_buffer(key).tobytes()).to_equal(b'woot' * 100)
+
+    def test_can_store_value_in_chunks(self):
+        key = 'test-10-%s' % time.time()
+        storage = RedisStorage(self.redis, chunk_size=100)
+        value = ['woot-%d' % index for index in range(100)]
+
+        storage.store(key, value, expiration=10)
+
+        expect(self.redis.get(key)[:2]).to_equal(b'\xc1\x00')
+        expect(len(self.redis.keys('%s-_CHUNK_-*' % key)) > 5).to_be_true()
+        expect(storage.retrieve(key)).to_equal(value)
+        expect(storage.retrieve_with_expiration(key, 10)).to_equal((value, False))
+        expect(storage.retrieve_buffer(key).tobytes()).to_equal(msgpack.packb(value, encoding='utf-8'))
+
+    def test_does_not_chunk_small_values(self):
+        key = 'test-10-%s' % time.time()
+        storage = RedisStorage(self.redis, chunk_size=100)
+
+        storage.store(key, 'woot', expiration=10)
+
+        expect(msgpack.unpackb(self.redis.get(key), encoding='utf-8')).to_equal('woot')
+        expect(self.redis.keys('%s-_CHUNK_-*' % key)).to_be_empty()
+
+    def test_chunked_values_can_be_expired(self):
+        key = 'test-10-%s' % time.time()
+        storage = RedisStorage(self.redis, chunk_size=100)
+        value = 'woot' * 100
+
+        storage.store(key, value, expiration=10)
+        storage.expire(key)
+
+        expect(storage.is_expired(key)).to_be_true()
+        expect(storage.retrieve(key)).to_equal(value)
+
+    def test_replaced_chunks_expire_soon(self):
+        key = 'test-10-%s' % time.time()
+        storage = RedisStorage(self.redis, chunk_size=100)
+
+        storage.store(key, 'woot' * 100, expiration=1000)
+        old_chunks = self.redis.keys('%s-_CHUNK_-*' % key)
+
+        storage.expire(key)
+        storage.store(key, 'toow' * 100, expiration=1000)
+
+        for chunk_key in old_chunks:
+            expect(self.redis.pttl(chunk_key) <= 30000).to_be_true()
+
+        expect(storage.retrieve(key)).to_equal('toow' * 100)
+        expect(self.redis.exists('_expired_%s' % key)).to_equal(0)
+
+    def test_missing_chunks_are_cache_misses(self):
+        key = 'test-10-%s' % time.time()
+        storage = RedisStorage(self.redis, chunk_size=100)
+
+        storage.store(key, 'woot' * 100, expiration=10)
+        self.redis.delete(self.redis.keys('%s-_CHUNK_-*' % key)[0])
+
+        expect(storage.retrieve(key)).to_be_null()
+
+    def test_can_store_many_in_chunks(self):
+        key = 'test-10-%s' % time.time()
+        storage = RedisStorage(self.redis, chunk_size=100)
+
+        storage.store_many([('%s-1' % key, 'woot' * 100, 10, 0), ('%s-2' % key, 'woot', 10, 0)])
+
+        expect(storage.retrieve_many(['%s-1' % key, '%s-2' % key])).to_be_like({
+            '%s-1' % key: 'woot' * 100,
+            '%s-2' % key: 'woot',
+        })
+
+    def test_can_iterate_records(self):
+        key = 'test-11-%s' % time.time()
+        storage = RedisStorage(self.redis)
+
+        expect(storage.iter_retrieve(key)).to_be_null()
+
+        storage.store(key, ['woot1', 'woot2'], expiration=10)
+        expect(list(storage.iter_retrieve(key))).to_equal(['woot1', 'woot2'])
+
+        storage.store(key, 'woot', expiration=10)
+        expect(list(storage.iter_retrieve(key))).to_equal(['woot'])
+
+    def test_streams_records_of_chunked_lists(self):
+        key = 'test-11-%s' % time.time()
+        storage = RedisStorage(self.redis, chunk_size=100, chunks_per_read=2)
+        value = [{'url': 'http://holmes.com/%d' % index} for index in range(100)]
+        storage.store(key, value, expiration=10)
+
+        records = storage.iter_retrieve(key)
+
+        expect(next(records)).to_equal(value[0])
+
+        chunk_count = len(self.redis.keys('%s-_CHUNK_-*' % key))
+        expect(chunk_count > 2).to_be_true()
+
+        expect(list(records)).to_equal(value[1:])
+
+    def test_streams_chunks_of_bytes(self):
+        key = 'test-11-%s' % time.time()
+        storage = RedisStorage(self.redis, serializer=Serializer(BytesCodec()), chunk_size=100)
+        storage.store(key, b'w' * 1000, expiration=10)
+
+        chunks = list(storage.iter_retrieve(key))
+
+        expect(chunks).to_length(11)
+        expect(b''.join(chunk.tobytes() for chunk in chunks)).to_equal(b'w' * 1000)
+
+    def test_iterates_compressed_chunked_values(self):
+        key = 'test-11-%s' % time.time()
+        serializer = Serializer(MsgPackCodec(), ZlibCompressor(), compress_threshold=0)
+        storage = RedisStorage(self.redis, serializer=serializer, chunk_size=20)
+        value = ['woot-%d' % index for index in range(100)]
+        storage.store(key, value, expiration=10)
+
+        expect(list(storage.iter_retrieve(key))).to_equal(value)
+
+    def test_iterating_replaced_value_raises(self):
+        key = 'test-11-%s' % time.time()
+        storage = RedisStorage(self.redis, chunk_size=100, chunks_per_read=1)
+        storage.store(key, ['woot-%d' % index for index in range(100)], expiration=10)
+
+        records = storage.iter_retrieve(key)
+        next(records)
+
+        self.redis.delete(*self.redis.keys('%s-_CHUNK_-*' % key))
+
+        try:
+            list(records)
+        except ValueError:
+            err = sys.exc_info()[1]
+            expect(err).to_have_an_error_message_of(
+                'Material %s was replaced while being read. Please try again.' % key
+            )
+        else:
+            assert False, "Should not have gotten this far"
+
+    def test_storing_same_value_only_extends_expiration(self):
+        key = 'test-12-%s' % time.time()
+        storage = RedisStorage(self.redis)
+
+        expect(storage.store(key, {'woot': 'woot'}, expiration=10)).to_be_true()
+        version = storage.get_version(key)
+
+        expect(storage.store(key, {'woot': 'woot'}, expiration=100)).to_be_false()
+
+        expect(storage.get_version(key)).to_equal(version)
+        expect(self.redis.ttl(key) > 10).to_be_true()
+
+    def test_storing_changed_value_bumps_version(self):
+        key = 'test-12-%s' % time.time()
+        storage = RedisStorage(self.redis)
+
+        expect(storage.get_version(key)).to_be_null()
+
+        storage.store(key, 'woot', expiration=10)
+        version = storage.get_version(key)
+        storage.store(key, 'other', expiration=10)
+
+        expect(storage.get_version(key) > version).to_be_true()
+        expect(storage.retrieve(key)).to_equal('other')
+
+    def test_storing_same_value_after_expire_restores_it(self):
+        key = 'test-12-%s' % time.time()
+        storage = RedisStorage(self.redis)
+        storage.store(key, 'woot', expiration=10)
+        version = storage.get_version(key)
+        storage.expire(key)
+
+        expect(storage.store(key, 'woot', expiration=10)).to_be_false()
+
+        expect(storage.is_expired(key)).to_be_false()
+        expect(storage.retrieve(key)).to_equal('woot')
+        expect(storage.get_version(key)).to_equal(version)
+
+    def test_storing_same_chunked_value_only_extends_expiration(self):
+        key = 'test-12-%s' % time.time()
+        storage = RedisStorage(self.redis, chunk_size=20)
+        value = ['woot-%d' % index for index in range(20)]
+
+        expect(storage.store(key, value, expiration=10)).to_be_true()
+        manifest = self.redis.get(key)
+
+        expect(storage.store(key, value, expiration=100)).to_be_false()
+
+        expect(self.redis.get(key)).to_equal(manifest)
+        expect(self.redis.ttl(key) > 10).to_be_true()
+        expect(storage.retrieve(key)).to_equal(value)
+
+    def test_store_many_keeps_versions(self):
+        key = 'test-12-%s' % time.time()
+        storage = RedisStorage(self.redis)
+        storage.store(key, 'woot', expiration=10)
+        version = storage.get_version(key)
+
+        storage.store_many([(key, 'woot', 10, 0), ('%s-other' % key, 'other', 10, 0)])
+
+        expect(storage.get_version(key)).to_equal(version)
+        expect(storage.get_version('%s-other' % key)).not_to_be_null()
+
+    def test_can_register_workers(self):
+        group = 'test-workers-%s' % time.time()
+        storage = RedisStorage(self.redis)
+
+        expect(storage.register_worker(group, 'worker1', 10)).to_equal(['worker1'])
+        expect(sorted(storage.register_worker(group, 'worker2', 10))).to_equal(['worker1', 'worker2'])
+
+        storage.unregister_worker(group, 'worker1')
+        expect(storage.register_worker(group, 'worker2', 10)).to_equal(['worker2'])
+
+    def test_dead_workers_are_dropped(self):
+        group = 'test-workers-%s' % time.time()
+        storage = RedisStorage(self.redis)
+
+        storage.register_worker(group, 'worker1', 0.05)
+        time.sleep(0.1)
+
+        expect(storage.register_worker(group, 'worker2', 10)).to_equal(['worker2'])
+
+    def test_can_record_requests(self):
+        family = 'test-requests-%s:{id}' % time.time()
+        storage = RedisStorage(self.redis)
+
+        before = time.time()
+        storage.record_request(family, 'test:1', 10)
+        storage.record_request(family, 'test:2', 10)
+
+        expect(sorted(key for key, _ in storage.requested_since(family, before))).to_equal(['test:1', 'test:2'])
+        expect(storage.requested_since(family, time.time())).to_be_empty()
+
+    def test_forgets_old_requests(self):
+        family = 'test-requests-%s:{id}' % time.time()
+        storage = RedisStorage(self.redis)
+
+        storage.record_request(family, 'test:1', 0.05)
+        time.sleep(0.1)
+        storage.record_request(family, 'test:2', 0.05)
+
+        expect([key for key, _ in storage.requested_since(family, 0)]).to_equal(['test:2'])
+
+    def test_uses_hash_tagged_layout_with_cluster_clients(self):
+        storage = RedisStorage(Mock(spec=RedisCluster))
+
+        expect(storage.is_cluster).to_be_true()
+        expect(storage.layout).to_be_instance_of(HashTaggedKeyLayout)
+        expect(RedisStorage(self.redis).layout).not_to_be_instance_of(HashTaggedKeyLayout)
+
+    def test_can_use_hash_tagged_layout(self):
+        key = 'test-13-%s' % time.time()
+        storage = RedisStorage(self.redis, layout=HashTaggedKeyLayout(), chunk_size=20)
+        value = ['woot-%d' % index for index in range(20)]
+
+        storage.store(key, value, expiration=10)
+        expect(self.redis.exists('{%s}' % key)).to_be_true()
+        expect(self.redis.exists('%s-_META_' % key)).to_be_false()
+        expect(self.redis.exists('{%s}-_META_' % key)).to_be_true()
+        expect(storage.retrieve(key)).to_equal(value)
+        expect(list(storage.iter_retrieve(key))).to_equal(value)
+
+        lock = storage.acquire_lock(key)
+        expect(self.redis.exists('{%s}-_LOCK_' % key)).to_be_true()
+        storage.release_lock(lock)
+
+        storage.expire(key)
+        expect(self.redis.exists('_expired_{%s}' % key)).to_be_true()
+        expect(storage.is_expired(key)).to_be_true()
+        expect(storage.retrieve(key)).to_equal(value)
+
+    def test_hash_tagged_layout_keeps_keys_of_a_material_in_one_slot(self):
+        layout = HashTaggedKeyLayout()
+        names = [layout.value('a}b'), layout.expired('a}b'), layout.lock('a}b'), layout.meta('a}b'), layout.chunk('a}b', 'v', 1)]
+
+        tags = [name[name.index('{') + 1:name.index('}')] for name in names]
+
+        expect(set(tags)).to_equal(set(['a']))
+
+    def test_can_expire_tag(self):
+        key = 'test-14-%s' % time.time()
+        storage = RedisStorage(self.redis)
+        storage.use_tags('%s-1' % key, ['%s-tag' % key])
+        storage.use_tags('%s-2' % key, ['%s-tag' % key, '%s-other' % key])
+        storage.use_tags('%s-3' % key, ['%s-other' % key])
+
+        for index in range(1, 4):
+            storage.store('%s-%d' % (key, index), 'woot', expiration=10)
+
+        expired = storage.expire_tag('%s-tag' % key)
+
+        expect(sorted(expired)).to_equal(['%s-1' % key, '%s-2' % key])
+        expect(storage.is_expired('%s-1' % key)).to_be_true()
+        expect(storage.is_expired('%s-2' % key)).to_be_true()
+        expect(storage.is_expired('%s-3' % key)).to_be_false()
+        expect(storage.retrieve('%s-1' % key)).to_equal('woot')
+
+    def test_expire_tag_forgets_missing_materials(self):
+        key = 'test-14-%s' % time.time()
+        storage = RedisStorage(self.redis, chunk_size=20)
+        storage.use_tags(key, ['%s-tag' % key])
+        storage.store(key, ['woot-%d' % index for index in range(20)], expiration=10)
+
+        expect(self.redis.smembers('_tag_%s-tag' % key)).to_equal(set([key.encode('utf-8')]))
+
+        self.redis.delete(key)
+
+        expect(storage.expire_tag('%s-tag' % key)).to_be_empty()
+        expect(self.redis.smembers('_tag_%s-tag' % key)).to_be_empty()
+
+    def test_can_renew_lock(self):
+        key = 'test-15-%s' % time.time()
+        storage = RedisStorage(self.redis)
+
+        lock = storage.acquire_lock(key, timeout=1)
+
+        expect(storage.renew_lock(lock, 10)).to_be_true()
+        expect(self.redis.pttl('%s-_LOCK_' % key) > 5000).to_be_true()
+
+        storage.release_lock(lock)
+
+    def test_renewing_or_releasing_a_lost_lock_returns_false(self):
+        key = 'test-16-%s' % time.time()
+        storage = RedisStorage(self.redis)
+
+        lock = storage.acquire_lock(key, timeout=10)
+        self.redis.delete('%s-_LOCK_' % key)
+        other = storage.acquire_lock(key, timeout=10)
+
+        expect(storage.renew_lock(lock, 10)).to_be_false()
+        expect(storage.release_lock(lock)).to_be_false()
+        expect(storage.acquire_lock(key)).to_be_null()
+
+        expect(storage.release_lock(other)).to_be_true()
+
+    def test_rejects_values_stored_with_a_stale_fence(self):
+        key = 'test-17-%s' % time.time()
+        storage = RedisStorage(self.redis)
+
+        stale = storage.fence(key)
+        current = storage.fence(key)
+        expect(current).to_equal(stale + 1)
+
+        expect(storage.store(key, 'woot', expiration=10, fence=current)).to_be_true()
+
+        try:
+            storage.store(key, 'other', expiration=10, fence=stale)
+        except StaleLockError:
+            err = sys.exc_info()[1]
+            expect(err).to_have_an_error_message_of(
+                'Fencing token %d for %s is stale, someone else took its lock.' % (stale, key)
+            )
+        else:
+            assert False, "Should not have gotten this far"
+
+        expect(storage.retrieve(key)).to_equal('woot')
+        expect(storage.store(key, 'other', expiration=10)).to_be_true()
+
+    def test_rejects_chunked_values_stored_with_a_stale_fence(self):
+        key = 'test-18-%s' % time.time()
+        storage = RedisStorage(self.redis, chunk_size=20)
+
+        stale = storage.fence(key)
+        storage.fence(key)
+
+        try:
+            storage.store(key, ['woot-%d' % index for index in range(20)], expiration=10, fence=stale)
+        except StaleLockError:
+            pass
+        else:
+            assert False, "Should not have gotten this far"
+
+        expect(storage.retrieve(key)).to_be_null()
+
+    def test_rejects_chunked_values_whose_lock_was_taken_while_writing_chunks(self):
+        key = 'test-18-%s' % time.time()
+        storage = RedisStorage(self.redis, chunk_size=20)
+        storage.store(key, 'woot', expiration=10)
+
+        stale = storage.fence(key)
+        write_chunks = storage._write_chunks
+
+        def write_chunks_while_lock_is_taken(*args):
+            chunk_keys = write_chunks(*args)
+            storage.fence(key)
+            return chunk_keys
+
+        storage._write_chunks = write_chunks_while_lock_is_taken
+
+        with expect.error_to_happen(StaleLockError):
+            storage.store(key, ['woot-%d' % index for index in range(20)], expiration=10, fence=stale)
+
+        expect(storage.retrieve(key)).to_equal('woot')
+        expect(self.redis.keys('%s-_CHUNK_-*' % key)).to_be_empty()
+
+    def test_can_acquire_permits_within_limit(self):
+        resource = 'test-19-%s' % time.time()
+        storage = RedisStorage(self.redis)
+
+        expect(storage.acquire_permit(resource, 'worker1', 2, 3, 10)).to_be_true()
+        expect(storage.acquire_permit(resource, 'worker2', 2, 3, 10)).to_be_false()
+        expect(storage.acquire_permit(resource, 'worker2', 1, 3, 10)).to_be_true()
+
+        storage.release_permit(resource, 'worker1')
+
+        expect(storage.acquire_permit(resource, 'worker3', 2, 3, 10)).to_be_true()
+        expect(self.redis.hgetall('_permits_%s-_COST_' % resource)).to_equal({b'worker2': b'1', b'worker3': b'2'})
+
+    def test_frees_expired_permits(self):
+        resource = 'test-20-%s' % time.time()
+        storage = RedisStorage(self.redis)
+
+        expect(storage.acquire_permit(resource, 'worker1', 1, 1, 0.01)).to_be_true()
+        time.sleep(0.02)
+
+        expect(storage.acquire_permit(resource, 'worker2', 1, 1, 10)).to_be_true()
+        expect(self.redis.zrange('_permits_%s' % resource, 0, -1)).to_equal([b'worker2'])
+
+    def test_can_renew_permits(self):
+        resource = 'test-20-%s' % time.time()
+        storage = RedisStorage(self.redis)
+
+        expect(storage.acquire_permit(resource, 'worker1', 1, 1, 0.05)).to_be_true()
+        expect(storage.renew_permit(resource, 'worker1', 10)).to_be_true()
+        time.sleep(0.1)
+
+        expect(storage.acquire_permit(resource, 'worker2', 1, 1, 10)).to_be_false()
+        expect(storage.renew_permit(resource, 'worker2', 10)).to_be_false()
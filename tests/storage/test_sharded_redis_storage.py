@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+
+import redis
+from preggy import expect
+
+from materialgirl.storage.layout import HashTaggedKeyLayout
+from materialgirl.storage.sharded import ShardedRedisStorage
+from tests.base import TestCase
+
+
+class TestShardedRedisStorage(TestCase):
+    def setUp(self):
+        super(TestShardedRedisStorage, self).setUp()
+        self.connections = [redis.StrictRedis(host='localhost', port=7557, db=db) for db in (1, 2)]
+        self.storage = ShardedRedisStorage(self.connections)
+
+    def keys(self, count=20):
+        prefix = 'test-%s' % time.time()
+        return ['%s-%d' % (prefix, index) for index in range(count)]
+
+    def test_can_create_storage(self):
+        expect(sorted(self.storage.shards)).to_equal(['localhost:7557/1', 'localhost:7557/2'])
+
+    def test_spreads_materials_over_shards(self):
+        keys = self.keys()
+        for key in keys:
+            self.storage.store(key, 'woot', expiration=10)
+
+        stored = [set(key for key in keys if connection.exists(key)) for connection in self.connections]
+
+        expect(stored[0] | stored[1]).to_equal(set(keys))
+        expect(stored[0] & stored[1]).to_be_empty()
+        expect(stored[0]).not_to_be_empty()
+        expect(stored[1]).not_to_be_empty()
+
+        for key in keys:
+            expect(self.storage.retrieve(key)).to_equal('woot')
+
+    def test_can_store_and_retrieve_many(self):
+        keys = self.keys()
+
+        self.storage.store_many([(key, key, 10, 0) for key in keys])
+
+        expect(self.storage.retrieve_many(keys)).to_equal(dict((key, key) for key in keys))
+
+    def test_can_expire_and_lock(self):
+        key = self.keys(1)[0]
+        self.storage.store(key, 'woot', expiration=10)
+
+        self.storage.expire(key)
+        expect(self.storage.is_expired(key)).to_be_true()
+        expect(self.storage.retrieve(key)).to_equal('woot')
+
+        lock = self.storage.acquire_lock_if_expired(key, timeout=10)
+        expect(lock).not_to_be_null()
+        expect(self.storage.acquire_lock(key)).to_be_null()
+
+        self.storage.release_lock(lock)
+        expect(self.storage.acquire_lock(key)).not_to_be_null()
+
+    def test_can_use_hash_tagged_layout(self):
+        storage = ShardedRedisStorage(self.connections, layout=HashTaggedKeyLayout())
+        key = self.keys(1)[0]
+
+        storage.store(key, 'woot', expiration=10)
+        storage.expire(key)
+
+        expect(storage.shard_for(key).redis.exists('_expired_{%s}' % key)).to_be_true()
+        expect(storage.retrieve(key)).to_equal('woot')
+
+    def test_can_expire_tag(self):
+        keys = self.keys()
+        tag = '%s-tag' % keys[0]
+        for key in keys:
+            self.storage.use_tags(key, [tag])
+            self.storage.store(key, 'woot', expiration=10)
+
+        expect(sorted(self.storage.expire_tag(tag))).to_equal(sorted(keys))
+        expect(all(self.storage.is_expired(key) for key in keys)).to_be_true()
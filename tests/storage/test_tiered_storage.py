@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+
+from mock import Mock
+from preggy import expect
+
+from materialgirl.storage.memory import InMemoryStorage
+from materialgirl.storage.redis import RedisStorage
+from materialgirl.storage.tiered import TieredStorage
+from tests.base import TestCase
+
+
+class TestTieredStorage(TestCase):
+    def wait_for(self, condition, timeout=2):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if condition():
+                return True
+            time.sleep(0.01)
+        return False
+
+    def test_can_create_storage(self):
+        backend = InMemoryStorage()
+        storage = TieredStorage(backend)
+
+        expect(storage.storage).to_equal(backend)
+        expect(storage.local.items).to_be_empty()
+
+    def test_store_keeps_local_copy(self):
+        backend = InMemoryStorage()
+        storage = TieredStorage(backend)
+
+        storage.store('test', 'woot', expiration=10)
+
+        expect(backend.items['test']).to_equal('woot')
+        expect(storage.local.items['test']).to_equal('woot')
+
+    def test_retrieve_uses_local_copy(self):
+        backend = Mock()
+        storage = TieredStorage(backend)
+
+        storage.store('test', 'woot', expiration=10)
+
+        expect(storage.retrieve('test')).to_equal('woot')
+        expect(backend.retrieve_with_freshness.called).to_be_false()
+
+    def test_retrieve_keeps_fresh_values_locally(self):
+        backend = InMemoryStorage()
+        backend.store('test', 'woot', expiration=10)
+        storage = TieredStorage(backend)
+
+        expect(storage.retrieve('test')).to_equal('woot')
+        expect(storage.local.items['test']).to_equal('woot')
+
+    def test_retrieve_does_not_keep_expired_values_locally(self):
+        backend = InMemoryStorage()
+        backend.store('test', 'woot', expiration=10)
+        backend.expire('test')
+        storage = TieredStorage(backend)
+
+        expect(storage.retrieve_with_expiration('test')).to_equal(('woot', True))
+        expect(storage.local.items).to_be_empty()
+
+    def test_local_copies_live_at_most_ttl(self):
+        backend = InMemoryStorage()
+        storage = TieredStorage(backend, ttl=0.05)
+
+        storage.store('test', 'woot', expiration=10)
+        time.sleep(0.06)
+
+        expect(storage.local.retrieve('test')).to_be_null()
+        expect(storage.retrieve('test')).to_equal('woot')
+
+    def test_local_copies_live_at_most_their_remaining_freshness(self):
+        backend = InMemoryStorage()
+        backend.store('test', 'woot', expiration=0.1, grace_period=10)
+        time.sleep(0.05)
+        storage = TieredStorage(backend, ttl=5)
+
+        expect(storage.retrieve_with_expiration('test')).to_equal(('woot', False))
+        time.sleep(0.06)
+
+        expect(storage.local.retrieve('test')).to_be_null()
+        expect(storage.retrieve_with_expiration('test')).to_equal(('woot', True))
+
+    def test_local_copies_of_redis_values_live_at_most_their_remaining_freshness(self):
+        key = 'test-tiered-%s' % time.time()
+        backend = RedisStorage(self.redis)
+        backend.store(key, 'woot', expiration=0.2, grace_period=10)
+        time.sleep(0.1)
+        storage = TieredStorage(backend, ttl=5)
+
+        expect(storage.retrieve_with_expiration(key)).to_equal(('woot', False))
+        time.sleep(0.15)
+
+        expect(storage.retrieve_with_expiration(key)).to_equal(('woot', True))
+
+    def test_does_not_keep_values_of_unknown_freshness_locally(self):
+        backend = Mock()
+        backend.retrieve_with_freshness.return_value = ('woot', None)
+        storage = TieredStorage(backend)
+
+        expect(storage.retrieve_with_expiration('test')).to_equal(('woot', False))
+        expect(storage.local.items).to_be_empty()
+
+    def test_local_cache_is_bounded(self):
+        storage = TieredStorage(InMemoryStorage(), max_entries=2)
+
+        for index in range(5):
+            storage.store('test%d' % index, 'woot', expiration=10)
+
+        expect(storage.local.items).to_length(2)
+
+    def test_expire_drops_local_copy(self):
+        backend = InMemoryStorage()
+        storage = TieredStorage(backend)
+        storage.store('test', 'woot', expiration=10)
+
+        storage.expire('test')
+
+        expect(storage.local.items).to_be_empty()
+        expect(storage.is_expired('test')).to_be_true()
+        expect(storage.retrieve('test')).to_equal('woot')
+
+    def test_can_retrieve_many(self):
+        backend = InMemoryStorage()
+        backend.store('test2', 'woot2', expiration=10)
+        storage = TieredStorage(backend)
+        storage.store('test1', 'woot1', expiration=10)
+
+        backend.items = {'test2': 'woot2'}
+
+        expect(storage.retrieve_many(['test1', 'test2', 'test3'])).to_be_like({
+            'test1': 'woot1', 'test2': 'woot2', 'test3': None
+        })
+
+    def test_delegates_locks(self):
+        backend = InMemoryStorage()
+        storage = TieredStorage(backend)
+
+        lock = storage.acquire_lock('test')
+
+        expect(lock).not_to_be_null()
+        expect(storage.acquire_lock_if_expired('test')).to_be_null()
+
+        storage.release_lock(lock)
+
+        expect(backend.locks).to_be_empty()
+
+    def test_invalidates_other_nodes(self):
+        channel = 'test-invalidations-%s' % time.time()
+        backend = InMemoryStorage()
+        node1 = TieredStorage(backend, redis=self.redis, channel=channel)
+        node2 = TieredStorage(backend, redis=self.redis, channel=channel)
+
+        try:
+            time.sleep(0.2)
+
+            node1.store('test', 'woot1', expiration=10)
+            expect(node2.retrieve('test')).to_equal('woot1')
+
+            node1.store('test', 'woot2', expiration=10)
+
+            expect(self.wait_for(lambda: 'test' not in node2.local.items)).to_be_true()
+            expect(node2.retrieve('test')).to_equal('woot2')
+            expect(node1.local.items['test']).to_equal('woot2')
+
+            node2.expire('test')
+
+            expect(self.wait_for(lambda: 'test' not in node1.local.items)).to_be_true()
+        finally:
+            node1.close()
+            node2.close()
+
+    def test_unchanged_values_are_not_published(self):
+        backend = InMemoryStorage()
+        redis = Mock()
+        storage = TieredStorage(backend, redis=redis)
+        storage.close()
+
+        storage.store('test', 'woot', expiration=10)
+        storage.store('test', 'woot', expiration=10)
+
+        expect(redis.publish.call_count).to_equal(1)
+        expect(storage.get_version('test')).to_equal(backend.get_version('test'))
+
+    def test_expire_tag_drops_local_copies(self):
+        backend = InMemoryStorage()
+        redis = Mock()
+        storage = TieredStorage(backend, redis=redis)
+        storage.close()
+
+        storage.use_tags('test1', ['tag'])
+        storage.use_tags('test2', ['tag'])
+        storage.store('test1', 'woot', expiration=10)
+        storage.store('test2', 'woot', expiration=10)
+
+        expect(sorted(storage.expire_tag('tag'))).to_equal(['test1', 'test2'])
+        expect(storage.local.items).to_be_empty()
+        expect(backend.is_expired('test1')).to_be_true()
+        expect(redis.pipeline.return_value.publish.call_count).to_equal(2)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+import asyncio
+
+from preggy import expect
+from redis.asyncio import StrictRedis
+
+from materialgirl.aio import AsyncMaterializer
+from materialgirl.materializer import REFRESHED, SKIPPED, LOCKED
+from materialgirl.storage.aio.memory import AsyncInMemoryStorage
+from materialgirl.storage.aio.redis import AsyncRedisStorage
+from tests.base import TestCase
+
+
+class TestAsyncMaterializer(TestCase):
+    def test_can_create_girl(self):
+        storage = AsyncInMemoryStorage()
+        girl = AsyncMaterializer(storage=storage)
+
+        expect(girl.storage).to_equal(storage)
+
+    def test_can_run_coroutine_materials(self):
+        storage = AsyncInMemoryStorage()
+        girl = AsyncMaterializer(storage=storage)
+
+        async def get_woot():
+            return 'woot'
+
+        girl.add_material('test', get_woot)
+
+        results = asyncio.run(girl.run())
+
+        expect(results['test'].status).to_equal(REFRESHED)
+        expect(storage.storage.items['test']).to_equal('woot')
+
+    def test_can_run_sync_materials(self):
+        storage = AsyncInMemoryStorage()
+        girl = AsyncMaterializer(storage=storage)
+
+        girl.add_material('test', lambda: 'woot')
+
+        asyncio.run(girl.run())
+
+        expect(storage.storage.items['test']).to_equal('woot')
+
+    def test_runs_materials_concurrently(self):
+        storage = AsyncInMemoryStorage()
+        girl = AsyncMaterializer(storage=storage)
+
+        def slow(value):
+            async def get():
+                await asyncio.sleep(0.2)
+                return value
+            return get
+
+        for index in range(10):
+            girl.add_material('test%d' % index, slow('woot%d' % index))
+
+        start = time.time()
+        results = asyncio.run(girl.run())
+
+        expect(time.time() - start < 1).to_be_true()
+        expect(results).to_length(10)
+
+    def test_dont_update_not_expired_materials(self):
+        storage = AsyncInMemoryStorage()
+        girl = AsyncMaterializer(storage=storage)
+
+        girl.add_material('test', lambda: 'woot')
+
+        async def run_twice():
+            await girl.run()
+            return await girl.run()
+
+        results = asyncio.run(run_twice())
+
+        expect(results['test'].status).to_equal(SKIPPED)
+
+    def test_can_skip_locked_key(self):
+        storage = AsyncInMemoryStorage()
+        girl = AsyncMaterializer(storage=storage)
+
+        girl.add_material('test', lambda: 'woot')
+        storage.storage.acquire_lock('test')
+
+        results = asyncio.run(girl.run())
+
+        expect(results['test'].status).to_equal(LOCKED)
+
+    def test_refreshes_outliving_their_lock_do_not_fail_the_run(self):
+        key = 'test-aio-%s' % time.time()
+
+        async def slow():
+            await asyncio.sleep(0.1)
+            return 'woot'
+
+        async def run():
+            redis = StrictRedis(host='localhost', port=7557, db=0)
+            try:
+                girl = AsyncMaterializer(storage=AsyncRedisStorage(redis))
+                girl.add_material(key, slow, lock_timeout=0.05)
+                return await girl.run()
+            finally:
+                await redis.aclose()
+
+        expect(asyncio.run(run())[key].status).to_equal(REFRESHED)
+
+    def test_can_get_value_if_material_girl_not_run(self):
+        storage = AsyncInMemoryStorage()
+        girl = AsyncMaterializer(storage=storage)
+
+        async def get_woot():
+            return 'woot'
+
+        girl.add_material('test', get_woot)
+
+        expect(asyncio.run(girl.get('test'))).to_equal('woot')
+
+    def test_can_expire_materials(self):
+        storage = AsyncInMemoryStorage()
+        girl = AsyncMaterializer(storage=storage)
+
+        girl.add_material('test', lambda: 'woot')
+
+        async def run_and_expire():
+            await girl.run()
+            await girl.expire('test')
+            return await girl.is_expired('test')
+
+        expect(asyncio.run(run_and_expire())).to_be_true()
+        expect(storage.storage.items['_expired_test']).to_equal('woot')
+
+    def test_raises_if_key_not_found(self):
+        girl = AsyncMaterializer(storage=AsyncInMemoryStorage())
+
+        try:
+            asyncio.run(girl.get('test'))
+        except ValueError:
+            err = sys.exc_info()[1]
+            expect(err).to_have_an_error_message_of(
+                'Key test not found in materials. Maybe you forgot to call "add_material" for this key?'
+            )
+        else:
+            assert False, "Should not have gotten this far"
@@ -2,15 +2,29 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import math
+import time
+import threading
 
 from mock import Mock, patch, call
 from preggy import expect
 
 from materialgirl import Materializer
+from materialgirl.materializer import (
+    Material, IncrementalMaterial, Delta, MaterialFamily, RefreshTimeout, compile_pattern,
+    REFRESHED, SKIPPED, LOCKED, FAILED
+)
+from materialgirl.metrics import InMemoryMetrics
+from materialgirl.storage import StaleLockError
 from materialgirl.storage.memory import InMemoryStorage
+from materialgirl.storage.redis import RedisStorage
 from tests.base import TestCase
 
 
+def get_woot():
+    return 'woot'
+
+
 class TestMaterialGirl(TestCase):
     @staticmethod
     def woots_generator():
@@ -179,6 +193,37 @@ class TestMaterialGirl(TestCase):
         else:
             assert False, "Should not have gotten this far"
 
+    def test_can_get_version_of_material(self):
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage)
+
+        woots = iter(['woot', 'woot', 'other'])
+        girl.add_material('test', lambda: next(woots))
+
+        expect(girl.get_version('test')).to_be_null()
+
+        girl.run()
+        version = girl.get_version('test')
+        expect(version).not_to_be_null()
+
+        girl.expire('test')
+        girl.run()
+        expect(girl.get_version('test')).to_equal(version)
+
+        girl.expire('test')
+        girl.run()
+        expect(girl.get_version('test') > version).to_be_true()
+
+        try:
+            girl.get_version('invalid')
+        except ValueError:
+            err = sys.exc_info()[1]
+            expect(err).to_have_an_error_message_of(
+                'Key invalid not found in materials. Maybe you forgot to call "add_material" for this key?'
+            )
+        else:
+            assert False, "Should not have gotten this far"
+
     def test_can_get_value_after_material_girl_run(self):
         storage = InMemoryStorage()
         girl = Materializer(storage=storage)
@@ -330,3 +375,1082 @@ class TestMaterialGirl(TestCase):
             expiration=10,
             grace_period=0
         )
+
+    def test_can_report_run_results(self):
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage)
+
+        girl.add_material('test', lambda: 'woot')
+
+        results = girl.run()
+
+        expect(results).to_include('test')
+        expect(results['test'].status).to_equal(REFRESHED)
+        expect(results['test'].succeeded).to_be_true()
+
+        results = girl.run()
+
+        expect(results['test'].status).to_equal(SKIPPED)
+
+    def test_can_report_locked_materials(self):
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage)
+
+        girl.add_material('test', lambda: 'woot')
+        storage.acquire_lock('test')
+
+        results = girl.run()
+
+        expect(results['test'].status).to_equal(LOCKED)
+        expect(storage.items).to_be_empty()
+
+    def test_can_report_failed_materials(self):
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage)
+
+        def fail():
+            raise RuntimeError('database is gone')
+
+        girl.add_material('test1', fail)
+        girl.add_material('test2', lambda: 'woot')
+
+        results = girl.run()
+
+        expect(results['test1'].status).to_equal(FAILED)
+        expect(results['test1'].succeeded).to_be_false()
+        expect(results['test1'].error).to_be_an_error_like(RuntimeError)
+        expect(results['test2'].status).to_equal(REFRESHED)
+        expect(storage.items['test2']).to_equal('woot')
+        expect(storage.acquire_lock('test1')).not_to_be_null()
+
+    def test_can_run_materials_in_parallel(self):
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage, workers=4)
+
+        def slow(value):
+            def get():
+                time.sleep(0.2)
+                return value
+            return get
+
+        for index in range(4):
+            girl.add_material('test%d' % index, slow('woot%d' % index))
+
+        start = time.time()
+        results = girl.run()
+        elapsed = time.time() - start
+
+        girl.close()
+
+        expect(elapsed < 0.6).to_be_true()
+        expect(results).to_length(4)
+        for index in range(4):
+            expect(results['test%d' % index].status).to_equal(REFRESHED)
+            expect(storage.items['test%d' % index]).to_equal('woot%d' % index)
+
+    def test_can_run_materials_in_process_pool(self):
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage, workers=2, use_processes=True)
+
+        girl.add_material('test', get_woot)
+
+        results = girl.run()
+
+        girl.close()
+
+        expect(results['test'].status).to_equal(REFRESHED)
+        expect(storage.items['test']).to_equal('woot')
+        expect(girl.materials['test'].current_value).to_equal('woot')
+
+    def test_checks_and_locks_in_a_single_call_after_first_run(self):
+        storage = Mock(acquire_lock_if_expired=Mock(return_value=None))
+
+        girl = Materializer(storage=storage)
+        girl.add_material('test', lambda: 'woot', lock_timeout=3)
+
+        girl.run()
+        results = girl.run()
+
+        expect(results['test'].status).to_equal(SKIPPED)
+        expect(storage.acquire_lock.call_count).to_equal(1)
+        expect(storage.store.call_count).to_equal(1)
+        storage.acquire_lock_if_expired.assert_called_once_with('test', 10, timeout=3)
+        expect(storage.is_expired.called).to_be_false()
+
+    def test_can_get_many(self):
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage)
+
+        girl.add_material('test1', lambda: 'woot1')
+        girl.add_material('test2', lambda: 'woot2')
+        girl.add_material('test3', lambda: 'woot3')
+
+        storage.store('test1', 'stored1', expiration=10)
+
+        values = girl.get_many(['test1', 'test2'])
+
+        expect(values).to_be_like({'test1': 'stored1', 'test2': 'woot2'})
+        expect(storage.items).to_be_like({'test1': 'stored1', 'test2': 'woot2'})
+
+    def test_get_many_loads_misses_concurrently_and_stores_them_at_once(self):
+        storage = Mock(retrieve_many=Mock(return_value={'test1': None, 'test2': None}))
+        girl = Materializer(storage=storage, workers=2)
+
+        def slow(value):
+            def get():
+                time.sleep(0.2)
+                return value
+            return get
+
+        girl.add_material('test1', slow('woot1'))
+        girl.add_material('test2', slow('woot2'), expiration=20, grace_period=30)
+
+        start = time.time()
+        values = girl.get_many(['test1', 'test2'])
+        elapsed = time.time() - start
+
+        girl.close()
+
+        expect(elapsed < 0.4).to_be_true()
+        expect(values).to_be_like({'test1': 'woot1', 'test2': 'woot2'})
+        storage.retrieve_many.assert_called_once_with(['test1', 'test2'])
+        storage.store_many.assert_called_once_with([
+            ('test1', 'woot1', 10, 0),
+            ('test2', 'woot2', 20, 30),
+        ])
+
+    def test_get_many_can_miss_the_cache(self):
+        storage = Mock(retrieve_many=Mock(return_value={'test': None}))
+        girl = Materializer(storage=storage, load_on_cachemiss=False)
+        girl.add_material('test', lambda: 'woot')
+
+        expect(girl.get_many(['test'])).to_be_like({'test': None})
+        expect(storage.store_many.called).to_be_false()
+
+    def test_get_many_raises_if_key_not_found(self):
+        girl = Materializer(storage=InMemoryStorage())
+
+        try:
+            girl.get_many(['test'])
+        except ValueError:
+            err = sys.exc_info()[1]
+            expect(err).to_have_an_error_message_of(
+                'Key test not found in materials. Maybe you forgot to call "add_material" for this key?'
+            )
+        else:
+            assert False, "Should not have gotten this far"
+
+    def test_concurrent_cache_misses_load_material_once(self):
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage)
+
+        calls = []
+
+        def slow():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'woot'
+
+        girl.add_material('test', slow)
+
+        values = []
+        threads = [threading.Thread(target=lambda: values.append(girl.get('test'))) for index in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        expect(calls).to_length(1)
+        expect(values).to_equal(['woot'] * 10)
+        expect(storage.items['test']).to_equal('woot')
+
+    def test_concurrent_cache_misses_share_errors(self):
+        girl = Materializer(storage=InMemoryStorage())
+
+        def fail():
+            time.sleep(0.1)
+            raise RuntimeError('database is gone')
+
+        girl.add_material('test', fail)
+
+        errors = []
+
+        def get():
+            try:
+                girl.get('test')
+            except RuntimeError:
+                errors.append(sys.exc_info()[1])
+
+        threads = [threading.Thread(target=get) for index in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        expect(errors).to_length(3)
+        expect(girl._flights).to_be_empty()
+
+    def test_cache_miss_waits_for_value_loaded_elsewhere(self):
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage, cachemiss_wait=2, cachemiss_poll_interval=0.01)
+
+        calls = []
+        girl.add_material('test', lambda: calls.append(1) or 'mine')
+
+        lock = storage.acquire_lock('test')
+
+        def load_elsewhere():
+            time.sleep(0.1)
+            storage.store('test', 'theirs', expiration=10)
+            storage.release_lock(lock)
+
+        thread = threading.Thread(target=load_elsewhere)
+        thread.start()
+
+        value = girl.get('test')
+        thread.join()
+
+        expect(value).to_equal('theirs')
+        expect(calls).to_be_empty()
+
+    def test_cache_miss_loads_value_if_waiting_times_out(self):
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage, cachemiss_wait=0.1, cachemiss_poll_interval=0.01)
+
+        girl.add_material('test', lambda: 'woot')
+
+        storage.acquire_lock('test')
+
+        expect(girl.get('test')).to_equal('woot')
+        expect(storage.items['test']).to_equal('woot')
+
+    def test_cache_miss_uses_value_stored_while_acquiring_lock(self):
+        storage = Mock(
+            retrieve=Mock(side_effect=[None, 'theirs']),
+            acquire_lock=Mock(return_value='lock')
+        )
+        girl = Materializer(storage=storage)
+
+        girl.add_material('test', lambda: 'mine')
+
+        expect(girl.get('test')).to_equal('theirs')
+        expect(storage.store.called).to_be_false()
+        storage.release_lock.assert_called_once_with('lock')
+
+    def test_can_serve_stale_value_while_revalidating(self):
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage, stale_while_revalidate=True)
+
+        refreshed = threading.Event()
+
+        def slow():
+            time.sleep(0.1)
+            refreshed.set()
+            return 'new'
+
+        girl.add_material('test', slow)
+
+        storage.store('test', 'old', expiration=10)
+        storage.expire('test')
+
+        start = time.time()
+        value = girl.get('test')
+
+        expect(time.time() - start < 0.1).to_be_true()
+        expect(value).to_equal('old')
+
+        expect(refreshed.wait(2)).to_be_true()
+        girl.close()
+
+        expect(storage.retrieve('test')).to_equal('new')
+        expect(storage.is_expired('test')).to_be_false()
+
+    def test_dont_revalidate_fresh_values(self):
+        storage = Mock(retrieve_with_expiration=Mock(return_value=('woot', False)))
+        girl = Materializer(storage=storage, stale_while_revalidate=True)
+        girl.add_material('test', lambda: 'new')
+
+        expect(girl.get('test')).to_equal('woot')
+        expect(storage.acquire_lock_if_expired.called).to_be_false()
+
+    def test_revalidates_values_about_to_expire(self):
+        storage = Mock(
+            retrieve_with_expiration=Mock(return_value=('woot', True)),
+            acquire_lock_if_expired=Mock(return_value='lock')
+        )
+        girl = Materializer(storage=storage, stale_while_revalidate=True, refresh_ahead=5)
+        girl.add_material('test', lambda: 'new', expiration=20, lock_timeout=3)
+
+        expect(girl.get('test')).to_equal('woot')
+        girl.close()
+
+        storage.retrieve_with_expiration.assert_called_once_with('test', 25)
+        storage.acquire_lock_if_expired.assert_called_once_with('test', 25, timeout=3)
+        storage.store.assert_called_once_with('test', 'new', expiration=20, grace_period=0)
+        storage.release_lock.assert_called_once_with('lock')
+
+    def test_does_not_revalidate_fresh_redis_values_without_grace_period(self):
+        key = 'test-swr-%s' % time.time()
+        storage = RedisStorage(self.redis)
+        girl = Materializer(storage=storage, stale_while_revalidate=True, refresh_ahead=5)
+        calls = []
+
+        girl.add_material(key, lambda: calls.append(1) or 'woot', expiration=60)
+        girl.run()
+
+        # a value a couple of seconds old
+        self.redis.pexpire(key, 58000)
+
+        for _ in range(10):
+            expect(girl.get(key)).to_equal('woot')
+        girl.close()
+
+        expect(calls).to_length(1)
+
+    def test_revalidation_is_skipped_if_refreshed_elsewhere(self):
+        storage = Mock(
+            retrieve_with_expiration=Mock(return_value=('woot', True)),
+            acquire_lock_if_expired=Mock(return_value=None)
+        )
+        girl = Materializer(storage=storage, stale_while_revalidate=True)
+        girl.add_material('test', lambda: 'new')
+
+        girl.get('test')
+        girl.close()
+
+        expect(storage.store.called).to_be_false()
+        expect(girl._revalidating).to_be_empty()
+
+    def test_material_records_last_duration(self):
+        material = Material('test', lambda: time.sleep(0.05) or 'woot')
+
+        expect(material.last_duration).to_be_null()
+
+        material.get()
+
+        expect(material.last_duration >= 0.05).to_be_true()
+
+    def test_material_has_no_early_refresh_by_default(self):
+        material = Material('test', lambda: 'woot')
+        material.last_duration = 10
+
+        expect(material.early_refresh_offset()).to_equal(0)
+
+    @patch('materialgirl.materializer.random', Mock(return_value=1 - math.exp(-1)))
+    def test_material_early_refresh_offset_follows_last_duration(self):
+        material = Material('test', lambda: 'woot', early_refresh_beta=2)
+
+        expect(material.early_refresh_offset()).to_equal(0)
+
+        material.last_duration = 3
+
+        expect(round(material.early_refresh_offset(), 6)).to_equal(6)
+
+    def test_material_is_due_early(self):
+        material = Material('test', lambda: 'woot', expiration=10)
+        material.get()
+
+        expect(material.is_due()).to_be_false()
+        expect(material.is_due(early=11)).to_be_true()
+
+    def test_material_stored_expiration_without_jitter(self):
+        material = Material('test', lambda: 'woot', expiration=10, grace_period=20)
+
+        expect(material.stored_expiration()).to_equal((10, 20))
+
+    def test_material_stored_expiration_with_jitter(self):
+        material = Material('test', lambda: 'woot', expiration=10, grace_period=20, ttl_jitter=0.5)
+
+        for index in range(20):
+            expiration, grace_period = material.stored_expiration()
+
+            expect(expiration >= 10 and expiration <= 15).to_be_true()
+            expect(round(grace_period - expiration, 6)).to_equal(10)
+
+    @patch('materialgirl.materializer.random', Mock(return_value=1 - math.exp(-1)))
+    def test_run_checks_expiration_early(self):
+        storage = Mock(acquire_lock_if_expired=Mock(return_value=None))
+        girl = Materializer(storage=storage)
+        girl.add_material('test', lambda: 'woot', expiration=100, early_refresh_beta=1)
+
+        girl.run()
+        girl.materials['test'].last_duration = 4
+        girl.run()
+
+        storage.acquire_lock_if_expired.assert_called_once_with('test', 104, timeout=None)
+
+    @patch('materialgirl.materializer.random', Mock(return_value=1 - math.exp(-1)))
+    def test_run_refreshes_materials_about_to_expire(self):
+        storage = Mock()
+        girl = Materializer(storage=storage)
+        girl.add_material('test', lambda: 'woot', expiration=10, early_refresh_beta=1)
+
+        girl.run()
+        girl.materials['test'].last_duration = 20
+
+        results = girl.run()
+
+        expect(results['test'].status).to_equal(REFRESHED)
+        expect(storage.acquire_lock.call_count).to_equal(2)
+        expect(storage.acquire_lock_if_expired.called).to_be_false()
+
+    def test_run_stores_jittered_expiration(self):
+        storage = Mock()
+        girl = Materializer(storage=storage)
+        girl.add_material('test', lambda: 'woot', expiration=10, ttl_jitter=0.5)
+
+        girl.run()
+
+        kwargs = storage.store.call_args[1]
+        expect(kwargs['expiration'] >= 10 and kwargs['expiration'] <= 15).to_be_true()
+        expect(round(kwargs['expiration'] - kwargs['grace_period'], 6)).to_equal(10)
+        expect(girl.materials['test'].expiration_date - time.time() > 9).to_be_true()
+
+    def test_run_due_only_touches_due_materials(self):
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage)
+
+        girl.add_material('test1', lambda: 'woot1', expiration=100)
+        girl.add_material('test2', lambda: 'woot2', expiration=100)
+
+        results = girl.run_due()
+
+        expect(results).to_length(2)
+        expect(storage.items).to_length(2)
+
+        storage.acquire_lock = Mock()
+
+        expect(girl.run_due()).to_be_empty()
+        expect(storage.acquire_lock.called).to_be_false()
+
+    def test_run_due_reschedules_materials(self):
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage)
+
+        girl.add_material('test', lambda: 'woot', expiration=100)
+        girl.run_due()
+
+        material = girl.materials['test']
+        expect(girl.scheduler.next_due_time()).to_equal(material.expiration_date)
+
+    def test_values_loaded_by_get_are_not_due_until_they_expire(self):
+        girl = Materializer(storage=InMemoryStorage())
+        girl.add_material('test', lambda: 'woot', expiration=100)
+        girl.add_material('other', lambda: 'woot', expiration=100)
+
+        girl.get('test')
+        girl.get_many(['other'])
+
+        expect(girl.scheduler.due_times['test']).to_equal(girl.materials['test'].expiration_date)
+        expect(girl.scheduler.due_times['other']).to_equal(girl.materials['other'].expiration_date)
+        expect(girl.run_due()).to_be_empty()
+
+    def test_expire_wakes_material(self):
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage)
+
+        woots = self.woots_generator()
+        girl.add_material('test', lambda: next(woots), expiration=100)
+        girl.run_due()
+
+        girl.expire('test')
+        results = girl.run_due()
+
+        expect(results['test'].status).to_equal(REFRESHED)
+        expect(storage.items['test']).to_equal('woot2')
+
+    def test_can_run_forever(self):
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage)
+
+        woots = self.woots_generator()
+        girl.add_material('test', lambda: next(woots), expiration=100)
+
+        thread = threading.Thread(target=girl.run_forever)
+        thread.start()
+
+        time.sleep(0.1)
+        expect(storage.items['test']).to_equal('woot1')
+
+        girl.expire('test')
+        time.sleep(0.1)
+        expect(storage.items['test']).to_equal('woot2')
+
+        girl.stop()
+        thread.join(1)
+
+        expect(thread.is_alive()).to_be_false()
+
+    def test_run_due_keeps_materials_scheduled_after_storage_errors(self):
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage)
+        girl.add_material('a', lambda: 'woot', expiration=3600)
+        girl.add_material('b', lambda: 'woot', expiration=3600)
+
+        acquire_lock = storage.acquire_lock
+        errors = [ConnectionError('redis is gone')]
+
+        def flaky_acquire_lock(key, timeout=None):
+            if key == 'a' and errors:
+                raise errors.pop()
+            return acquire_lock(key, timeout=timeout)
+
+        storage.acquire_lock = flaky_acquire_lock
+        results = girl.run_due()
+
+        expect(results['a'].status).to_equal(FAILED)
+        expect(results['b'].status).to_equal(REFRESHED)
+        expect(girl.scheduler.due_times['a'] <= time.time() + 1).to_be_true()
+
+        time.sleep(1)
+        expect(girl.run_due()['a'].status).to_equal(REFRESHED)
+
+    def test_run_due_keeps_materials_scheduled_when_heartbeat_fails(self):
+        partitioner = Mock(heartbeat_interval=5)
+        partitioner.heartbeat.side_effect = ConnectionError('redis is gone')
+        girl = Materializer(storage=InMemoryStorage(), partitioner=partitioner)
+        girl.add_material('test', lambda: 'woot', expiration=3600)
+
+        with expect.error_to_happen(ConnectionError):
+            girl.run_due()
+
+        expect('test' in girl.scheduler).to_be_true()
+
+    def test_retries_failed_refreshes_with_backoff(self):
+        girl = Materializer(storage=InMemoryStorage())
+
+        def fail():
+            raise RuntimeError('database is gone')
+
+        girl.add_material('test', fail, expiration=3600)
+
+        for delay in (1, 2, 4):
+            start = time.time()
+            girl.run()
+            expect(girl.scheduler.due_times['test'] - start).to_be_lesser_or_equal_to(delay + 0.1)
+            expect(girl.scheduler.due_times['test'] - start).to_be_greater_or_equal_to(delay)
+
+        girl.materials['test'].get_method = lambda: 'woot'
+        girl.run()
+        expect(girl.materials['test'].failures).to_equal(0)
+
+    def test_run_forever_keeps_running_after_errors(self):
+        girl = Materializer(storage=InMemoryStorage())
+        calls = []
+
+        def run_due():
+            calls.append(True)
+            if len(calls) == 1:
+                raise ConnectionError('redis is gone')
+            girl.stop()
+
+        girl.run_due = run_due
+        girl.run_forever(max_sleep=0.01)
+
+        expect(calls).to_length(2)
+
+    def test_can_add_material_with_serializer(self):
+        storage = Mock()
+        serializer = Mock()
+        girl = Materializer(storage=storage)
+
+        girl.add_material('test', lambda: 'woot', serializer=serializer)
+
+        storage.use_serializer.assert_called_once_with('test', serializer)
+
+    def test_can_iterate_records(self):
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage)
+
+        girl.add_material('test', lambda: ['woot1', 'woot2'])
+        girl.add_material('other', lambda: 'woot')
+
+        expect(list(girl.iter_get('test'))).to_equal(['woot1', 'woot2'])
+        expect(storage.items['test']).to_equal(['woot1', 'woot2'])
+        expect(list(girl.iter_get('test'))).to_equal(['woot1', 'woot2'])
+        expect(list(girl.iter_get('other'))).to_equal(['woot'])
+
+    def test_iterates_nothing_on_cache_miss(self):
+        girl = Materializer(storage=InMemoryStorage(), load_on_cachemiss=False)
+        girl.add_material('test', lambda: ['woot'])
+
+        expect(list(girl.iter_get('test'))).to_be_empty()
+
+    def test_iter_get_raises_if_key_not_found(self):
+        girl = Materializer(storage=InMemoryStorage())
+
+        try:
+            girl.iter_get('test')
+        except ValueError:
+            err = sys.exc_info()[1]
+            expect(err).to_have_an_error_message_of(
+                'Key test not found in materials. Maybe you forgot to call "add_material" for this key?'
+            )
+        else:
+            assert False, "Should not have gotten this far"
+
+    def test_derived_materials_get_their_dependencies_values(self):
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage)
+
+        girl.add_material('total', lambda first, second: first + second, dependencies=['first', 'second'])
+        girl.add_material('first', lambda: 1)
+        girl.add_material('second', lambda: 2)
+
+        results = girl.run()
+
+        expect(storage.items['total']).to_equal(3)
+        expect(results['total'].status).to_equal(REFRESHED)
+        expect(girl._levels(['total', 'first', 'second'])).to_equal([['first', 'second'], ['total']])
+
+    def test_derived_materials_are_only_recomputed_when_inputs_change(self):
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage)
+
+        values = iter(['woot', 'woot', 'other'])
+        derive = Mock(side_effect=lambda value: value.upper())
+
+        girl.add_material('base', lambda: next(values))
+        girl.add_material('derived', derive, expiration=100, dependencies=['base'])
+
+        girl.run()
+        expect(derive.call_count).to_equal(1)
+
+        girl.expire('base')
+        results = girl.run()
+        expect(results['base'].status).to_equal(REFRESHED)
+        expect(results['derived'].status).to_equal(SKIPPED)
+        expect(derive.call_count).to_equal(1)
+
+        girl.expire('base')
+        results = girl.run()
+        expect(results['derived'].status).to_equal(REFRESHED)
+        expect(storage.items['derived']).to_equal('OTHER')
+
+    def test_run_due_refreshes_dependents(self):
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage)
+
+        values = iter(['woot1', 'woot2'])
+        girl.add_material('base', lambda: next(values))
+        girl.add_material('derived', lambda value: value.upper(), expiration=100, dependencies=['base'])
+        girl.run()
+
+        girl.expire('base')
+        results = girl.run_due()
+
+        expect(set(results)).to_equal(set(['base', 'derived']))
+        expect(storage.items['derived']).to_equal('WOOT2')
+
+    def test_adding_material_again_replaces_its_dependencies(self):
+        girl = Materializer(storage=InMemoryStorage())
+        girl.add_material('base', get_woot)
+        girl.add_material('other', get_woot)
+        girl.add_material('derived', lambda value: value, dependencies=['base'])
+        girl.add_material('derived', lambda value: value, dependencies=['other'])
+
+        expect(girl._levels(['base'])).to_equal([['base']])
+        expect(girl._levels(['other'])).to_equal([['other'], ['derived']])
+
+    def test_can_refresh_independent_branches_in_parallel(self):
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage, workers=2)
+        barrier = threading.Barrier(2, timeout=2)
+
+        def branch(value):
+            barrier.wait()
+            return value
+
+        girl.add_material('first', lambda: branch('woot1'))
+        girl.add_material('second', lambda: branch('woot2'))
+        girl.add_material('both', lambda first, second: [first, second], dependencies=['first', 'second'])
+
+        try:
+            results = girl.run()
+        finally:
+            girl.close()
+
+        expect(results['both'].status).to_equal(REFRESHED)
+        expect(storage.items['both']).to_equal(['woot1', 'woot2'])
+
+    def test_get_loads_dependencies_on_cachemiss(self):
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage)
+
+        girl.add_material('base', lambda: 'woot')
+        girl.add_material('derived', lambda value: value.upper(), dependencies=['base'])
+
+        expect(girl.get('derived')).to_equal('WOOT')
+        expect(storage.items['base']).to_equal('woot')
+
+    def test_derived_material_fails_without_dependency_value(self):
+        girl = Materializer(storage=InMemoryStorage())
+
+        girl.add_material('base', lambda: None)
+        girl.add_material('derived', lambda value: value, dependencies=['base'])
+
+        results = girl.run()
+
+        expect(results['derived'].status).to_equal(FAILED)
+        expect(results['derived'].error).to_have_an_error_message_of(
+            'Material derived depends on base, which has no value.'
+        )
+
+    def test_run_raises_on_invalid_dependencies(self):
+        girl = Materializer(storage=InMemoryStorage())
+        girl.add_material('test', lambda value: value, dependencies=['missing'])
+
+        try:
+            girl.run()
+        except ValueError:
+            err = sys.exc_info()[1]
+            expect(err).to_have_an_error_message_of(
+                'Material test depends on missing, which was not found in materials. '
+                'Maybe you forgot to call "add_material" for it?'
+            )
+        else:
+            assert False, "Should not have gotten this far"
+
+        girl = Materializer(storage=InMemoryStorage())
+        girl.add_material('first', lambda value: value, dependencies=['second'])
+        girl.add_material('second', lambda value: value, dependencies=['first'])
+
+        try:
+            girl.run()
+        except ValueError:
+            err = sys.exc_info()[1]
+            expect(err).to_have_an_error_message_of('Materials first -> second -> first depend on each other.')
+        else:
+            assert False, "Should not have gotten this far"
+
+    def test_incremental_material_merges_deltas(self):
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage)
+
+        rows = [1, 2, 3]
+        merge = lambda previous, changes: previous + changes
+        delta = Mock(side_effect=lambda previous, watermark: Delta(rows[len(previous):], merge, watermark=len(rows)))
+
+        girl.add_material('test', lambda: list(rows), delta_method=delta)
+        expect(girl.materials['test']).to_be_instance_of(IncrementalMaterial)
+
+        girl.run()
+        expect(storage.items['test']).to_equal([1, 2, 3])
+        expect(delta.called).to_be_false()
+
+        rows.extend([4, 5])
+        girl.expire('test')
+        girl.run()
+
+        delta.assert_called_once_with([1, 2, 3], girl.materials['test'].last_full_refresh)
+        expect(storage.items['test']).to_equal([1, 2, 3, 4, 5])
+        expect(girl.materials['test'].watermark).to_equal(5)
+
+    def test_incremental_material_can_return_new_value(self):
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage)
+
+        girl.add_material('test', lambda: 1, delta_method=lambda previous, watermark: previous + 1)
+
+        girl.run()
+        girl.expire('test')
+        girl.run()
+
+        expect(storage.items['test']).to_equal(2)
+
+    def test_incremental_material_is_fully_refreshed_on_schedule(self):
+        get_method = Mock(return_value='full')
+        material = IncrementalMaterial(
+            'test', get_method, lambda previous, watermark: 'delta', full_refresh_interval=10
+        )
+
+        expect(material.get()).to_equal('full')
+        expect(material.get()).to_equal('delta')
+
+        material.last_full_refresh -= 10
+
+        expect(material.get()).to_equal('full')
+        expect(get_method.call_count).to_equal(2)
+
+    def test_incremental_material_gets_dependencies_values(self):
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage)
+
+        girl.add_material('base', lambda: 10)
+        girl.add_material(
+            'test',
+            lambda base: base,
+            delta_method=lambda previous, watermark, base: previous + base,
+            dependencies=['base']
+        )
+
+        girl.run()
+        girl.expire('test')
+        girl.run()
+
+        expect(storage.items['test']).to_equal(20)
+
+    def test_can_compile_key_patterns(self):
+        regex = compile_pattern('violations.{domain_id}:{page}')
+
+        expect(regex.match('violations.10:20').groupdict()).to_equal({'domain_id': '10', 'page': '20'})
+        expect(regex.match('violationsX10:20')).to_be_null()
+        expect(regex.match('other.10:20')).to_be_null()
+
+    def test_can_get_materials_of_family(self):
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage)
+
+        factory = Mock(side_effect=lambda domain_id: lambda: 'woot-%s' % domain_id)
+        family = girl.add_material_family('violations:{domain_id}', factory, expiration=20)
+
+        expect(girl.get('violations:10')).to_equal('woot-10')
+        expect(girl.get('violations:10')).to_equal('woot-10')
+
+        factory.assert_called_once_with(domain_id='10')
+        expect(storage.items['violations:10']).to_equal('woot-10')
+        expect(storage.entries['violations:10'].expiration).to_equal(20)
+        expect(family.members).to_include('violations:10')
+        expect(girl.materials).to_be_empty()
+
+        try:
+            girl.get('other:10')
+        except ValueError:
+            err = sys.exc_info()[1]
+            expect(err).to_have_an_error_message_of(
+                'Key other:10 not found in materials. Maybe you forgot to call "add_material" for this key?'
+            )
+        else:
+            assert False, "Should not have gotten this far"
+
+    def test_run_refreshes_only_requested_family_members(self):
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage)
+
+        woots = self.woots_generator()
+        girl.add_material_family('test:{id}', lambda id: lambda: next(woots))
+        girl.add_material('other', lambda: 'woot')
+
+        expect(girl.run()).to_length(1)
+
+        girl.get('test:1')
+        girl.expire('test:1')
+        results = girl.run()
+
+        expect(results['test:1'].status).to_equal(REFRESHED)
+        expect(storage.items['test:1']).to_equal('woot2')
+
+    def test_family_members_do_not_keep_their_values(self):
+        girl = Materializer(storage=InMemoryStorage())
+        family = girl.add_material_family('test:{id}', lambda id: lambda: 'woot', expiration=100)
+
+        expect(girl.get('test:1')).to_equal('woot')
+        girl.run()
+
+        member = family.members['test:1']
+        expect(member.current_value).to_be_null()
+        expect(member.is_loaded).to_be_true()
+        expect(member.is_due()).to_be_false()
+
+    def test_family_forgets_members_not_requested_recently(self):
+        family = MaterialFamily('test:{id}', lambda id: lambda: id, active_for=10, max_members=2)
+
+        for key in ('test:1', 'test:2', 'test:3'):
+            family.request(key, family.match(key))
+
+        expect(family.prune()).to_equal(['test:1'])
+
+        family.members['test:2'].requested_at -= 10
+        expect(family.prune()).to_equal(['test:2'])
+        expect(list(family.members)).to_equal(['test:3'])
+
+    def test_run_removes_inactive_family_members_from_schedule(self):
+        girl = Materializer(storage=InMemoryStorage())
+        family = girl.add_material_family('test:{id}', lambda id: lambda: 'woot', active_for=0)
+
+        girl.get('test:1')
+        expect('test:1' in girl.scheduler).to_be_true()
+
+        expect(girl.run()).to_be_empty()
+        expect(family).to_length(0)
+        expect('test:1' in girl.scheduler).to_be_false()
+        expect(girl.run_due()).to_be_empty()
+
+    def test_run_due_forgets_family_members_not_requested_recently(self):
+        girl = Materializer(storage=InMemoryStorage())
+        family = girl.add_material_family('test:{id}', lambda id: lambda: 'woot', max_members=2)
+
+        for index in range(5):
+            girl.get('test:%d' % index)
+
+        girl.run_due()
+
+        expect(list(family.members)).to_equal(['test:3', 'test:4'])
+        expect('test:0' in girl.scheduler).to_be_false()
+        expect('test:4' in girl.scheduler).to_be_true()
+
+    def test_workers_refresh_family_members_requested_in_other_processes(self):
+        storage = InMemoryStorage()
+        reader = Materializer(storage=storage)
+        reader.add_material_family('test:{id}', lambda id: lambda: 'woot')
+        worker = Materializer(storage=storage)
+        family = worker.add_material_family('test:{id}', lambda id: lambda: 'woot')
+
+        reader.get('test:1')
+        storage.expire('test:1')
+        results = worker.run_due()
+
+        expect(list(family.members)).to_equal(['test:1'])
+        expect(results['test:1'].status).to_equal(REFRESHED)
+
+    def test_can_expire_materials_by_tag(self):
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage)
+
+        girl.add_material('test1', lambda: 'woot', expiration=100, tags=['domain:1'])
+        girl.add_material('test2', lambda: 'woot', expiration=100, tags=['domain:1', 'pages'])
+        girl.add_material('test3', lambda: 'woot', expiration=100, tags=['pages'])
+        girl.add_material_family('violations:{domain_id}', lambda domain_id: lambda: 'woot', tags=['domain:{domain_id}'])
+        girl.run_due()
+        girl.get('violations:1')
+        girl.get('violations:2')
+
+        expect(sorted(girl.expire_tag('domain:1'))).to_equal(['test1', 'test2', 'violations:1'])
+
+        expect(girl.is_expired('test1')).to_be_true()
+        expect(girl.is_expired('test3')).to_be_false()
+        expect(girl.is_expired('violations:2')).to_be_false()
+
+        results = girl.run_due()
+        expect(results['test1'].status).to_equal(REFRESHED)
+        expect(results['violations:1'].status).to_equal(REFRESHED)
+        expect(results).not_to_include('test3')
+
+    def test_abandons_refreshes_taking_longer_than_refresh_timeout(self):
+        storage = InMemoryStorage()
+        metrics = InMemoryMetrics()
+        girl = Materializer(storage=storage, metrics=metrics)
+        finished = threading.Event()
+
+        def slow():
+            finished.wait(1)
+            return 'woot'
+
+        girl.add_material('test', slow, refresh_timeout=0.05)
+
+        result = girl.run()['test']
+        finished.set()
+
+        expect(result.status).to_equal(FAILED)
+        expect(result.error).to_be_an_error_like(RefreshTimeout)
+        expect(storage.retrieve('test')).to_be_null()
+        expect(storage.acquire_lock('test')).not_to_be_null()
+        expect(metrics.counter('refresh.timeout', material='test')).to_equal(1)
+
+    def test_does_not_refresh_again_while_abandoned_refresh_runs(self):
+        girl = Materializer(storage=InMemoryStorage())
+        finished = threading.Event()
+        calls = []
+
+        def slow():
+            calls.append(True)
+            finished.wait(1)
+            return 'woot'
+
+        girl.add_material('test', slow, refresh_timeout=0.05)
+        girl.run()
+
+        girl.expire('test')
+        result = girl.run()['test']
+
+        expect(result.error).to_be_an_error_like(RefreshTimeout)
+        expect(calls).to_length(1)
+
+        finished.set()
+        girl._abandoned['test'].done.wait(1)
+        girl.expire('test')
+
+        expect(girl.run()['test'].status).to_equal(REFRESHED)
+        expect(calls).to_length(2)
+
+    def test_refresh_timeout_keeps_get_method_errors(self):
+        girl = Materializer(storage=InMemoryStorage())
+
+        def fail():
+            raise RuntimeError('database is gone')
+
+        girl.add_material('test', fail, refresh_timeout=1)
+
+        expect(girl.run()['test'].error).to_be_an_error_like(RuntimeError)
+
+    def test_renews_lock_lease_while_refreshing(self):
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage, lock_lease=0.06)
+        locked = []
+
+        def slow():
+            time.sleep(0.15)
+            locked.append(storage.acquire_lock('test') is None)
+            return 'woot'
+
+        girl.add_material('test', slow)
+
+        expect(girl.run()['test'].status).to_equal(REFRESHED)
+        expect(locked).to_equal([True])
+        expect(storage.acquire_lock('test')).not_to_be_null()
+
+    def test_lock_lease_keeps_explicit_lock_timeout(self):
+        storage = Mock(acquire_lock=Mock(return_value='lock'), renew_lock=Mock(return_value=True))
+        girl = Materializer(storage=storage, lock_lease=30)
+
+        girl.add_material('test', get_woot, lock_timeout=60)
+        girl.add_material('other', get_woot)
+        girl.run()
+
+        storage.acquire_lock.assert_any_call('test', timeout=60)
+        storage.acquire_lock.assert_any_call('other', timeout=30)
+
+    def test_does_not_store_after_losing_lock(self):
+        storage = InMemoryStorage()
+        metrics = InMemoryMetrics()
+        girl = Materializer(storage=storage, lock_lease=0.03, metrics=metrics)
+
+        def slow():
+            # someone else takes the lock as it was not renewed in time
+            storage.locks.pop('test')
+            storage.acquire_lock('test')
+            time.sleep(0.1)
+            return 'woot'
+
+        girl.add_material('test', slow)
+        result = girl.run()['test']
+
+        expect(result.status).to_equal(FAILED)
+        expect(result.error).to_be_an_error_like(StaleLockError)
+        expect(storage.retrieve('test')).to_be_null()
+        expect(metrics.counter('lock.lost', material='test')).to_equal(1)
+
+    def test_rejects_values_of_stale_workers_with_fencing(self):
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage, fencing=True)
+
+        def slow():
+            # another worker took the lock meanwhile and stored its value
+            storage.store('test', 'newer', expiration=10, fence=storage.fence('test'))
+            return 'woot'
+
+        girl.add_material('test', slow)
+        result = girl.run()['test']
+
+        expect(result.status).to_equal(FAILED)
+        expect(result.error).to_be_an_error_like(StaleLockError)
+        expect(storage.retrieve('test')).to_equal('newer')
+
+    def test_stores_with_fencing_tokens(self):
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage, fencing=True)
+        girl.add_material('test', get_woot)
+
+        expect(girl.run()['test'].status).to_equal(REFRESHED)
+        expect(girl.get('test')).to_equal('woot')
+        expect(storage.fences['test']).to_equal(1)
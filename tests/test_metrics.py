@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import unittest
+
+from mock import Mock
+from preggy import expect
+
+from materialgirl import Materializer
+from materialgirl.materializer import REFRESHED, LOCKED
+from materialgirl.metrics import (
+    Metrics, InMemoryMetrics, StatsdMetrics, PrometheusMetrics, InstrumentedStorage, prometheus_client
+)
+from materialgirl.storage.memory import InMemoryStorage
+from materialgirl.storage.redis import RedisStorage
+from tests.base import TestCase
+
+
+class TestMetrics(TestCase):
+    def test_default_metrics_do_nothing(self):
+        metrics = Metrics()
+        metrics.increment('test', material='test')
+        metrics.timing('test', 1)
+        metrics.histogram('test', 1)
+
+        expect(metrics.snapshot()).to_equal({})
+
+    def test_in_memory_metrics_keep_counters_and_summaries(self):
+        metrics = InMemoryMetrics()
+
+        metrics.increment('get.hit', material='test')
+        metrics.increment('get.hit', value=2, material='test')
+        for value in range(1, 101):
+            metrics.timing('get_method.duration', value, material='test')
+
+        expect(metrics.counter('get.hit', material='test')).to_equal(3)
+        expect(metrics.counter('get.hit', material='other')).to_equal(0)
+
+        summary = metrics.summary('get_method.duration', material='test')
+        expect(summary.to_dict()).to_equal({'count': 100, 'mean': 50.5, 'max': 100, 'p50': 51, 'p99': 100})
+
+        snapshot = metrics.snapshot()
+        expect(snapshot['counters']).to_equal({'get.hit[material=test]': 3})
+        expect(snapshot['summaries']).to_include('get_method.duration[material=test]')
+
+    def test_statsd_metrics_append_tags_to_names(self):
+        client = Mock()
+        metrics = StatsdMetrics(client)
+
+        metrics.increment('get.hit', material='test.1')
+        metrics.timing('storage.latency', 0.5, operation='store')
+        metrics.histogram('value.size', 10)
+
+        client.incr.assert_called_once_with('materialgirl.get.hit.test_1', 1)
+        client.timing.assert_called_once_with('materialgirl.storage.latency.store', 500)
+        client.gauge.assert_called_once_with('materialgirl.value.size', 10)
+
+    @unittest.skipIf(prometheus_client is None, 'prometheus_client is not installed')
+    def test_prometheus_metrics_use_labels(self):
+        registry = prometheus_client.CollectorRegistry()
+        metrics = PrometheusMetrics(registry=registry)
+
+        metrics.increment('get.hit', material='test')
+        metrics.increment('get.hit', material='test')
+        metrics.timing('get_method.duration', 0.5, material='test')
+
+        expect(registry.get_sample_value('materialgirl_get_hit_total', {'material': 'test'})).to_equal(2)
+        expect(registry.get_sample_value(
+            'materialgirl_get_method_duration_seconds_sum', {'material': 'test'}
+        )).to_equal(0.5)
+
+    @unittest.skipIf(prometheus_client is None, 'prometheus_client is not installed')
+    def test_prometheus_metrics_measure_sizes_in_bytes(self):
+        registry = prometheus_client.CollectorRegistry()
+        metrics = PrometheusMetrics(registry=registry)
+
+        metrics.histogram('value.size', 5000, material='test')
+
+        expect(registry.get_sample_value(
+            'materialgirl_value_size_bucket', {'material': 'test', 'le': '4096.0'}
+        )).to_equal(0)
+        expect(registry.get_sample_value(
+            'materialgirl_value_size_bucket', {'material': 'test', 'le': '16384.0'}
+        )).to_equal(1)
+
+    def test_instrumented_storage_times_operations(self):
+        metrics = InMemoryMetrics()
+        storage = InstrumentedStorage(RedisStorage(self.redis), metrics)
+        key = 'test-metrics-%s' % time.time()
+
+        storage.store(key, 'woot', expiration=10)
+        expect(storage.retrieve(key)).to_equal('woot')
+
+        expect(metrics.summary('storage.latency', operation='store').count).to_equal(1)
+        expect(metrics.summary('storage.latency', operation='retrieve').count).to_equal(1)
+        expect(metrics.summary('value.size', material=key).max).to_equal(5)
+        expect(storage.serializer).to_equal(storage.storage.serializer)
+
+    def test_storage_measures_family_members_together(self):
+        metrics = InMemoryMetrics()
+        prefix = 'test-metrics-%s' % time.time()
+        girl = Materializer(storage=RedisStorage(self.redis), metrics=metrics)
+        girl.add_material_family(prefix + ':{id}', lambda id: lambda: 'woot')
+
+        for index in range(50):
+            girl.get('%s:%d' % (prefix, index))
+
+        expect(metrics.summary('value.size', material=prefix + ':{id}').count).to_equal(50)
+        expect([name for name in metrics.snapshot()['summaries'] if name.startswith('value.size')]).to_length(1)
+
+    def test_materializer_reports_metrics(self):
+        metrics = InMemoryMetrics()
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage, metrics=metrics)
+
+        girl.add_material('test', lambda: 'woot')
+        girl.add_material_family('page:{id}', lambda id: lambda: id)
+
+        expect(girl.storage).to_be_instance_of(InstrumentedStorage)
+
+        girl.get('test')
+        girl.get('test')
+        girl.get('page:1')
+        girl.get_many(['test', 'page:1'])
+
+        expect(metrics.counter('get.miss', material='test')).to_equal(1)
+        expect(metrics.counter('get.hit', material='test')).to_equal(2)
+        expect(metrics.counter('get.hit', material='page:{id}')).to_equal(1)
+        expect(metrics.summary('get_method.duration', material='test').count).to_equal(1)
+        expect(metrics.summary('storage.latency', operation='retrieve_many').count).to_equal(1)
+
+        girl.add_material('locked', lambda: 'woot')
+        storage.acquire_lock('locked')
+        girl.expire('test')
+        results = girl.run()
+
+        expect(results['test'].status).to_equal(REFRESHED)
+        expect(results['locked'].status).to_equal(LOCKED)
+        expect(metrics.counter('refresh', material='test', status=REFRESHED)).to_equal(1)
+        expect(metrics.counter('lock.contended', material='locked')).to_equal(1)
+
+    def test_materializer_counts_stale_values(self):
+        metrics = InMemoryMetrics()
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage, metrics=metrics, stale_while_revalidate=True)
+
+        girl.add_material('test', lambda: 'woot', grace_period=100)
+        girl.get('test')
+        storage.expire('test')
+        girl.get('test')
+
+        try:
+            expect(metrics.counter('get.stale', material='test')).to_equal(1)
+        finally:
+            girl.close()
+
+    def test_materializer_stats(self):
+        girl = Materializer(storage=InMemoryStorage(), metrics=InMemoryMetrics())
+        girl.add_material('test', lambda: 'woot', expiration=100)
+        girl.add_material('other', lambda: 'woot')
+
+        girl.get('test')
+        stats = girl.stats()
+
+        expect(stats['materials']['test']['is_due']).to_be_false()
+        expect(stats['materials']['test']['expires_in'] > 99).to_be_true()
+        expect(stats['materials']['test']['last_duration']).not_to_be_null()
+        expect(stats['materials']['other']['is_due']).to_be_true()
+        expect(stats['metrics']['counters']['get.miss[material=test]']).to_equal(1)
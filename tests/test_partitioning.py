@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from preggy import expect
+
+from materialgirl import Materializer
+from materialgirl.partitioning import Partitioner, weight
+from materialgirl.storage.memory import InMemoryStorage
+from tests.base import TestCase
+
+
+class TestPartitioner(TestCase):
+    def test_weights_are_stable(self):
+        expect(weight('worker', 'test')).to_equal(weight('worker', 'test'))
+        expect(weight('worker', 'test')).not_to_equal(weight('other', 'test'))
+
+    def test_owns_everything_alone(self):
+        partitioner = Partitioner(InMemoryStorage(), worker_id='worker1')
+        partitioner.heartbeat()
+
+        expect(partitioner.workers).to_equal(['worker1'])
+        expect(all(partitioner.owns('test-%d' % index) for index in range(100))).to_be_true()
+
+    def test_splits_keys_among_workers(self):
+        storage = InMemoryStorage()
+        partitioners = [Partitioner(storage, worker_id='worker%d' % index) for index in range(3)]
+        for partitioner in partitioners:
+            partitioner.heartbeat()
+        for partitioner in partitioners:
+            partitioner.heartbeat(force=True)
+
+        keys = ['test-%d' % index for index in range(300)]
+        shares = [set(key for key in keys if partitioner.owns(key)) for partitioner in partitioners]
+
+        expect(sum(len(share) for share in shares)).to_equal(300)
+        expect(set.union(*shares)).to_equal(set(keys))
+        expect(min(len(share) for share in shares) > 50).to_be_true()
+
+    def test_only_moves_keys_of_leaving_workers(self):
+        storage = InMemoryStorage()
+        worker1 = Partitioner(storage, worker_id='worker1')
+        worker2 = Partitioner(storage, worker_id='worker2')
+        worker1.heartbeat()
+        worker2.heartbeat()
+        worker1.heartbeat(force=True)
+
+        keys = ['test-%d' % index for index in range(100)]
+        owned = set(key for key in keys if worker1.owns(key))
+
+        worker2.leave()
+        worker1.heartbeat(force=True)
+
+        expect(worker1.workers).to_equal(['worker1'])
+        expect(owned < set(key for key in keys if worker1.owns(key))).to_be_true()
+
+    def test_dead_workers_are_dropped(self):
+        storage = InMemoryStorage()
+        Partitioner(storage, worker_id='worker1', worker_timeout=0).heartbeat()
+
+        partitioner = Partitioner(storage, worker_id='worker2')
+        partitioner.heartbeat()
+
+        expect(partitioner.workers).to_equal(['worker2'])
+
+    def test_heartbeats_are_throttled(self):
+        storage = InMemoryStorage()
+        partitioner = Partitioner(storage, worker_id='worker1', heartbeat_interval=10)
+        partitioner.heartbeat()
+
+        Partitioner(storage, worker_id='worker2').heartbeat()
+        partitioner.heartbeat()
+        expect(partitioner.workers).to_equal(['worker1'])
+
+        partitioner.heartbeat(force=True)
+        expect(partitioner.workers).to_equal(['worker1', 'worker2'])
+
+    def test_materializer_only_refreshes_its_share(self):
+        storage = InMemoryStorage()
+        Partitioner(storage, worker_id='worker2').heartbeat()
+
+        partitioner = Partitioner(storage, worker_id='worker1')
+        girl = Materializer(storage=storage, partitioner=partitioner)
+
+        keys = ['test-%d' % index for index in range(20)]
+        for key in keys:
+            girl.add_material(key, lambda: 'woot')
+
+        results = girl.run()
+
+        expect(set(results)).to_equal(set(key for key in keys if partitioner.owns(key)))
+        expect(len(results) < 20).to_be_true()
+        expect(all('test-%d' % index in girl.scheduler for index in range(20))).to_be_true()
+
+        girl.close()
+        expect(list(storage.workers['materialgirl-workers'])).to_equal(['worker2'])
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from preggy import expect
+
+from materialgirl import Materializer
+from materialgirl.materializer import REFRESHED
+from materialgirl.resources import ResourceLimiter
+from materialgirl.storage.memory import InMemoryStorage
+from tests.base import TestCase
+
+
+def wait_until(condition, timeout=1):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.005)
+
+
+class TestResourceLimiter(TestCase):
+    def acquire_in_thread(self, limiter, order, name, **kwargs):
+        def acquire():
+            permit = limiter.acquire(**kwargs)
+            order.append(name)
+            limiter.release(permit)
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        return thread
+
+    def test_limits_cost_running_at_once(self):
+        limiter = ResourceLimiter('db', 3)
+        running = []
+        peaks = []
+
+        def use(cost):
+            permit = limiter.acquire(cost)
+            running.append(cost)
+            peaks.append(sum(running))
+            time.sleep(0.02)
+            running.remove(cost)
+            limiter.release(permit)
+
+        threads = [threading.Thread(target=use, args=(cost,)) for cost in (1, 2, 1, 2, 1, 2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        expect(max(peaks)).to_equal(3)
+        expect(limiter.used).to_equal(0)
+
+    def test_runs_highest_priority_and_longest_due_first(self):
+        limiter = ResourceLimiter('db', 1)
+        permit = limiter.acquire()
+        order = []
+
+        threads = []
+        for name, priority, due_time in (('low', 0, 1), ('high', 5, 3), ('due', 0, 0), ('late', 0, 2)):
+            threads.append(self.acquire_in_thread(limiter, order, name, priority=priority, due_time=due_time))
+            wait_until(lambda: len(limiter.waiting) == len(threads))
+
+        limiter.release(permit)
+        for thread in threads:
+            thread.join()
+
+        expect(order).to_equal(['high', 'due', 'low', 'late'])
+
+    def test_cost_over_limit_runs_alone(self):
+        limiter = ResourceLimiter('db', 2)
+        permit = limiter.acquire(cost=5)
+
+        expect(limiter.used).to_equal(2)
+
+        limiter.release(permit)
+        expect(limiter.used).to_equal(0)
+
+    def test_shares_budget_through_storage(self):
+        storage = InMemoryStorage()
+        worker1 = ResourceLimiter('db', 2, storage=storage, poll_interval=0.01)
+        worker2 = ResourceLimiter('db', 2, storage=storage, poll_interval=0.01)
+        order = []
+
+        permit = worker1.acquire(cost=2)
+        thread = self.acquire_in_thread(worker2, order, 'worker2')
+
+        time.sleep(0.05)
+        expect(order).to_be_empty()
+
+        worker1.release(permit)
+        thread.join()
+
+        expect(order).to_equal(['worker2'])
+        expect(storage.permits['db']).to_be_empty()
+
+    def test_storage_frees_permits_of_dead_workers(self):
+        storage = InMemoryStorage()
+
+        expect(storage.acquire_permit('db', 'worker1', 2, 2, 0.01)).to_be_true()
+        expect(storage.acquire_permit('db', 'worker2', 1, 2, 10)).to_be_false()
+
+        time.sleep(0.02)
+        expect(storage.acquire_permit('db', 'worker2', 1, 2, 10)).to_be_true()
+
+    def test_renews_shared_permits_while_held(self):
+        storage = InMemoryStorage()
+        limiter = ResourceLimiter('db', 1, storage=storage, permit_timeout=0.06)
+
+        permit = limiter.acquire()
+        time.sleep(0.15)
+        expect(storage.acquire_permit('db', 'someone-else', 1, 1, 10)).to_be_false()
+
+        limiter.release(permit)
+        expect(storage.acquire_permit('db', 'someone-else', 1, 1, 10)).to_be_true()
+        expect(storage.renew_permit('db', permit[1], 10)).to_be_false()
+
+
+class TestMaterializerResources(TestCase):
+    def test_limits_get_methods_using_a_resource(self):
+        girl = Materializer(storage=InMemoryStorage(), workers=4, resources={'db': 2})
+        running = []
+        peaks = []
+
+        def get_method_for(key, resource):
+            def get_method():
+                running.append(resource)
+                peaks.append(running.count('db'))
+                time.sleep(0.02)
+                running.remove(resource)
+                return key
+            return get_method
+
+        for index in range(4):
+            girl.add_material('test-%d' % index, get_method_for('test-%d' % index, 'db'), resource='db')
+        girl.add_material('free', get_method_for('free', None))
+
+        results = girl.run()
+        girl.close()
+
+        expect(all(result.succeeded for result in results.values())).to_be_true()
+        expect(max(peaks)).to_equal(2)
+        expect(girl.limiters['db'].used).to_equal(0)
+
+    def test_refreshes_higher_priority_materials_first(self):
+        girl = Materializer(storage=InMemoryStorage(), resources={'db': 1})
+        order = []
+
+        for key, priority in (('low', 0), ('high', 10), ('other', 0)):
+            girl.add_material(key, lambda key=key: order.append(key) or key, resource='db', priority=priority)
+
+        girl.run()
+
+        expect(order).to_equal(['high', 'low', 'other'])
+
+    def test_limits_cache_misses(self):
+        storage = InMemoryStorage()
+        girl = Materializer(storage=storage, resources={'db': 1}, share_resources=True)
+        girl.add_material('test', lambda: 'woot', resource='db')
+
+        permit = storage.acquire_permit('db', 'someone-else', 1, 1, 0.05)
+        expect(permit).to_be_true()
+
+        start = time.time()
+        expect(girl.get('test')).to_equal('woot')
+        expect(time.time() - start >= 0.04).to_be_true()
+
+    def test_waiting_for_resource_does_not_count_against_refresh_timeout(self):
+        girl = Materializer(storage=InMemoryStorage(), resources={'db': 1})
+        girl.add_material('test', lambda: 'woot', resource='db', refresh_timeout=0.05)
+
+        permit = girl.limiters['db'].acquire()
+        threading.Timer(0.1, girl.limiters['db'].release, args=(permit,)).start()
+
+        expect(girl.run()['test'].status).to_equal(REFRESHED)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+
+from preggy import expect
+
+from materialgirl.scheduler import Scheduler
+from tests.base import TestCase
+
+
+class TestScheduler(TestCase):
+    def test_can_create_scheduler(self):
+        scheduler = Scheduler()
+
+        expect(scheduler).to_length(0)
+        expect(scheduler.next_due_time()).to_be_null()
+
+    def test_can_schedule_keys(self):
+        scheduler = Scheduler()
+
+        scheduler.schedule('test2', 20)
+        scheduler.schedule('test1', 10)
+
+        expect(scheduler).to_length(2)
+        expect('test1' in scheduler).to_be_true()
+        expect(scheduler.next_due_time()).to_equal(10)
+
+    def test_can_pop_due_keys_in_order(self):
+        scheduler = Scheduler()
+
+        scheduler.schedule('test3', 30)
+        scheduler.schedule('test1', 10)
+        scheduler.schedule('test2', 20)
+
+        expect(scheduler.pop_due(now=25)).to_equal(['test1', 'test2'])
+        expect(scheduler).to_length(1)
+        expect(scheduler.pop_due(now=25)).to_be_empty()
+        expect(scheduler.next_due_time()).to_equal(30)
+
+    def test_rescheduling_replaces_due_time(self):
+        scheduler = Scheduler()
+
+        scheduler.schedule('test', 10)
+        scheduler.schedule('test', 30)
+
+        expect(scheduler).to_length(1)
+        expect(scheduler.pop_due(now=20)).to_be_empty()
+        expect(scheduler.pop_due(now=30)).to_equal(['test'])
+        expect(scheduler.next_due_time()).to_be_null()
+
+    def test_can_wake_key(self):
+        scheduler = Scheduler()
+
+        scheduler.schedule('test', time.time() + 100)
+        scheduler.wake('test')
+
+        expect(scheduler.pop_due()).to_equal(['test'])
+
+    def test_can_remove_key(self):
+        scheduler = Scheduler()
+
+        scheduler.schedule('test', 10)
+        scheduler.remove('test')
+
+        expect(scheduler).to_length(0)
+        expect(scheduler.pop_due(now=20)).to_be_empty()
+
+    def test_wait_sleeps_until_next_key_is_due(self):
+        scheduler = Scheduler()
+        scheduler.schedule('test', time.time() + 0.1)
+
+        start = time.time()
+        scheduler.wait(5)
+
+        expect(time.time() - start >= 0.09).to_be_true()
+        expect(time.time() - start < 1).to_be_true()
+
+    def test_wait_returns_when_key_is_scheduled(self):
+        scheduler = Scheduler()
+        scheduler.schedule('test', time.time() + 100)
+
+        timer = threading.Timer(0.1, lambda: scheduler.wake('test'))
+        timer.start()
+
+        start = time.time()
+        scheduler.wait()
+
+        expect(time.time() - start < 1).to_be_true()
+        expect(scheduler.pop_due()).to_equal(['test'])
+
+    def test_wait_returns_at_timeout(self):
+        scheduler = Scheduler()
+
+        start = time.time()
+        scheduler.wait(0.05)
+
+        expect(time.time() - start < 1).to_be_true()
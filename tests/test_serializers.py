@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import struct
+from unittest import skipIf
+
+import msgpack
+from preggy import expect
+
+from materialgirl.serializers import (
+    Serializer, MsgPackCodec, PickleCodec, JsonCodec, NumpyCodec, BytesCodec,
+    ZlibCompressor, Lz4Compressor, ZstdCompressor, numpy, lz4, zstandard
+)
+from tests.base import TestCase
+
+
+VALUE = {'domain': 'holmes.com', 'violations': [{'key': 'blocking.css', 'count': 10}] * 100}
+
+
+class TestSerializer(TestCase):
+    def test_writes_plain_msgpack_by_default(self):
+        data = Serializer().dumps(VALUE)
+
+        expect(msgpack.unpackb(data, encoding='utf-8')).to_equal(VALUE)
+        expect(Serializer().loads(data)).to_equal(VALUE)
+
+    def test_can_serialize_with_msgpack(self):
+        serializer = Serializer(MsgPackCodec())
+        data = serializer.dumps(VALUE)
+
+        expect(data[:2]).to_equal(b'\xc1\x10')
+        expect(serializer.loads(data)).to_equal(VALUE)
+
+    def test_can_serialize_with_pickle(self):
+        serializer = Serializer(PickleCodec())
+
+        expect(serializer.loads(serializer.dumps(set([1, 2, 3])))).to_equal(set([1, 2, 3]))
+
+    def test_pickle_uses_protocol_5_when_available(self):
+        expect(PickleCodec().protocol).to_equal(5 if sys.version_info >= (3, 8) else 4)
+
+    def test_can_serialize_with_json(self):
+        serializer = Serializer(JsonCodec())
+        data = serializer.dumps(VALUE)
+
+        expect(data[:2]).to_equal(b'\xc1\x30')
+        expect(serializer.loads(data)).to_equal(VALUE)
+
+    def test_compresses_values_above_threshold(self):
+        serializer = Serializer(MsgPackCodec(), ZlibCompressor(), compress_threshold=100)
+
+        data = serializer.dumps(VALUE)
+
+        expect(data[:2]).to_equal(b'\xc1\x11')
+        expect(len(data) < len(MsgPackCodec().encode(VALUE))).to_be_true()
+        expect(serializer.loads(data)).to_equal(VALUE)
+
+    def test_does_not_compress_values_below_threshold(self):
+        serializer = Serializer(MsgPackCodec(), ZlibCompressor(), compress_threshold=100)
+
+        data = serializer.dumps('woot')
+
+        expect(data[:2]).to_equal(b'\xc1\x10')
+        expect(serializer.loads(data)).to_equal('woot')
+
+    def test_can_read_values_written_by_accepted_codecs(self):
+        data = Serializer(JsonCodec(), ZlibCompressor(), compress_threshold=0).dumps(VALUE)
+
+        expect(Serializer(accept=[JsonCodec()]).loads(data)).to_equal(VALUE)
+        expect(Serializer(PickleCodec(), accept=[JsonCodec()]).loads(data)).to_equal(VALUE)
+
+    def test_reads_msgpack_values_with_any_codec(self):
+        data = Serializer(MsgPackCodec()).dumps(VALUE)
+
+        expect(Serializer(JsonCodec()).loads(data)).to_equal(VALUE)
+        expect(Serializer(JsonCodec()).loads(Serializer().dumps(VALUE))).to_equal(VALUE)
+
+    def test_does_not_read_values_of_other_codecs(self):
+        data = Serializer(JsonCodec()).dumps(VALUE)
+
+        with expect.error_to_happen(ValueError):
+            Serializer().loads(data)
+
+    def test_only_unpickles_when_asked_to(self):
+        data = Serializer(PickleCodec()).dumps(VALUE)
+
+        with expect.error_to_happen(ValueError):
+            Serializer(JsonCodec()).loads(data)
+
+        expect(Serializer(accept=[PickleCodec()]).loads(data)).to_equal(VALUE)
+
+    @skipIf(lz4 is None, 'lz4 is not installed')
+    def test_can_compress_with_lz4(self):
+        serializer = Serializer(MsgPackCodec(), Lz4Compressor(), compress_threshold=0)
+
+        expect(serializer.loads(serializer.dumps(VALUE))).to_equal(VALUE)
+
+    @skipIf(zstandard is None, 'zstandard is not installed')
+    def test_can_compress_with_zstd(self):
+        serializer = Serializer(MsgPackCodec(), ZstdCompressor(), compress_threshold=0)
+
+        expect(serializer.loads(serializer.dumps(VALUE))).to_equal(VALUE)
+
+    @skipIf(numpy is None, 'numpy is not installed')
+    def test_can_serialize_numpy_arrays(self):
+        serializer = Serializer(NumpyCodec())
+        array = numpy.arange(12, dtype='float32').reshape(3, 4)
+
+        value = serializer.loads(serializer.dumps(array))
+
+        expect(value.dtype).to_equal(array.dtype)
+        expect(value.shape).to_equal((3, 4))
+        expect((value == array).all()).to_be_true()
+
+    def test_can_serialize_bytes(self):
+        serializer = Serializer(BytesCodec())
+        data = serializer.dumps(b'woot')
+
+        value = serializer.loads(data)
+
+        expect(value).to_be_instance_of(memoryview)
+        expect(value.tobytes()).to_equal(b'woot')
+
+    def test_can_get_payload_without_copying(self):
+        serializer = Serializer(BytesCodec())
+        data = bytearray(serializer.dumps(b'woot'))
+
+        payload = serializer.payload(data)
+        data[2:3] = b'b'
+
+        expect(payload.tobytes()).to_equal(b'boot')
+
+    def test_can_get_compressed_payload(self):
+        serializer = Serializer(BytesCodec(), ZlibCompressor(), compress_threshold=0)
+
+        expect(serializer.payload(serializer.dumps(b'woot')).tobytes()).to_equal(b'woot')
+
+    def test_can_get_legacy_payload(self):
+        data = msgpack.packb('woot', encoding='utf-8')
+
+        expect(Serializer().payload(data).tobytes()).to_equal(data)
+
+    @skipIf(numpy is None, 'numpy is not installed')
+    def test_numpy_arrays_are_rebuilt_without_copying(self):
+        serializer = Serializer(NumpyCodec())
+        data = serializer.dumps(numpy.arange(1000, dtype='float64'))
+
+        value = serializer.loads(data)
+
+        expect(numpy.shares_memory(value, numpy.frombuffer(data, dtype='uint8'))).to_be_true()
+        expect(value.flags.writeable).to_be_false()
+
+    @skipIf(numpy is None, 'numpy is not installed')
+    def test_numpy_array_data_is_aligned(self):
+        for dimensions in range(1, 6):
+            data = Serializer(NumpyCodec()).dumps(numpy.zeros([2] * dimensions))
+            header_size = struct.unpack('>I', data[2:6])[0]
+
+            expect((6 + header_size) % 16).to_equal(0)